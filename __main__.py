@@ -3,7 +3,9 @@ import os
 import toml
 import importlib
 import argparse
+import signal
 import sys
+import time
 import logging
 
 
@@ -27,6 +29,119 @@ class CascadingLogger(logging.getLoggerClass()):
 logging.setLoggerClass(CascadingLogger)
 logger = logging.getLogger("website")
 
+WORKER_MIN_UPTIME = 30  # Seconds a worker has to run for to not count as a crash
+WORKER_MAX_CRASHES = 5  # Crashes in a row before a worker's given up on and everything is stopped
+WORKER_RESTART_DELAY = 1  # Seconds before restarting a crashed worker, doubled for each crash in a row
+WORKER_MAX_RESTART_DELAY = 60  # The most seconds to wait before restarting a worker
+
+
+def fork_workers(count: int) -> bool:
+    """
+    Fork the given number of worker processes, restarting any that die, and
+    wait until they've all exited. A SIGTERM or SIGINT sent to this process
+    is passed on to every worker so that they can shut down cleanly.
+
+    A worker that dies soon after starting is restarted after a delay that
+    doubles each time it happens again; if it keeps happening, every worker
+    is stopped and the parent exits with an error.
+
+    Parameters
+    -----------
+    count: :class:`int`
+        The number of workers to run.
+
+    Returns
+    --------
+    :class:`bool`
+        ``True`` in each worker process, and ``False`` in the parent once
+        every worker has stopped.
+
+    Raises
+    -------
+    :class:`SystemExit`
+        In the parent, if a worker kept crashing and every worker was
+        stopped.
+    """
+
+    children: dict[int, int] = {}  # pid: worker index
+    started_at: dict[int, float] = {}  # pid: monotonic start time
+    crashes: dict[int, int] = {}  # worker index: crashes in a row
+    stopping = False
+    aborted = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def spawn(index: int) -> bool:
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            return True
+        children[pid] = index
+        started_at[pid] = time.monotonic()
+        logger.info(f"Started worker {index} (pid {pid})")
+        return False
+
+    for index in range(count):
+        if spawn(index):
+            return True
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        index = children.pop(pid, None)
+        if index is None:
+            continue
+        uptime = time.monotonic() - started_at.pop(pid)
+        if stopping:
+            logger.info(f"Worker {index} (pid {pid}) stopped")
+            continue
+        exit_code = os.waitstatus_to_exitcode(status)
+
+        # See if it's crashing as soon as it starts
+        if uptime >= WORKER_MIN_UPTIME:
+            crashes[index] = 0
+        else:
+            crashes[index] = crashes.get(index, 0) + 1
+        if crashes[index] >= WORKER_MAX_CRASHES:
+            logger.critical(
+                f"Worker {index} (pid {pid}) exited with code {exit_code} after {uptime:.1f}s, "
+                f"{crashes[index]} times in a row; stopping all workers"
+            )
+            aborted = True
+            stop(None, None)
+            continue
+
+        # Restart it, waiting longer each time it crashes
+        delay = 0.0
+        if crashes[index]:
+            delay = min(WORKER_RESTART_DELAY * 2 ** (crashes[index] - 1), WORKER_MAX_RESTART_DELAY)
+        logger.error(
+            f"Worker {index} (pid {pid}) exited with code {exit_code} after {uptime:.1f}s; "
+            f"restarting in {delay:.1f}s"
+        )
+        restart_at = time.monotonic() + delay
+        while not stopping and time.monotonic() < restart_at:
+            time.sleep(max(0.0, min(0.5, restart_at - time.monotonic())))
+        if stopping:
+            continue
+        if spawn(index):
+            return True
+    if aborted:
+        sys.exit(1)
+    return False
+
 
 def run_website(args: argparse.Namespace) -> None:
     """
@@ -42,17 +157,35 @@ def run_website(args: argparse.Namespace) -> None:
     from aiohttp.web import Application, AppRunner, TCPSite
     from aiohttp_jinja2 import setup as jinja_setup
     from aiohttp_session import setup as session_setup, SimpleCookieStorage
-    from aiohttp_session.cookie_storage import EncryptedCookieStorage as ECS
     from jinja2 import FileSystemLoader
-    import re
-    import html
-    from datetime import datetime as dt
-    import markdown
+    from website.utils.sessions import RedisSessionStorage, RotatingEncryptedCookieStorage, load_session_keys
+    from website.utils.text_rendering import register_filters
 
     # Read config
     with open(args.config_file) as a:
         config = toml.load(a)
 
+    # Sessions can only be kept in Redis if it's enabled
+    session_backend = config.get('session', {}).get('backend')
+    if session_backend == "redis" and not config.get('redis', {}).get('enabled', False):
+        logger.warning("Redis isn't enabled; sessions will be stored in encrypted cookies instead")
+        session_backend = None
+
+    # Load the session keys before forking so that every worker can read
+    # every other worker's cookies
+    session_keys: list[bytes] = []
+    if session_backend != "redis":
+        session_keys = load_session_keys(config)
+
+    # Fork our workers - everything after this (including the database and
+    # redis pools) is created separately in each one
+    workers = getattr(args, "workers", None) or config.get("workers", 1)
+    if workers > 1:
+        logger.info(f"Starting {workers} workers")
+        if not fork_workers(workers):
+            logger.info("All workers stopped")
+            return
+
     # Create website object - don't start based on argv
     app = Application(loop=asyncio.get_event_loop(), debug=args.debug)
     app["static_root_url"] = "/static"
@@ -64,60 +197,17 @@ def run_website(args: argparse.Namespace) -> None:
     # Add middlewares
     if args.debug:
         session_setup(app, SimpleCookieStorage(max_age=int(1e6)))
+    elif session_backend == "redis":
+        session_storage = RedisSessionStorage(max_age=int(1e6))
+        session_setup(app, session_storage)
+        app.on_startup.append(session_storage.start)
+        app.on_cleanup.append(session_storage.stop)
     else:
-        session_setup(app, ECS(os.urandom(32), max_age=int(1e6)))
+        session_setup(app, RotatingEncryptedCookieStorage(session_keys, max_age=int(1e6)))
     jinja_env = jinja_setup(app, loader=FileSystemLoader(os.getcwd() + "/website/templates"))
 
     # Add our jinja env filters
-    def regex_replace(string, find, replace):
-        return re.sub(find, replace, string, re.IGNORECASE | re.MULTILINE)
-
-    def escape_text(string):
-        return html.escape(string)
-
-    def timestamp(string):
-        return dt.fromtimestamp(float(string))
-
-    def int_to_hex(string):
-        return format(hex(int(string))[2:], "0>6")
-
-    def to_markdown(string):
-        return markdown.markdown(string, extensions=["extra"])
-
-    def display_mentions(string, users):
-        def get_display_name(group):
-            user = users.get(group.group("userid"))
-            if not user:
-                return "unknown-user"
-            return user.get("display_name") or user.get("username")
-        return re.sub(
-            "(?:<|(?:&lt;))@!?(?P<userid>\\d{16,23})(?:>|(?:&gt;))",
-            lambda g: f'<span class="chatlog__mention">@{get_display_name(g)}</span>',
-            string,
-            re.IGNORECASE | re.MULTILINE,
-        )
-
-    def display_emojis(string):
-        def get_html(group):
-            return (
-                f'<img class="discord_emoji" src="https://cdn.discordapp.com/emojis/{group.group("id")}'
-                f'.{"gif" if group.group("animated") else "png"}" alt="Discord custom emoji: '
-                f'{group.group("name")}" style="height: 1em; width: auto;">'
-            )
-        return re.sub(
-            r"(?P<emoji>(?:<|&lt;)(?P<animated>a)?:(?P<name>\w+):(?P<id>\d+)(?:>|&gt;))",
-            get_html,
-            string,
-            re.IGNORECASE | re.MULTILINE,
-        )
-
-    jinja_env.filters["regex_replace"] = regex_replace
-    jinja_env.filters["escape_text"] = escape_text
-    jinja_env.filters["timestamp"] = timestamp
-    jinja_env.filters["int_to_hex"] = int_to_hex
-    jinja_env.filters["markdown"] = to_markdown
-    jinja_env.filters["display_mentions"] = display_mentions
-    jinja_env.filters["display_emojis"] = display_emojis
+    register_filters(jinja_env)
 
     # Add our connections and their loggers
     app["database"] = DatabaseWrapper
@@ -128,6 +218,39 @@ def run_website(args: argparse.Namespace) -> None:
     # Add our config
     app['config'] = config
 
+    # Add our shared outbound HTTP sessions
+    from website.utils.http_sessions import setup_sessions
+    from website.utils.sql_pools import close_dsn_pools
+    from website.utils.delivery import setup_delivery_workers
+    setup_sessions(app)
+    setup_delivery_workers(app)
+
+    # Pick where cached responses are stored
+    from website.utils.cache import RedisCacheBackend, set_cache_backend, setup_cache
+    if config.get('cache', {}).get('backend') == "redis":
+        if config.get('redis', {}).get('enabled', False):
+            set_cache_backend(RedisCacheBackend())
+        else:
+            logger.warning("Redis isn't enabled; cached responses will be kept in memory instead")
+    setup_cache(app)
+    app.on_cleanup.append(close_dsn_pools)
+
+    # Set up the processes used to render chatlogs
+    from website.utils.chatlog import setup_chatlog_renderer
+    setup_chatlog_renderer(app)
+
+    # Pick how TTS Streamdeck messages are relayed
+    from website.utils.tts_relay import setup_tts_relay
+    setup_tts_relay(app)
+
+    # Listen for changes sent from other workers
+    from website.utils.db_listeners import setup_db_listeners
+    from website.utils.authorization import setup_authorization_cache
+    from website.utils.purchase_events import setup_purchase_events
+    setup_authorization_cache(app)
+    setup_purchase_events(app)
+    setup_db_listeners(app)
+
     loop = app.loop
 
     # Connect the database pool
@@ -158,13 +281,14 @@ def run_website(args: argparse.Namespace) -> None:
     logger.info("Creating webserver...")
     application = AppRunner(app)
     loop.run_until_complete(application.setup())
-    webserver = TCPSite(application, host=args.host, port=args.port)
+    webserver = TCPSite(application, host=args.host, port=args.port, reuse_port=workers > 1)
 
     # Start the webserver
     loop.run_until_complete(webserver.start())
     logger.info(f"Server started - http://{args.host}:{args.port}/")
 
-    # This is the forever loop
+    # This is the forever loop - a SIGTERM stops it the same as a ctrl+c
+    loop.add_signal_handler(signal.SIGTERM, loop.stop)
     try:
         logger.info("Running webserver")
         loop.run_forever()
@@ -0,0 +1,148 @@
+"""
+Benchmark filtering a synthetic ICS feed, comparing the old path (parsing
+every event with ``ics`` and checking each filter in turn) against the raw
+VEVENT filter used by ``/calendar_filter``, and combining similar events
+on the raw lines against combining them with ``ics``.
+
+    python benchmarks/calendar_filter.py [event_count]
+"""
+
+from datetime import datetime as dt, timedelta
+import importlib.util
+import os
+import random
+import sys
+import time
+
+import ics
+
+
+# Load the module directly so that the rest of the website's dependencies
+# aren't needed
+spec = importlib.util.spec_from_file_location(
+    "ics_filter",
+    os.path.join(os.path.dirname(__file__), "..", "website", "utils", "ics_filter.py"),
+)
+assert spec and spec.loader
+ics_filter = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(ics_filter)
+
+
+SHIFTS = ["Tech", "Duty Manager", "Meeting", "Usher", "Bar", "Followspot"]
+SHOWS = ["Hamlet", "The Tempest", "Cats", "Panto, Again", "Quiz Night"]
+FILTERS = ["bar", "quiz night", "usher", "reminder"]
+
+
+def make_feed(count: int) -> str:
+    """
+    Build a feed with a timezone and a lot of back-to-back shifts, some of
+    which have alarms with their own summaries and descriptions.
+    """
+
+    rng = random.Random(0)
+    lines = [
+        "BEGIN:VCALENDAR",
+        "VERSION:2.0",
+        "PRODID:-//Voxel Fox//Benchmark//EN",
+        "BEGIN:VTIMEZONE",
+        "TZID:Europe/London",
+        "BEGIN:STANDARD",
+        "DTSTART:19701025T020000",
+        "TZOFFSETFROM:+0100",
+        "TZOFFSETTO:+0000",
+        "END:STANDARD",
+        "END:VTIMEZONE",
+    ]
+    start = dt(2024, 1, 1, 9)
+    for index in range(count):
+        shifts = ", ".join(rng.sample(SHIFTS, rng.randint(1, 2)))
+        summary = f"{rng.choice(SHOWS)} ({shifts})".replace(",", "\\,")
+        end = start + timedelta(hours=rng.randint(1, 3))
+        lines.extend([
+            "BEGIN:VEVENT",
+            f"UID:event-{index}@example.com",
+            f"DTSTAMP:{start:%Y%m%dT%H%M%S}Z",
+            f"DTSTART:{start:%Y%m%dT%H%M%S}Z",
+            f"DTEND:{end:%Y%m%dT%H%M%S}Z",
+            f"SUMMARY:{summary}",
+            "DESCRIPTION:Please arrive fifteen minutes before the start of your shift"
+            "\r\n  and sign in at stage door.",
+        ])
+        if index % 5 == 0:
+            lines.extend([
+                "BEGIN:VALARM",
+                "ACTION:EMAIL",
+                "TRIGGER:-PT1H",
+                "SUMMARY:Reminder email",
+                "DESCRIPTION:Your shift starts in an hour",
+                "ATTENDEE:mailto:crew@example.com",
+                "END:VALARM",
+                "BEGIN:VALARM",
+                "ACTION:DISPLAY",
+                "TRIGGER:-PT15M",
+                "DURATION:PT5M",
+                "REPEAT:2",
+                "DESCRIPTION:Shift starting soon",
+                "END:VALARM",
+            ])
+        lines.append("END:VEVENT")
+        start = end if rng.random() < 0.5 else end + timedelta(hours=1)
+    lines.append("END:VCALENDAR")
+    return "\r\n".join(lines) + "\r\n"
+
+
+def legacy(feed: str, filters: list[str]) -> str:
+    calendar = ics.Calendar(feed)
+    new_calendar = ics.Calendar()
+    for event in calendar.events:
+        add = True
+        for f in filters:
+            if f.casefold() in event.name.casefold():
+                add = False
+                break
+        if not add:
+            continue
+        new_calendar.events.add(event)
+    return new_calendar.serialize()
+
+
+def raw(feed: str, filters: list[str]) -> str:
+    calendar = ics_filter.RawCalendar.parse(feed)
+    return ics_filter.filter_calendar_sync(calendar, filters, False)
+
+
+def bench(name: str, func, *args) -> str:
+    start = time.perf_counter()
+    output = func(*args)
+    print(f"{name:<24} {time.perf_counter() - start:8.3f}s")
+    return output
+
+
+def main() -> None:
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 5_000
+    feed = make_feed(count)
+    print(f"{count} events, {len(feed) / 1024:.0f} KiB")
+
+    old = bench("ics parse + filter", legacy, feed, FILTERS)
+    new = bench("raw filter", raw, feed, FILTERS)
+    combined = bench("raw filter + combine", ics_filter.filter_calendar_sync, ics_filter.RawCalendar.parse(feed), FILTERS, True)
+    parsed = bench("ics combine", lambda: ics_filter._combine_similar(ics.Calendar(new)).serialize())
+
+    # Both paths should keep the same events
+    old_uids = {e.uid for e in ics.Calendar(old).events}
+    new_uids = {e.uid for e in ics.Calendar(new).events}
+    assert old_uids == new_uids, (len(old_uids), len(new_uids))
+    print(f"{len(new_uids)} events kept")
+
+    # Combining on the raw lines should give the same events as ics does
+    def summarise(output: str) -> set[tuple]:
+        return {
+            (e.uid, e.name, e.begin, e.end, e.description, len(e.alarms))
+            for e in ics.Calendar(output).events
+        }
+    assert summarise(combined) == summarise(parsed)
+    print(f"{len(summarise(combined))} events after combining")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""
+Benchmark the chatlog text filters over a synthetic 10k message log,
+comparing the old per-filter chain against the combined
+``render_message`` filter.
+
+    python benchmarks/text_rendering.py [message_count]
+"""
+
+import html
+import importlib.util
+import os
+import random
+import re
+import sys
+import time
+
+import markdown
+
+
+# Load the module directly so that the rest of the website's dependencies
+# aren't needed
+spec = importlib.util.spec_from_file_location(
+    "text_rendering",
+    os.path.join(os.path.dirname(__file__), "..", "website", "utils", "text_rendering.py"),
+)
+assert spec and spec.loader
+text_rendering = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(text_rendering)
+
+
+def legacy_render(string, users):
+    """
+    The filter chain as it was before precompiling and combining.
+    """
+
+    def get_display_name(group):
+        user = users.get(group.group("userid"))
+        if not user:
+            return "unknown-user"
+        return user.get("display_name") or user.get("username")
+
+    def get_html(group):
+        return (
+            f'<img class="discord_emoji" src="https://cdn.discordapp.com/emojis/{group.group("id")}'
+            f'.{"gif" if group.group("animated") else "png"}" alt="Discord custom emoji: '
+            f'{group.group("name")}" style="height: 1em; width: auto;">'
+        )
+
+    string = html.escape(string)
+    string = markdown.markdown(string, extensions=["extra"])
+    string = re.sub(
+        "(?:<|(?:&lt;))@!?(?P<userid>\\d{16,23})(?:>|(?:&gt;))",
+        lambda g: f'<span class="chatlog__mention">@{get_display_name(g)}</span>',
+        string,
+        flags=re.IGNORECASE | re.MULTILINE,
+    )
+    return re.sub(
+        r"(?P<emoji>(?:<|&lt;)(?P<animated>a)?:(?P<name>\w+):(?P<id>\d+)(?:>|&gt;))",
+        get_html,
+        string,
+        flags=re.IGNORECASE | re.MULTILINE,
+    )
+
+
+def make_log(count: int) -> tuple[list[str], dict[str, dict]]:
+    random.seed(0)
+    users = {
+        str(random.randint(10 ** 17, 10 ** 18)): {"display_name": f"User {i}", "username": f"user{i}"}
+        for i in range(50)
+    }
+    user_ids = list(users)
+    words = "the quick **brown** fox _jumps_ over `lazy` dogs and some more words".split()
+    messages = []
+    for _ in range(count):
+        parts = random.choices(words, k=random.randint(3, 30))
+        if random.random() < 0.3:
+            parts.append(f"<@{random.choice(user_ids)}>")
+        if random.random() < 0.2:
+            parts.append(f"<:blob:{random.randint(10 ** 17, 10 ** 18)}>")
+        if random.random() < 0.05:
+            parts.append("\n```py\nprint('hello')\n```\n")
+        messages.append(" ".join(parts))
+    return messages, users
+
+
+def bench(name: str, func, messages, users) -> list[str]:
+    start = time.perf_counter()
+    output = [func(m, users) for m in messages]
+    elapsed = time.perf_counter() - start
+    print(f"{name:>16}: {elapsed:.3f}s ({elapsed / len(messages) * 1e6:.1f}us/message)")
+    return output
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10_000
+    messages, users = make_log(count)
+    print(f"Rendering {count} messages")
+    legacy = bench("legacy", legacy_render, messages, users)
+    combined = bench("render_message", text_rendering.render_message, messages, users)
+    assert legacy == combined, "Outputs differ"
@@ -1,18 +1,26 @@
+import asyncio
 import functools
 import io
-from typing import Literal, Tuple
-import asyncio
+from typing import Tuple
 import aiohttp
-import re
 from datetime import datetime
 
-from aiohttp.web import Request, RouteTableDef, Response, WebSocketResponse, HTTPBadRequest
-from aiohttp_jinja2 import render_string
-import htmlmin
+from aiohttp.web import Request, RouteTableDef, Response, WebSocketResponse, HTTPBadRequest, json_response
 from PIL import Image
-from bs4 import BeautifulSoup, Tag
-import imgkit
-import ics
+
+from .utils.calendars import filter_calendar
+from .utils.chatlog import (
+    ChatlogRendererBusy,
+    cache_chatlog,
+    chatlog_cache_key,
+    get_cached_chatlog,
+    get_chatlog_metrics,
+    render_chatlog,
+    stream_chatlog,
+)
+from .utils.http_sessions import get_session
+from .utils.login import requires_manager_login
+from .utils.tts_relay import get_tts_relay_broker
 
 
 routes = RouteTableDef()
@@ -73,51 +81,71 @@ async def discord_handler(request: Request):
     }
     """
 
-    with open("website/static/css/discord/core.min.css") as a:
-        core_css = a.read()
-    with open("website/static/css/discord/dark.min.css") as a:
-        dark_css = a.read()
-    rendered_template: str = render_string(
-        "project-pages/discord_page.html.j2",
-        request,
-        {
-            "data": (await request.json()),
-            "core_css": core_css,
-            "dark_css": dark_css,
-        },
-    )
-    response_data = htmlmin.minify(
-        rendered_template,
-        remove_comments=True,
-        remove_empty_space=True,
-        reduce_boolean_attributes=True
-    )
-    headers = {"Content-Type": "text/html"}
-    if "image" in request.query:
-        soup = BeautifulSoup(response_data, "html.parser")
-        pre = soup.find(class_="preamble")
-        assert isinstance(pre, Tag)
-        try:
-            pre.decompose()  # Remove from the containing page
-        except Exception:
-            pass
-        subset = str(soup)
-
-        loop = asyncio.get_running_loop()
-        partial = functools.partial(
-            imgkit.from_string,
-            subset,
-            None,
-            options={"format": "png"},
+    image = "image" in request.query
+    data = await request.json()
+    content_type = "image/png" if image else "text/html"
+
+    # See if we've rendered this before
+    key = chatlog_cache_key(data, image=image)
+    etag = f'"{key}"'
+    if etag in request.headers.get("If-None-Match", ""):
+        return Response(status=304, headers={"ETag": etag})
+    cached = await get_cached_chatlog(key)
+    if cached is not None:
+        return Response(
+            body=cached,
+            headers={"Content-Type": content_type, "ETag": etag},
+        )
+
+    # Render the chatlog
+    try:
+        if "stream" in request.query and not image:
+            return await stream_chatlog(request, data)
+        response_data = await render_chatlog(data, image=image)
+    except ChatlogRendererBusy:
+        return Response(
+            text="Too many chatlogs are being rendered - try again later.",
+            status=429,
+            headers={"Retry-After": "5"},
+        )
+    except asyncio.TimeoutError:
+        return Response(
+            text="The chatlog took too long to render.",
+            status=504,
         )
-        response_data = await loop.run_in_executor(None, partial)
-        headers = {"Content-Type": "image/png"}
+    if isinstance(response_data, str):
+        response_data = response_data.encode()
+    await cache_chatlog(key, response_data)
     return Response(
         body=response_data,
-        headers=headers,
+        headers={"Content-Type": content_type, "ETag": etag},
     )
 
 
+@routes.get("/discord/chatlog/metrics")
+@requires_manager_login()
+async def discord_chatlog_metrics(request: Request):
+    """
+    Get the queue sizes and counters for the chatlog renderers.
+    """
+
+    return json_response(get_chatlog_metrics())
+
+
+@functools.lru_cache(maxsize=1024)
+def colour_png(colour: Tuple[int, int, int], size: Tuple[int, int]) -> bytes:
+    """
+    Encode a PNG of a single colour. This uses a one colour palette rather
+    than RGB, which is much faster to compress and much smaller.
+    """
+
+    img = Image.new("P", size, color=0)
+    img.putpalette(colour)
+    file = io.BytesIO()
+    img.save(file, format="PNG", optimize=True)
+    return file.getvalue()
+
+
 @routes.get("/colour")
 async def colour(request: Request):
     """
@@ -180,61 +208,23 @@ async def colour(request: Request):
         clamp(int(height_req), 1, size_limit[1]),
     )
 
-    # Image processing  m a g i c
-    img = Image.new("RGB", image_size, color=image_colour)
-    file = io.BytesIO()
-    img.save(file, format="PNG")
-    file.seek(0)
+    image_colour = (
+        clamp(image_colour[0], 0, 255),
+        clamp(image_colour[1], 0, 255),
+        clamp(image_colour[2], 0, 255),
+    )
 
-    # And respond
+    # See if they have it already
     headers = {
         "Content-Type": "image/png",
         "Cache-Control": "public, max-age=604800, immutable",
+        "ETag": '"{0:02x}{1:02x}{2:02x}-{3}x{4}"'.format(*image_colour, *image_size),
     }
-    return Response(body=file.read(), headers=headers)
-
-
-def calendar_names_are_similar(name1: str, name2: str) -> Literal[False] | str:
-    """
-    Return whether or not two calendar event names are "similar" (mostly according to Dylan's
-    Rotacloud rules)
-    """
-
-    if name1 == name2:
-        return name1
-
-    regex = r"(.+) \((.+)\)"
-    match1 = re.search(regex, name1)
-    if match1 is None:
-        return False
-    match2 = re.search(regex, name2)
-    if match2 is None:
-        return False
-    if match1.group(1) != match2.group(1):
-        return False
-
-    # everything from now will have the same group 1
-
-    universal_shifts = set(["Meeting", "Auditorium Turnaround", "Training"])
-    tech_shifts = set(["Tech", "Tech projection", "Tech Usher", "Followspot", "Outside Steward"])
-    dm_shifts = set(["Duty Manager"])
-    shift1 = set([i.strip() for i in match1.group(2).split(",")])
-    shift2 = set([i.strip() for i in match2.group(2).split(",")])
-
-    joined_shift = [i.strip() for i in match1.group(2).split(",")]
-    for i in [i.strip() for i in match2.group(2).split(",")]:
-        if i not in joined_shift:
-            joined_shift.append(i)
-    joined_name = f"{match1.group(1)} ({', '.join(joined_shift)})"
+    if headers["ETag"] in request.headers.get("If-None-Match", ""):
+        return Response(status=304, headers=headers)
 
-    if tech_shifts.union(universal_shifts).intersection(shift1) and tech_shifts.union(universal_shifts).intersection(shift2):
-        return joined_name
-    if dm_shifts.union(universal_shifts).intersection(shift1) and dm_shifts.union(universal_shifts).intersection(shift2):
-        return joined_name
-    if universal_shifts.intersection(shift1) and tech_shifts.union(dm_shifts).intersection(shift2):
-        return joined_name
-
-    return False
+    # Image processing  m a g i c
+    return Response(body=colour_png(image_colour, image_size), headers=headers)
 
 
 @routes.get("/calendar_filter")
@@ -251,51 +241,13 @@ async def calendar_filter(request: Request):
             headers={"Access-Control-Allow-Origin": "*"},
         )
 
-    async with aiohttp.ClientSession() as session:
-        headers = {"User-Agent": "Voxel Fox calendar filter kae@voxelfox.co.uk"}
-        site = await session.get(url, headers=headers)
-        calendar_raw = await site.text()
-    calendar = ics.Calendar(calendar_raw)
-
-    filters = request.query.getall("filter")
-    if filters:
-        new_calendar = ics.Calendar()
-        for event in calendar.events:
-            add = True
-            for f in filters:
-                if f.casefold() in event.name.casefold():
-                    add = False
-                    break
-            if not add:
-                continue
-            new_calendar.events.add(event)
-        calendar = new_calendar
-
-    combine_similar = request.query.get("combine_similar") is not None
-    if combine_similar:
-        new_calendar = ics.Calendar()
-        previous: ics.Event | None = None
-        for event in sorted(calendar.events, key=lambda e: e.begin):
-            if previous is None:
-                previous = event
-                continue
-            assert previous is not None
-            new_name = calendar_names_are_similar(previous.name, event.name)
-            if new_name is not False and previous.end == event.begin:
-                if not isinstance(previous.description, str):
-                    previous.description = ""
-                previous.name = new_name
-                previous.description += "\n----------\n" + (event.description or "")
-                previous.end = event.end
-            else:
-                new_calendar.events.add(previous)
-                previous = event
-        if previous is not None:
-            new_calendar.events.add(previous)
-        calendar = new_calendar
-
+    calendar = await filter_calendar(
+        url,
+        request.query.getall("filter", []),
+        request.query.get("combine_similar") is not None,
+    )
     return Response(
-        body=calendar.serialize(),
+        body=calendar,
         headers={
             "Content-Type": "text/calendar",
             "Access-Control-Allow-Origin": "*",
@@ -303,13 +255,22 @@ async def calendar_filter(request: Request):
     )
 
 
-tts_streamdeck_clients: dict[str, dict[str, set[WebSocketResponse]]] = {}
+@routes.get("/tts-streamdeck/metrics")
+@requires_manager_login()
+async def tts_streamdeck_metrics(request: Request):
+    """
+    Get the send queue depths and counters for the TTS Streamdeck clients
+    connected to this worker.
+    """
+
+    return json_response(get_tts_relay_broker().get_metrics())
 
 
 @routes.get("/tts-streamdeck")
 async def tts_streamdeck(request: Request):
     """
-    TTS Streamdeck websocket handler.
+    TTS Streamdeck websocket handler. Messages from a TTS client are sent to
+    the Streamdecks with the same username, and the other way around.
     """
 
     username = request.query.get("username")
@@ -320,58 +281,23 @@ async def tts_streamdeck(request: Request):
     role = request.query.get("role")
     if role not in ("tts", "streamdeck"):
         raise HTTPBadRequest(text="Invalid role.")
+    peer_role = "streamdeck" if role == "tts" else "tts"
 
     ws = WebSocketResponse(heartbeat=30)
     await ws.prepare(request)
 
-    tts_streamdeck_clients.setdefault(username, {"tts": set(), "streamdeck": set()})
-    tts_streamdeck_clients[username][role].add(ws)
-
+    broker = get_tts_relay_broker()
     try:
-        if role == "tts":
-            await handle_tts_streamdeck_tts(ws, username)
-        else:
-            await handle_tts_streamdeck_streamdeck(ws, username)
+        await broker.join(username, role, ws)
+        async for msg in ws:
+            if msg.type == aiohttp.WSMsgType.TEXT:
+                await broker.publish(username, peer_role, msg.data)
+            elif msg.type in (aiohttp.WSMsgType.CLOSED, aiohttp.WSMsgType.ERROR):
+                break
     finally:
         # Cleanup even if handler errors
-        tts_streamdeck_clients.get(username, {}).get(role, set()).discard(ws)
-        if username in tts_streamdeck_clients:
-            if not tts_streamdeck_clients[username]["tts"] and not tts_streamdeck_clients[username]["streamdeck"]:
-                del tts_streamdeck_clients[username]
-
+        await broker.leave(username, role, ws)
         if not ws.closed:
             await ws.close()
 
     return ws
-
-
-async def _safe_broadcast(peers: set[WebSocketResponse], text: str):
-    dead: list[WebSocketResponse] = []
-    for peer in list(peers):
-        if peer.closed:
-            dead.append(peer)
-            continue
-        try:
-            await peer.send_str(text)
-        except Exception:
-            dead.append(peer)
-    for peer in dead:
-        peers.discard(peer)
-
-
-async def handle_tts_streamdeck_tts(ws: WebSocketResponse, username: str) -> None:
-    async for msg in ws:
-        if msg.type == aiohttp.WSMsgType.TEXT:
-            peers = tts_streamdeck_clients.get(username, {}).get("streamdeck", set())
-            await _safe_broadcast(peers, msg.data)
-        elif msg.type in (aiohttp.WSMsgType.CLOSED, aiohttp.WSMsgType.ERROR):
-            break
-
-
-async def handle_tts_streamdeck_streamdeck(ws: WebSocketResponse, username: str) -> None:
-    async for msg in ws:
-        if msg.type == aiohttp.WSMsgType.TEXT:
-            peers = tts_streamdeck_clients.get(username, {}).get("tts", set())
-            await _safe_broadcast(peers, msg.data)
-        elif msg.type in (aiohttp.WSMsgType.CLOSED, aiohttp.WSMsgType.ERROR):
-            break
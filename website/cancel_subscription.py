@@ -1,8 +1,9 @@
 import aiohttp
 from aiohttp.web import Request, RouteTableDef, json_response
-from discord.ext import vbu
 
+from .utils.authorization import product_authorization_is_valid
 from .utils.get_paypal_access_token import get_paypal_basicauth
+from .utils.http_sessions import get_session
 
 
 routes = RouteTableDef()
@@ -30,20 +31,7 @@ async def cancel_subscription(request: Request):
 
     # Make sure the authorization header is correct for the associated product
     # name
-    async with vbu.Database() as db:
-        item_rows = await db.call(
-            """
-            SELECT
-                1
-            FROM
-                checkout_items
-            WHERE
-                product_name = $1
-                AND transaction_webhook_authorization = $2
-            """,
-            product_name, auth_header,
-        )
-    if not item_rows:
+    if not await product_authorization_is_valid(product_name, auth_header):
         return json_response(
             {"error": "Invalid auth header."},
             status=401,
@@ -53,13 +41,15 @@ async def cancel_subscription(request: Request):
     if "paypal.com" in cancel_url:
         auth = await get_paypal_basicauth()
         method = "POST"
+        provider = "paypal"
     elif "stripe.com" in cancel_url:
         auth = aiohttp.BasicAuth(request.app['config']['stripe_api_key'])
         method = "DELETE"
+        provider = "stripe"
     else:
         raise Exception()
 
     # Make the request
-    async with aiohttp.ClientSession() as session:
-        r = await session.request(method, cancel_url, auth=auth)
-    return json_response({"error": "", "status": r.status})
+    async with get_session(provider).request(method, cancel_url, auth=auth) as r:
+        status = r.status
+    return json_response({"error": "", "status": status})
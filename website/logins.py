@@ -4,13 +4,15 @@ import logging
 from typing import Any
 import time
 
-import aiohttp
 from aiohttp.web import HTTPFound, Request, RouteTableDef, StreamResponse
 import aiohttp_session
 from aiohttp_jinja2 import template
 from discord.ext import vbu
 import asyncpg
 
+from .utils.cache import identity_tags, invalidate_cache_tags_on_commit
+from .utils.http_sessions import get_session
+
 
 routes = RouteTableDef()
 log = logging.getLogger("vbu.voxelfox.login")
@@ -70,15 +72,33 @@ async def store_information(
                 SET
                     {0}_user_id = $2,
                     {0}_refresh_token = $3
+                FROM
+                    (
+                        SELECT
+                            id,
+                            {0}_user_id
+                        FROM
+                            users
+                        WHERE
+                            id = $1
+                        FOR UPDATE
+                    ) previous
                 WHERE
-                    id = $1
+                    users.id = previous.id
                 RETURNING
-                    *
+                    users.*,
+                    previous.{0}_user_id AS previous_user_id
                 """.format(identity),
                 current_id,
                 user_id,
                 refresh_token,
             )
+            if user_rows:
+                await invalidate_cache_tags_on_commit(db, *identity_tags([
+                    ("vfl", user_rows[0]['id']),
+                    (identity, user_id),
+                    (identity, user_rows[0]['previous_user_id']),
+                ]))
 
         # That identity exists for another user - try and merge
         except asyncpg.UniqueViolationError:
@@ -90,6 +110,10 @@ async def store_information(
                 """.format(identity),
                 user_id,
             )
+            await invalidate_cache_tags_on_commit(db, *identity_tags([
+                ("vfl", conflict_row[0]['id']),
+                *((oid, conflict_row[0][f"{oid}_user_id"]) for oid in oauth_identities),
+            ]))
 
             # Update
             check_user_ids = set()
@@ -205,29 +229,29 @@ async def discord(request: Request):
     }
 
     # Perform our web requests
-    async with aiohttp.ClientSession() as s:
+    s = get_session("discord")
 
-        # Use code to get a token
-        url = "https://discord.com/api/v9/oauth2/token"
-        r = await s.post(url, data=data, headers=headers)
+    # Use code to get a token
+    url = "https://discord.com/api/v9/oauth2/token"
+    async with s.post(url, data=data, headers=headers) as r:
         token_json = await r.json()
-        if 'error' in token_json:
-            log.error(token_json)
-            return None
-        log.info("Got Discord token information %s" % dump(token_json))
-
-        # Use token to get user ID
-        url = "https://discord.com/api/v9/users/@me"
-        headers = {
-            "Authorization": f"Bearer {token_json['access_token']}",
-            "User-Agent": "VoxelFox.co.uk Login Processor (kae@voxelfox.co.uk)",
-        }
-        r = await s.get(url, headers=headers)
+    if 'error' in token_json:
+        log.error(token_json)
+        return None
+    log.info("Got Discord token information %s" % dump(token_json))
+
+    # Use token to get user ID
+    url = "https://discord.com/api/v9/users/@me"
+    headers = {
+        "Authorization": f"Bearer {token_json['access_token']}",
+        "User-Agent": "VoxelFox.co.uk Login Processor (kae@voxelfox.co.uk)",
+    }
+    async with s.get(url, headers=headers) as r:
         user_json = await r.json()
-        if 'error' in user_json:
-            log.error(user_json)
-            return None
-        log.info("Got Discord user information %s" % dump(user_json))
+    if 'error' in user_json:
+        log.error(user_json)
+        return None
+    log.info("Got Discord user information %s" % dump(user_json))
 
     # Store the data in database
     storage = await aiohttp_session.get_session(request)
@@ -277,29 +301,29 @@ async def google(request: Request):
     }
 
     # Perform our web requests
-    async with aiohttp.ClientSession() as s:
+    s = get_session("google")
 
-        # Use code to get a token
-        url = "https://oauth2.googleapis.com/token"
-        r = await s.post(url, data=data, headers=headers)
+    # Use code to get a token
+    url = "https://oauth2.googleapis.com/token"
+    async with s.post(url, data=data, headers=headers) as r:
         token_json = await r.json()
-        if 'error' in token_json:
-            log.error(token_json)
-            return None
-        log.info("Got Google token information %s" % dump(token_json))
-
-        # Use token to get user ID
-        url = "https://www.googleapis.com/oauth2/v1/userinfo"
-        headers = {
-            "Authorization": f"Bearer {token_json['access_token']}",
-            "User-Agent": "VoxelFox.co.uk Login Processor (kae@voxelfox.co.uk)",
-        }
-        r = await s.get(url, headers=headers)
+    if 'error' in token_json:
+        log.error(token_json)
+        return None
+    log.info("Got Google token information %s" % dump(token_json))
+
+    # Use token to get user ID
+    url = "https://www.googleapis.com/oauth2/v1/userinfo"
+    headers = {
+        "Authorization": f"Bearer {token_json['access_token']}",
+        "User-Agent": "VoxelFox.co.uk Login Processor (kae@voxelfox.co.uk)",
+    }
+    async with s.get(url, headers=headers) as r:
         user_json = await r.json()
-        if 'error' in user_json:
-            log.error(user_json)
-            return None
-        log.info("Got Google user information %s" % dump(user_json))
+    if 'error' in user_json:
+        log.error(user_json)
+        return None
+    log.info("Got Google user information %s" % dump(user_json))
 
     # Store the data in database
     storage = await aiohttp_session.get_session(request)
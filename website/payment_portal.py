@@ -1,6 +1,5 @@
 import uuid
 from typing import Optional
-from datetime import datetime as dt
 
 from aiohttp.web import (
     HTTPFound,
@@ -36,60 +35,37 @@ async def index(request: Request):
     async with vbu.Database() as db:
 
         # Get the items from the database
-        item_rows = await db.call(
-            """
-            SELECT
-                *
-            FROM
-                checkout_items
-            WHERE
-                LOWER(product_group) = LOWER($1)
-            """,
+        available_items = await CheckoutItem.fetch_group(
+            db,
             request.match_info["group"],
         )
-        available_items = [
-            CheckoutItem.from_row(row)
-            for row in item_rows
-        ]
 
         # If there aren't any items then let's just redirect back to the index
         if not available_items:
             return HTTPFound("/")
 
-        for i in available_items:
-            await i.fetch_user(db)
-        item_ids = {i.id: i for i in available_items}
-
-        # Get the user's purchase history
+        # Get the user's active purchases of the items
         user_purchases: list[Purchase] | None = None  # Will be None for no login
         if "id" in session:
             user = await User.fetch(db, id=session["id"])
             assert user
             if user.blocked:
                 return Response(text="This account has been blocked from making purchases.")
-            item_ids = {i.id: i for i in available_items}
-            user_purchases = [
-                i for i in await Purchase.fetch_by_user(db, user)
-                if i.product_id in item_ids
-            ]
+            user_purchases = await Purchase.fetch_active_by_user(
+                db,
+                user,
+                available_items,
+            )
 
     # Get the prices for all available items
-    for i in available_items:
-        await i.fetch_price(request.app['config']['stripe_api_key'])
-
-    # Filter out stuff that's expired
-    if user_purchases:
-        user_purchases = [
-            i for i in user_purchases
-            if (
-                i.expiry_time is None  # no expiry
-                or i.expiry_time > dt.utcnow()  # expires in the future
-            )
-        ]
+    await CheckoutItem.fetch_prices(
+        available_items,
+        request.app['config']['stripe_api_key'],
+    )
 
-    # Add item objects to the purchases
+    # Remove items that can only be bought once
     for i in (user_purchases or []):
-        i._item = item_ids[i.product_id]
+        assert i._item
         if not i._item.multiple:
             try:
                 available_items.remove(i._item)
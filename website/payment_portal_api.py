@@ -1,111 +1,76 @@
-from typing import Awaitable, Callable, Optional, Any
-from typing_extensions import Self
+from typing import Optional, Any
+import asyncio
 from datetime import datetime as dt, timedelta
-from functools import wraps
 import time
+import uuid
 
 from aiohttp.web import (
     Request,
     Response,
-    StreamResponse,
     json_response,
     RouteTableDef,
+    WebSocketResponse,
 )
 import aiohttp_session
 from discord.ext import vbu
 import aiohttp
 
+from .utils.authorization import get_authorized_product_ids
+from .utils.cache import cache_by_query, entitlement_tags, get_cache_backend, identity_tags
 from .utils.json_utils import serialize
 from .utils.get_paypal_access_token import get_paypal_basicauth
+from .utils.http_sessions import get_session
 from .utils.login import requires_manager_login
+from .utils.purchase_events import (
+    fetch_purchase_events,
+    get_purchase_event_cursor,
+    next_purchase_event,
+)
 from .utils.db_models import Purchase
 
 
 routes = RouteTableDef()
 
 
-CR = Callable[
-    [Request],
-    Awaitable[
-        StreamResponse
-        | tuple[StreamResponse, bool]
-        | tuple[StreamResponse, timedelta]
-    ]
-]
-
-
-class CacheItem:
-
-    all_items: dict[str, Self] = dict()
-    max_lifetime = timedelta(minutes=1)
-
-    __slots__ = (
-        '_response',
-        'cached_at',
-        'lifetime',
-    )
-
-    def __init__(
-            self,
-            request: Request,
-            response: StreamResponse,
-            cached_at: Optional[dt] = None,
-            lifetime: Optional[timedelta] = None):
-        self._response = response
-        self.cached_at = cached_at or dt.utcnow()
-        self.lifetime = lifetime or self.max_lifetime
-        self.all_items[self.get_key(request)] = self
-
-    @property
-    def response(self):
-        return Response(
-            body=self._response._body,
-            status=self._response.status,
-            headers=self._response.headers,
-        )
-
-    @staticmethod
-    def get_key(request: Request) -> str:
-        keys = sorted(request.query.keys())
-        return (
-            request.url.path
-            + "&".join(f"{key}={request.query[key]}" for key in keys)
-        )
-
-    @classmethod
-    def get(cls, request: Request) -> Optional[Self]:
-        key = cls.get_key(request)
-        v = cls.all_items.get(key)
-        if v:
-            if v.cached_at + v.lifetime < dt.utcnow():
-                del cls.all_items[key]
-                return None
-            return v
-        return None
+# The column that each identity type is checked against
+IDENTITY_COLUMNS: dict[str, str] = {
+    "vfl": "users.id",
+    "discord": "users.discord_user_id",
+    "guild": "purchases.discord_guild_id",
+    "google": "users.google_user_id",
+    "facebook": "users.facebook_user_id",
+}
+CHECK_CACHE_LIFETIME = timedelta(hours=1)  # How long a portal check is cached for
+MAX_BULK_IDENTITIES = 1_000  # Max identities in one bulk check
+MAX_BULK_PRODUCTS = 50  # Max products in one bulk check
+EVENT_BATCH_SIZE = 100  # Max purchase events read at once
+EVENT_POLL_INTERVAL = 30  # Seconds between event checks if not notified
 
 
-def cache_by_query():
+def parse_identity(kind: str, value: Any) -> str | int:
     """
-    Cache a given request to a URL by its query string.
+    Convert a given identity into the type that's stored in its column.
+
+    Parameters
+    ----------
+    kind : str
+        The type of identity (eg ``"discord"``, ``"guild"``).
+    value : Any
+        The given ID.
+
+    Raises
+    ------
+    ValueError
+        If the identity type is unknown or the ID is invalid.
     """
 
-    def decorator(func: CR) -> Callable[[Request], Awaitable[StreamResponse]]:
-        @wraps(func)
-        async def wrapper(request: Request) -> StreamResponse:
-            cached = CacheItem.get(request)
-            if cached and request.headers.get("Cache-Control") != "no-cache":
-                return cached.response
-            response = await func(request)
-            keep = False
-            if isinstance(response, tuple):
-                response, keep = response
-            if keep is True:
-                CacheItem(request, response)
-            elif isinstance(keep, timedelta):
-                CacheItem(request, response, lifetime=keep)
-            return response
-        return wrapper
-    return decorator
+    if kind not in IDENTITY_COLUMNS:
+        raise ValueError("Unknown identity type %s" % kind)
+    if kind == "guild":
+        return int(value)
+    if kind == "vfl":
+        return str(uuid.UUID(str(value)))
+    return str(value)
 
 
 @routes.patch("/api/portal/update")
@@ -158,10 +123,12 @@ async def portal_update(request: Request):
 
 
 @routes.get("/api/portal/check")
-@cache_by_query()
+@cache_by_query(lifetime=CHECK_CACHE_LIFETIME)
 async def portal_check(request: Request):
     """
-    Check if a user has purchased a certain product.
+    Check if a user has purchased a certain product. Results are cached
+    until the user's purchases of the product (or their linked accounts)
+    change, or until the earliest of their purchases expires.
     """
 
     # Check the get params
@@ -204,21 +171,28 @@ async def portal_check(request: Request):
         ), True
 
     # Work out what identity to use
-    user_column: str  # The column that the user identifies with (X_user_id)
+    identity_kind: str  # The type of identity given (vfl, discord, etc)
     identity: str | int  # The given identity (X_user_id = Y)
     for k, i in any_id:
         if i:
+            identity_kind = k
             identity = i
-            if k == "guild":
-                user_column = "purchases.discord_guild_id"
-                identity = int(i)
-            elif k == "vfl":
-                user_column = "users.user_id"
-            else:
-                user_column = f"users.{k}_user_id"
             break
     else:
         raise ValueError("Could not find identity")
+    user_column = IDENTITY_COLUMNS[identity_kind]
+    try:
+        identity = parse_identity(identity_kind, identity)
+    except ValueError:
+        return json_response(
+            {
+                "error": "Invalid user or guild ID provided.",
+                "success": False,
+                "result": False,
+                "generated": dt.utcnow().isoformat(),
+            },
+            status=400,
+        ), True
 
     # It is time to open our database connection
     db = await vbu.Database.get_connection()
@@ -276,6 +250,13 @@ async def portal_check(request: Request):
             status=400,
         )
     recursive_base_product: dict[str, Any] = possible_base_product[0]
+    tags = [
+        *entitlement_tags(
+            [(identity_kind, identity)],
+            [recursive_base_product['id'], *(i['id'] for i in base_products)],
+        ),
+        *identity_tags([(identity_kind, identity)]),
+    ]
 
     # Try and get the user's purchases
     result: list[dict] | None = await db.call(
@@ -319,8 +300,12 @@ async def portal_check(request: Request):
     )
     await db.disconnect()
 
-    # Return the result
+    # Return the result, only caching it until the first purchase expires
     if result:
+        lifetime = CHECK_CACHE_LIFETIME
+        expiry_times = [i['expiry_time'] for i in result if i['expiry_time'] is not None]
+        if expiry_times:
+            lifetime = min(lifetime, min(expiry_times) - dt.utcnow())
         return json_response(
             {
                 "success": True,
@@ -333,14 +318,293 @@ async def portal_check(request: Request):
                 "purchases": [serialize(i) for i in result],
                 "generated": dt.utcnow().isoformat(),
             },
-        ), True
+        ), lifetime if lifetime > timedelta(0) else False, tags
     return json_response(
         {
             "success": True,
             "result": False,
             "generated": dt.utcnow().isoformat(),
         },
-    ), True
+    ), True, tags
+
+
+@routes.post("/api/portal/check_bulk")
+async def portal_check_bulk(request: Request):
+    """
+    Check if many users or guilds have purchased any of a set of products.
+
+    Takes a JSON body of ``{"identities": [[type, id], ...], "product_names":
+    [...], "product_ids": [...]}``, where ``type`` is any of the identity
+    types accepted by ``/api/portal/check``. Returns a map of ``"type:id"``
+    to a map of each requested product to whether or not that identity
+    owns it.
+    """
+
+    # Check the given data
+    try:
+        data = await request.json()
+        identities = [
+            (str(kind), str(i), parse_identity(kind, i),)
+            for kind, i in data.get("identities", [])
+        ]
+        product_names = [str(i) for i in data.get("product_names", [])]
+        product_ids = [str(uuid.UUID(str(i))) for i in data.get("product_ids", [])]
+    except Exception:
+        return json_response(
+            {
+                "error": "Invalid data.",
+                "success": False,
+                "generated": dt.utcnow().isoformat(),
+            },
+            status=400,
+        )
+    if not identities or not (product_names or product_ids):
+        return json_response(
+            {
+                "error": "No identities or products provided.",
+                "success": False,
+                "generated": dt.utcnow().isoformat(),
+            },
+            status=400,
+        )
+    if len(identities) > MAX_BULK_IDENTITIES or len(product_names) + len(product_ids) > MAX_BULK_PRODUCTS:
+        return json_response(
+            {
+                "error": "Too many identities or products provided.",
+                "success": False,
+                "generated": dt.utcnow().isoformat(),
+            },
+            status=400,
+        )
+
+    # Group the identities by the column they're checked against
+    identity_keys: dict[tuple[str, str | int], list[str]] = {}
+    identity_values: dict[str, set[str | int]] = {}
+    for kind, given, parsed in identities:
+        identity_keys.setdefault((kind, parsed,), []).append(f"{kind}:{given}")
+        identity_values.setdefault(kind, set()).add(parsed)
+    kinds = list(identity_values)
+
+    async with vbu.Database() as db:
+
+        # Get the products we want to check for
+        product_rows = await db.call(
+            """
+            SELECT
+                id,
+                product_name,
+                subscription,
+                description
+            FROM
+                checkout_items
+            WHERE
+                id = ANY($1::UUID[])
+            OR
+                product_name = ANY($2::CITEXT[])
+            """,
+            product_ids,
+            product_names,
+        )
+
+        # Product names are case insensitive, so map each row back to every
+        # name that was asked for
+        requested_names: dict[str, list[str]] = {}
+        for name in product_names:
+            requested_names.setdefault(name.casefold(), []).append(name)
+        base_products: dict[str, dict[str, Any]] = {}  # requested key: product
+        for row in product_rows:
+            if str(row['id']) in product_ids:
+                base_products[str(row['id'])] = row
+            for name in requested_names.get(row['product_name'].casefold(), ()):
+                base_products.setdefault(name, row)
+        base_ids = list({str(i['id']) for i in base_products.values()})
+
+        # Get every matching purchase
+        purchase_rows = await db.call(
+            """
+            SELECT
+                purchases.product_id,
+                checkout_items.base_product_id,
+                {0}
+            FROM
+                purchases
+            LEFT JOIN
+                checkout_items
+            ON
+                purchases.product_id = checkout_items.id
+            LEFT JOIN
+                users
+            ON
+                users.id = purchases.user_id
+            WHERE
+                ({1})
+            AND
+                (
+                        expiry_time IS NULL
+                    OR
+                        expiry_time > TIMEZONE('UTC', NOW())
+                )
+            AND
+                (
+                        purchases.product_id = ANY($1::UUID[])
+                    OR
+                        checkout_items.base_product_id = ANY($1::UUID[])
+                )
+            """.format(
+                ", ".join(
+                    f"{IDENTITY_COLUMNS[kind]} AS {kind}_identity"
+                    for kind in kinds
+                ),
+                " OR ".join(
+                    f"{IDENTITY_COLUMNS[kind]} = ANY(${i + 2})"
+                    for i, kind in enumerate(kinds)
+                ),
+            ),
+            base_ids,
+            *(list(identity_values[kind]) for kind in kinds),
+        ) if base_ids else []
+
+    # Work out which identities own which products
+    owned: set[tuple[str, str | int, str]] = set()
+    for row in purchase_rows:
+        for kind in kinds:
+            value = row[f"{kind}_identity"]
+            if value is None:
+                continue
+            if kind != "guild":
+                value = str(value)
+            owned.add((kind, value, str(row['product_id']),))
+            if row['base_product_id']:
+                owned.add((kind, value, str(row['base_product_id']),))
+
+    # Return the result
+    results: dict[str, dict[str, bool]] = {}
+    for (kind, parsed), keys in identity_keys.items():
+        result = {
+            key: (kind, parsed, str(product['id']),) in owned
+            for key, product in base_products.items()
+        }
+        for key in keys:
+            results[key] = result
+    return json_response(
+        {
+            "success": True,
+            "results": results,
+            "products": {
+                key: serialize(product)
+                for key, product in base_products.items()
+            },
+            "missing_products": [
+                i
+                for i in (*product_ids, *product_names)
+                if i not in base_products
+            ],
+            "generated": dt.utcnow().isoformat(),
+        },
+    )
+
+
+@routes.get("/api/portal/events")
+async def portal_events(request: Request):
+    """
+    A websocket feed of changes to purchases of the products that use the
+    given transaction webhook authorization.
+
+    Connect with an ``Authorization`` header of the products' transaction
+    webhook authorization, and optionally a ``product_name`` to limit the
+    feed to, and a ``cursor`` to replay events after. Each message is a
+    JSON object with a ``cursor`` that should be stored to resume from.
+    """
+
+    # Check the given data
+    auth_header = request.headers.get("Authorization", "")
+    product_name = request.query.get("product_name")
+    try:
+        cursor: int | None = (
+            int(request.query["cursor"])
+            if "cursor" in request.query
+            else None
+        )
+    except ValueError:
+        return json_response(
+            {"error": "Invalid cursor.", "success": False},
+            status=400,
+        )
+    if not auth_header:
+        return json_response(
+            {"error": "Missing auth header.", "success": False},
+            status=401,
+        )
+
+    # Get the products that the auth header is valid for
+    product_ids = await get_authorized_product_ids(auth_header, product_name)
+    if not product_ids:
+        return json_response(
+            {"error": "Invalid auth header.", "success": False},
+            status=401,
+        )
+    if cursor is None:
+        async with vbu.Database() as db:
+            cursor = await get_purchase_event_cursor(db)
+
+    # Open the websocket
+    ws = WebSocketResponse(heartbeat=30)
+    await ws.prepare(request)
+    reader = asyncio.create_task(_drain_websocket(ws))
+
+    # Send events as they come in
+    try:
+        while not ws.closed:
+            waiter = next_purchase_event()
+            async with vbu.Database() as db:
+                events = await fetch_purchase_events(
+                    db,
+                    product_ids,
+                    cursor,
+                    EVENT_BATCH_SIZE,
+                )
+            for event in events:
+                await ws.send_json(event)
+                cursor = event['cursor']
+            if len(events) >= EVENT_BATCH_SIZE:
+                continue
+            waiter_task = asyncio.create_task(waiter.wait())
+            await asyncio.wait(
+                {reader, waiter_task},
+                timeout=EVENT_POLL_INTERVAL,
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+            waiter_task.cancel()
+            if reader.done():
+                break
+    finally:
+        reader.cancel()
+        if not ws.closed:
+            await ws.close()
+    return ws
+
+
+async def _drain_websocket(ws: WebSocketResponse) -> None:
+    """
+    Read (and ignore) everything sent to a websocket until it closes.
+    """
+
+    async for _ in ws:
+        pass
+
+
+@routes.get("/api/portal/cache_stats")
+@requires_manager_login()
+async def portal_cache_stats(request: Request):
+    """
+    Get the hit, miss and eviction counters for the response cache.
+    """
+
+    backend = get_cache_backend()
+    return json_response({
+        "backend": backend.__class__.__name__,
+        **backend.stats,
+    })
 
 
 @routes.get("/api/portal/get_guilds")
@@ -359,12 +623,12 @@ async def portal_get_guilds(request: Request):
         return json_response([], headers={"X-Message": "Missing refresh token"})
 
     # Do some web requesting
-    async with aiohttp.ClientSession() as session:
+    session = get_session("discord")
 
-        # Get an access token
-        if access_token is None or int(access_token.split(":", 1)[0]) < time.time():
-            discord_config = request.app['config']['oauth']['discord']
-            resp = await session.post(
+    # Get an access token
+    if access_token is None or int(access_token.split(":", 1)[0]) < time.time():
+        discord_config = request.app['config']['oauth']['discord']
+        async with session.post(
                 "https://discord.com/api/v9/oauth2/token",
                 data={
                     "client_id": discord_config['client_id'],
@@ -374,30 +638,28 @@ async def portal_get_guilds(request: Request):
                 },
                 headers={
                     "Content-Type": "application/x-www-form-urlencoded"
-                }
-            )
+                }) as resp:
             token_json = await resp.json()
-            try:
-                access_token = token_json['access_token']
-                expires_at = token_json['expires_at']
-            except KeyError:
-                user_session.invalidate()  # type: ignore
-                return json_response([], headers={"X-Message": "Failed getting access token"})
-            user_session["discord"]["access_token"] = (
-                f"{expires_at + time.time() - 60}:"
-                f"{token_json['access_token']}"
-            )
-            user_session["discord"]["refresh_token"] = token_json['refresh_token']
-        else:
-            access_token = user_session['discord']['access_token'].split(":", 1)[-1]
+        try:
+            access_token = token_json['access_token']
+            expires_at = token_json['expires_at']
+        except KeyError:
+            user_session.invalidate()  # type: ignore
+            return json_response([], headers={"X-Message": "Failed getting access token"})
+        user_session["discord"]["access_token"] = (
+            f"{expires_at + time.time() - 60}:"
+            f"{token_json['access_token']}"
+        )
+        user_session["discord"]["refresh_token"] = token_json['refresh_token']
+    else:
+        access_token = user_session['discord']['access_token'].split(":", 1)[-1]
 
-        # Get the guilds
-        resp = await session.get(
+    # Get the guilds
+    async with session.get(
             "https://discord.com/api/users/@me/guilds",
             headers={
                 "Authorization": f"Bearer {access_token}",
-            },
-        )
+            }) as resp:
         if not resp.ok:
             user_session.invalidate()  # type: ignore
             return json_response([], headers={"X-Message": "Failed getting guilds"})
@@ -491,25 +753,24 @@ async def portal_unsubscribe(request: Request):
 
     # Make the request
     if method:
-        async with aiohttp.ClientSession() as session:
-            resp = await session.request(
+        provider = "paypal" if method == "POST" else "stripe"
+        async with get_session(provider).request(
                 method,
                 purchase.cancel_url,
-                auth=auth,
-            )
-        if resp.ok:
-            pass
-        elif resp.status == 404:
-            pass
-        else:
-            return json_response(
-                {
-                    "error": "Failed to cancel subscription.",
-                    "success": False,
-                    "data": (await resp.text()),
-                },
-                status=400,
-            )
+                auth=auth) as resp:
+            if resp.ok:
+                pass
+            elif resp.status == 404:
+                pass
+            else:
+                return json_response(
+                    {
+                        "error": "Failed to cancel subscription.",
+                        "success": False,
+                        "data": (await resp.text()),
+                    },
+                    status=400,
+                )
 
     # If it was a fake purchase, update the expiry time in the database.
     # If it WASNT a fake purchase, then we'll get a webhook about it later.
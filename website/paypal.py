@@ -4,19 +4,19 @@ from datetime import datetime as dt, timedelta
 from typing import Tuple, Generator
 import logging
 
-import aiohttp
 from aiohttp.web import Request, RouteTableDef, Response
 from discord.ext import vbu
 import pytz
 
 from .utils import (
-    send_webhook,
+    enqueue_delivery,
+    wake_delivery_workers,
     get_paypal_access_token,
     CheckoutItem,
     types,
     User,
     Purchase,
-    send_sql,
+    get_session,
 )
 
 
@@ -105,11 +105,10 @@ async def paypal_ipn_complete(request: Request):
 
     # Send the data back to PayPal to make sure it's valid
     data_send_back = "cmd=_notify-validate&" + paypal_data_string
-    async with aiohttp.ClientSession() as session:
-        resp = await session.post(paypal_url, data=data_send_back)
+    async with get_session("paypal").post(paypal_url, data=data_send_back) as resp:
         site_data = await resp.read()
-        if site_data.decode() != "VERIFIED":
-            return Response(status=200)  # Fake data, but PayPal expects a 200
+    if site_data.decode() != "VERIFIED":
+        return Response(status=200)  # Fake data, but PayPal expects a 200
 
     # Process the data
     event = paypal_data.get('txn_type')
@@ -193,8 +192,7 @@ async def get_subscription_by_subscription_id(
     headers = {
         "Authorization": f"Bearer {access_token}",
     }
-    async with aiohttp.ClientSession() as session:
-        resp = await session.get(url, headers=headers)
+    async with get_session("paypal").get(url, headers=headers) as resp:
         return await resp.json()
 
 
@@ -307,8 +305,8 @@ async def charge_captured(request: Request, data: types.IPNMessage):
                 "discord_user_id": user.discord_user_id,
                 "discord_guild_id": current.discord_guild_id,
             }
-            await send_webhook(i, json_data)
-            await send_sql(i, json_data)
+            await enqueue_delivery(db, i, json_data)
+    wake_delivery_workers()
 
 
 async def subscription_created(request: Request, data: types.IPNMessage):
@@ -383,8 +381,8 @@ async def subscription_created(request: Request, data: types.IPNMessage):
             "discord_user_id": user.discord_user_id,
             "discord_guild_id": current.discord_guild_id,
         }
-        await send_webhook(item, json_data)
-        await send_sql(item, json_data)
+        await enqueue_delivery(db, item, json_data)
+    wake_delivery_workers()
 
 
 async def subscription_deleted(request: Request, data: types.IPNMessage):
@@ -450,5 +448,5 @@ async def subscription_deleted(request: Request, data: types.IPNMessage):
             "discord_user_id": user.discord_user_id,
             "discord_guild_id": current[0].discord_guild_id,
         }
-        await send_webhook(item, json_data)
-        await send_sql(item, json_data)
+        await enqueue_delivery(db, item, json_data)
+    wake_delivery_workers()
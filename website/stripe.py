@@ -16,8 +16,10 @@ from .utils import (
     types,
     CheckoutItem,
     Purchase,
-    send_webhook,
-    send_sql,
+    enqueue_delivery,
+    wake_delivery_workers,
+    get_session,
+    invalidate_price,
 )
 
 
@@ -129,26 +131,24 @@ async def create_checkout_session(request: Request):
             },
         })
 
-    # Send some data to Stripe
-    async with aiohttp.ClientSession() as session:
-
-        # Ask Stripe for a session object
-        url = f"{STRIPE_BASE}/checkout/sessions"
-        form_data = form_encode(json_data)
-        headers = {
-            "Content-Type": "application/x-www-form-urlencoded",
-        }
-        if stripe_id:
-            headers["Stripe-Account"] = stripe_id
-        auth = aiohttp.BasicAuth(request.app['config']['stripe_api_key'])
-        resp = await session.post(url, data=form_data, headers=headers, auth=auth)
+    # Ask Stripe for a session object
+    url = f"{STRIPE_BASE}/checkout/sessions"
+    form_data = form_encode(json_data)
+    headers = {
+        "Content-Type": "application/x-www-form-urlencoded",
+    }
+    if stripe_id:
+        headers["Stripe-Account"] = stripe_id
+    auth = aiohttp.BasicAuth(request.app['config']['stripe_api_key'])
+    session = get_session("stripe")
+    async with session.post(url, data=form_data, headers=headers, auth=auth) as resp:
         response = await resp.json()
-        if not resp.ok:
-            return json_response(
-                response,
-                status=500,
-                headers={"Access-Control-Allow-Origin": "*"},
-            )
+    if not resp.ok:
+        return json_response(
+            response,
+            status=500,
+            headers={"Access-Control-Allow-Origin": "*"},
+        )
 
     # And while we're here, add a User ID to the customer's metadata
     if response["customer"]:
@@ -250,6 +250,8 @@ async def stripe_purchase_complete(request: Request):
             stripe_data.get("account"),
             event_type=event,  # pyright: ignore
         )
+    elif event in ["price.updated", "price.deleted"]:
+        await invalidate_price(data_object["id"])
     elif event == "customer.subscription.deleted":
         data_object = cast(types.Subscription, data_object)
         await subscription_deleted(
@@ -264,6 +266,65 @@ async def stripe_purchase_complete(request: Request):
     return Response(status=200)
 
 
+async def get_line_items(
+        data: types.Charge | types.CheckoutSession,
+        auth: aiohttp.BasicAuth,
+        headers: dict[str, str]) -> tuple[types.DataList[Any], str] | None:
+    """
+    Ask Stripe for the items that the user checked out with.
+
+    Returns
+    -------
+    tuple[types.DataList, str] | None
+        The line items object and the ID of the associated invoice, or
+        ``None`` if the line items couldn't be found.
+    """
+
+    # Get line items from an invoice
+    if data["invoice"]:
+        log.info(f"Getting items from an invoice {data['invoice']}")
+        url = f"{STRIPE_BASE}/invoices/{data['invoice']}"
+        async with get_session("stripe").get(url, auth=auth, headers=headers) as resp:
+            invoice_object = await resp.json()
+        invoice_object = cast(types.Invoice, invoice_object)
+        log.info(f"Invoice object: {json.dumps(invoice_object)}")
+        return invoice_object["lines"], invoice_object["id"]
+
+    # Get line items from a checkout session
+    elif data["object"] == "checkout.session":
+        data = cast(types.CheckoutSession, data)
+        log.info(f"Getting items from an checkout session {data['id']}")
+        url = f"{STRIPE_BASE}/checkout/sessions/{data['id']}/line_items"
+        async with get_session("stripe").get(url, auth=auth, headers=headers) as resp:
+            session_object = await resp.json()
+        session_object = cast(types.DataList[types.CheckoutSessionLineItem], session_object)
+        log.info(f"Session object: {json.dumps(session_object)}")
+        return session_object, data["invoice"]
+
+    # Get line items from a charge
+    elif data["object"] == "charge":
+        data = cast(types.Charge, data)
+        log.info(f"Getting items from a charge {data['id']} via payment intent {data['payment_intent']}")
+        url = (
+            f"{STRIPE_BASE}/payment_intents/{data['payment_intent']}?"
+            "expand[]=invoice"
+        )
+        async with get_session("stripe").get(url, auth=auth, headers=headers) as resp:
+            payment_intent = await resp.json()
+        payment_intent = cast(types.PaymentIntent, payment_intent)
+        log.info(f"Payment intent object: {json.dumps(payment_intent)}")
+        try:
+            invoice: types.Invoice = payment_intent["invoice"]  # pyright: ignore
+            return invoice["lines"], invoice["id"]
+        except TypeError:
+            log.info(f"Missing invoice from payment intent object {payment_intent['id']}")
+            return None
+
+    # Whoops we don't have anything available to get the lines from
+    log.critical(f"Failed to get line items for purchase ({data['object']}).")
+    return None
+
+
 async def checkout_processor(
         request: Request,
         data: types.Charge | types.CheckoutSession,
@@ -295,93 +356,42 @@ async def checkout_processor(
                 stripe_account_id,
             )
 
-    # Ask Stripe for the items that the user checked out with
+    # Ask Stripe for the items that the user checked out with and the
+    # customer data (so that we have a full set of metadata) at the same time
     auth = aiohttp.BasicAuth(request.app['config']['stripe_api_key'])
     headers = {}
     if stripe_account_id:
         headers["Stripe-Account"] = stripe_account_id
-    invoice_id: str
-
-    # Get line items from an invoice
-    if data["invoice"]:
-        log.info(f"Getting items from an invoice {data['invoice']}")
-        async with aiohttp.ClientSession() as session:
-            url = f"{STRIPE_BASE}/invoices/{data['invoice']}"
-            resp = await session.get(url, auth=auth, headers=headers)
-            invoice_object = await resp.json()
-        invoice_object = cast(types.Invoice, invoice_object)
-        log.info(f"Invoice object: {json.dumps(invoice_object)}")
-        line_items_object = invoice_object["lines"]
-        invoice_id = invoice_object["id"]
-
-    # Get line items from a checkout session
-    elif data["object"] == "checkout.session":
-        data = cast(types.CheckoutSession, data)
-        log.info(f"Getting items from an checkout session {data['id']}")
-        async with aiohttp.ClientSession() as session:
-            url = f"{STRIPE_BASE}/checkout/sessions/{data['id']}/line_items"
-            resp = await session.get(url, auth=auth, headers=headers)
-            session_object = await resp.json()
-        session_object = cast(types.DataList[types.CheckoutSessionLineItem], session_object)
-        log.info(f"Session object: {json.dumps(session_object)}")
-        line_items_object = session_object
-        invoice_id = data["invoice"]
-
-    # Get line items from a charge
-    elif data["object"] == "charge":
-        data = cast(types.Charge, data)
-        log.info(f"Getting items from a charge {data['id']} via payment intent {data['payment_intent']}")
-        async with aiohttp.ClientSession() as session:
-            url = (
-                f"{STRIPE_BASE}/payment_intents/{data['payment_intent']}?"
-                "expand[]=invoice"
-            )
-            resp = await session.get(url, auth=auth, headers=headers)
-            payment_intent = await resp.json()
-        payment_intent = cast(types.PaymentIntent, payment_intent)
-        log.info(f"Payment intent object: {json.dumps(payment_intent)}")
-        try:
-            invoice: types.Invoice = payment_intent["invoice"]  # pyright: ignore
-            line_items_object = invoice["lines"]
-        except TypeError:
-            log.info(f"Missing invoice from payment intent object {payment_intent['id']}")
-            return
-        invoice_id = invoice["id"]
-
-    # Whoops we don't have anything available to get the lines from
-    else:
-        log.critical(f"Failed to get line items for purchase ({data['object']}).")
+    line_items_result, customer_data = await asyncio.gather(
+        get_line_items(data, auth, headers),
+        get_customer_by_id(
+            request,
+            data["customer"],
+            stripe_account_id,
+        ),
+    )
+    if line_items_result is None:
         return
+    line_items_object, invoice_id = line_items_result
+    all_metadata = {
+        **customer_data["metadata"],
+        **data["metadata"],
+    }
 
     # Cast our data as necessary
     line_items: list[types.InvoiceLineItem] | list[types.CheckoutSessionLineItem]
     line_items = line_items_object["data"]
 
-    # Grab the item from the database
+    # Grab the items from the database
     line_item_products: list[str] = [
         i["price"]["product"]
         for i in line_items
     ]
     async with vbu.Database() as db:
-        items = [
-            await CheckoutItem.fetch_by_stripe_product_id(db, p)
-            for p in line_item_products
-        ]
+        items = await CheckoutItem.fetch_by_stripe_product_ids(db, line_item_products)
     if not items:
         log.info(f"Missing items {line_item_products} from database")
         return
-    items = [i for i in items if i is not None]  # remove None
-
-    # Get the customer data so that we have a full set of metadata
-    customer_data = await get_customer_by_id(
-        request,
-        data["customer"],
-        stripe_account_id,
-    )
-    all_metadata = {
-        **customer_data["metadata"],
-        **data["metadata"],
-    }
 
     # Update our item as necessary based on the Stripe data
     for purchased in items:
@@ -405,17 +415,22 @@ async def checkout_processor(
                 subscription_id = i["subscription"]
                 break
 
-    # Update our storage
-    async with vbu.Database() as db:
+    # Update our storage - all of the purchases for the event (and their
+    # deliveries) are written in one transaction
+    async with vbu.Database() as db, db.transaction():
+
+        # Get the user who made the purchase
+        user: User | None = None
+        if event_type != "charge.refunded":
+            try:
+                user_id: str = all_metadata["user_id"]
+            except KeyError:
+                return  # No user ID in charge
+            user = await User.fetch(db, id=user_id)
+            assert user
+
         for i in items:
-            if event_type != "charge.refunded":
-                try:
-                    user_id: str = all_metadata["user_id"]
-                except KeyError:
-                    continue  # No user ID in charge
-                user = await User.fetch(db, id=user_id)
-                assert user
-                current = None
+            if user is not None:
                 current = await Purchase.fetch_by_identifier(db, subscription_id or invoice_id)
                 if current:
                     log.info("Ignoring purchase that is already stored.")
@@ -433,6 +448,7 @@ async def checkout_processor(
                     identifier=subscription_id or invoice_id,
                     quantity=i.purchased_quantity,
                 )
+                purchase_user = user
             else:
                 data = cast(types.Charge, data)
                 current = await Purchase.fetch_by_identifier(
@@ -443,7 +459,7 @@ async def checkout_processor(
                     log.info("Cannot delete item that is not currently stored.")
                     continue
                 await current.delete(db)
-                user = await current.fetch_user(db)
+                purchase_user = await current.fetch_user(db)
 
             json_data = {
                 "product_name": i.name,
@@ -454,7 +470,7 @@ async def checkout_processor(
                 "subscription_expiry_time": None,
                 "source": "Stripe",
                 "subscription_delete_url": None,
-                "discord_user_id": user.discord_user_id,
+                "discord_user_id": purchase_user.discord_user_id,
                 "discord_guild_id": current.discord_guild_id,
             }
             if data.get("subscription"):
@@ -462,8 +478,10 @@ async def checkout_processor(
                 json_data["subscription_delete_url"] = (
                     f"{STRIPE_BASE}/subscriptions/{data['subscription']}"
                 )
-            asyncio.create_task(send_webhook(i, json_data))
-            asyncio.create_task(send_sql(i, json_data))
+            await enqueue_delivery(db, i, json_data)
+
+    # Only tell the item owners once everything has been stored
+    wake_delivery_workers()
 
 
 async def set_customer_metadata(
@@ -481,8 +499,7 @@ async def set_customer_metadata(
     headers = {}
     if stripe_account_id:
         headers["Stripe-Account"] = stripe_account_id
-    async with aiohttp.ClientSession() as session:
-        resp = await session.post(url, data=data, auth=auth, headers=headers)
+    async with get_session("stripe").post(url, data=data, auth=auth, headers=headers) as resp:
         response_json = await resp.json()
     return response_json
 
@@ -500,8 +517,7 @@ async def get_customer_by_id(
     headers = {}
     if stripe_account_id:
         headers["Stripe-Account"] = stripe_account_id
-    async with aiohttp.ClientSession() as session:
-        resp = await session.get(url, auth=auth, headers=headers)
+    async with get_session("stripe").get(url, auth=auth, headers=headers) as resp:
         response_json = await resp.json()
     return response_json
 
@@ -571,5 +587,5 @@ async def subscription_deleted(
             "discord_user_id": user.discord_user_id,
             "discord_guild_id": current[0].discord_guild_id,
         }
-        asyncio.create_task(send_webhook(item, json_data))
-        asyncio.create_task(send_sql(item, json_data))
+        await enqueue_delivery(db, item, json_data)
+    wake_delivery_workers()
@@ -1,12 +1,58 @@
 from . import types
+from .authorization import *
+from .cache import *
+from .calendars import *
+from .chatlog import *
+from .db_listeners import *
 from .db_models import *
+from .delivery import *
 from .flags import *
 from .get_paypal_access_token import *
+from .http_sessions import *
+from .ics_filter import *
 from .json_utils import *
 from .login import *
+from .prices import *
+from .sessions import *
+from .purchase_events import *
+from .sql_pools import *
+from .text_rendering import *
+from .tts_relay import *
 from .webhook_util import *
 
 __all__: tuple[str, ...] = (
+    'AuthorizationCache',
+    'get_authorization_cache',
+    'get_authorized_product_ids',
+    'is_manager',
+    'product_authorization_is_valid',
+    'refresh_product_credentials',
+    'setup_authorization_cache',
+    'CacheBackend',
+    'MemoryCacheBackend',
+    'RedisCacheBackend',
+    'DiskCacheBackend',
+    'CacheItem',
+    'get_cache_backend',
+    'set_cache_backend',
+    'cache_by_query',
+    'entitlement_tags',
+    'identity_tags',
+    'invalidate_cache_tags',
+    'invalidate_cache_tags_on_commit',
+    'setup_cache',
+    'filter_calendar',
+    'ChatlogRendererBusy',
+    'load_static_text',
+    'render_chatlog_sync',
+    'render_chatlog',
+    'render_png',
+    'stream_chatlog',
+    'get_chatlog_metrics',
+    'chatlog_cache_key',
+    'get_cached_chatlog',
+    'cache_chatlog',
+    'setup_chatlog_renderer',
     'CheckoutItem',
     'User',
     'ManagerUser',
@@ -14,10 +60,45 @@ __all__: tuple[str, ...] = (
     '_require_login_wrapper',
     'get_paypal_access_token',
     'get_paypal_basicauth',
+    'get_session',
+    'setup_sessions',
+    'close_sessions',
+    'RawEvent',
+    'RawCalendar',
+    'calendar_names_are_similar',
+    'filter_calendar_sync',
     'requires_login',
     'requires_manager_login',
     'send_webhook',
     'send_sql',
+    'enqueue_delivery',
+    'wake_delivery_workers',
+    'start_delivery_workers',
+    'stop_delivery_workers',
+    'setup_delivery_workers',
+    'get_dsn_pool',
+    'close_dsn_pools',
+    'add_db_listener',
+    'setup_db_listeners',
+    'record_purchase_event',
+    'fetch_purchase_events',
+    'get_purchase_event_cursor',
+    'next_purchase_event',
+    'setup_purchase_events',
+    'get_prices',
+    'invalidate_price',
+    'load_session_keys',
+    'RotatingEncryptedCookieStorage',
+    'RedisSessionStorage',
     'serialize',
+    'render_message',
+    'register_filters',
+    'RelayConnection',
+    'TTSRelayBroker',
+    'LocalTTSRelayBroker',
+    'RedisTTSRelayBroker',
+    'get_tts_relay_broker',
+    'set_tts_relay_broker',
+    'setup_tts_relay',
     'types',
 )
@@ -0,0 +1,296 @@
+from __future__ import annotations
+
+import asyncio
+from collections import OrderedDict
+import hashlib
+import hmac
+import logging
+import time
+from typing import Any
+
+from aiohttp.web import Application
+from discord.ext import vbu
+
+from .db_listeners import add_db_listener
+
+__all__ = (
+    'AuthorizationCache',
+    'get_authorization_cache',
+    'get_authorized_product_ids',
+    'is_manager',
+    'product_authorization_is_valid',
+    'refresh_product_credentials',
+    'setup_authorization_cache',
+)
+
+log = logging.getLogger("vbu.voxelfox.authorization")
+
+
+NOTIFY_CHANNEL = "authorization_changed"
+AUTHORIZATION_TTL = 60  # Seconds that an authorization check is cached for
+MAX_AUTHORIZATIONS = 10_000  # Max authorization checks cached by each worker
+
+
+class AuthorizationCache:
+    """
+    An in-process cache of authorization checks. Entries are grouped by the
+    table that they were read from, so that every check against a table
+    can be dropped when Postgres says that table has changed; they also
+    expire after a short TTL in case a notification is missed.
+
+    Attributes
+    ----------
+    ttl : float
+        Seconds that a check is cached for.
+    max_items : int
+        The maximum number of checks to cache.
+    stats : dict[str, int]
+        Counters for cache hits, misses and invalidations.
+    """
+
+    def __init__(self, ttl: float = AUTHORIZATION_TTL, max_items: int = MAX_AUTHORIZATIONS):
+        self.ttl = ttl
+        self.max_items = max_items
+        self.stats: dict[str, int] = {
+            "hits": 0,
+            "misses": 0,
+            "invalidations": 0,
+        }
+        self._items: OrderedDict[tuple[str, Any], tuple[float, bool]] = OrderedDict()
+        self._generation = 0
+
+    @property
+    def generation(self) -> int:
+        """
+        A number that changes whenever anything is invalidated. Get this
+        *before* reading from the database, and pass it to :meth:`set` so
+        that a result read before an invalidation isn't cached after it.
+        """
+
+        return self._generation
+
+    def get(self, table: str, key: Any) -> bool | None:
+        item = self._items.get((table, key))
+        if item is None or item[0] < time.monotonic():
+            self.stats["misses"] += 1
+            return None
+        self._items.move_to_end((table, key))
+        self.stats["hits"] += 1
+        return item[1]
+
+    def set(self, table: str, key: Any, value: bool, generation: int) -> None:
+        if generation != self._generation:
+            return
+        self._items[(table, key)] = (time.monotonic() + self.ttl, value)
+        self._items.move_to_end((table, key))
+        while len(self._items) > self.max_items:
+            self._items.popitem(last=False)
+
+    def invalidate(self, table: str | None = None) -> None:
+        """
+        Drop every cached check against the given table, or against every
+        table if one isn't given.
+        """
+
+        self.stats["invalidations"] += 1
+        self._generation += 1
+        if table is None:
+            self._items.clear()
+            return
+        for key in [i for i in self._items if i[0] == table]:
+            del self._items[key]
+
+
+_authorization_cache = AuthorizationCache()
+
+# Product name (lowercased, like CITEXT) to the SHA-256 digest of the
+# transaction webhook authorization and the ID of each product with that
+# name
+_product_credentials: dict[str, list[tuple[bytes, str]]] | None = None
+_product_credentials_task: asyncio.Task | None = None
+_product_credentials_stale = False
+
+
+def get_authorization_cache() -> AuthorizationCache:
+    """
+    Get the cache used for authorization checks.
+    """
+
+    return _authorization_cache
+
+
+async def is_manager(login_id: str) -> bool:
+    """
+    Get whether or not the user with the given login ID is a manager user.
+    """
+
+    cache = get_authorization_cache()
+    cached = cache.get("manager_users", login_id)
+    if cached is not None:
+        return cached
+    generation = cache.generation
+    async with vbu.Database() as db:
+        rows = await db.call(
+            """
+            SELECT
+                1
+            FROM
+                manager_users
+            WHERE
+                login_id = $1
+            """,
+            login_id,
+        )
+    cache.set("manager_users", login_id, bool(rows), generation)
+    return bool(rows)
+
+
+def _digest(authorization: str) -> bytes:
+    return hashlib.sha256(authorization.encode()).digest()
+
+
+async def _load_product_credentials() -> None:
+    """
+    Read the digest of every product's transaction webhook authorization
+    into memory, starting again if the products change while they're being
+    read.
+    """
+
+    global _product_credentials, _product_credentials_stale
+    while True:
+        _product_credentials_stale = False
+        try:
+            async with vbu.Database() as db:
+                rows = await db.call(
+                    """
+                    SELECT
+                        id,
+                        product_name,
+                        transaction_webhook_authorization
+                    FROM
+                        checkout_items
+                    WHERE
+                        transaction_webhook_authorization != ''
+                    """,
+                )
+        except Exception:
+            log.error("Failed to load product credentials", exc_info=True)
+            return
+        credentials: dict[str, list[tuple[bytes, str]]] = {}
+        for r in rows:
+            credentials.setdefault(r['product_name'].lower(), []).append(
+                (_digest(r['transaction_webhook_authorization']), str(r['id']))
+            )
+        if _product_credentials_stale:
+            continue
+        _product_credentials = credentials
+        log.info(f"Loaded credentials for {len(credentials)} product names")
+        return
+
+
+def refresh_product_credentials() -> None:
+    """
+    Reload the in-memory product credentials in the background. Until
+    they're loaded, authorizations are checked against the database.
+    """
+
+    global _product_credentials, _product_credentials_task, _product_credentials_stale
+    _product_credentials = None
+    if _product_credentials_task is not None and not _product_credentials_task.done():
+        _product_credentials_stale = True
+        return
+    _product_credentials_task = asyncio.create_task(_load_product_credentials())
+
+
+async def product_authorization_is_valid(product_name: str, authorization: str) -> bool:
+    """
+    Get whether or not the given authorization is the transaction webhook
+    authorization for the named product. This is checked against an
+    in-memory index of authorization digests (compared in constant time)
+    when it's loaded, or against the database if not.
+    """
+
+    # Check the index
+    credentials = _product_credentials
+    if credentials is not None:
+        digest = _digest(authorization)
+        return any(
+            hmac.compare_digest(digest, i)
+            for i, _ in credentials.get(product_name.lower(), ())
+        )
+
+    # Check the database
+    async with vbu.Database() as db:
+        rows = await db.call(
+            """
+            SELECT
+                1
+            FROM
+                checkout_items
+            WHERE
+                product_name = $1
+                AND transaction_webhook_authorization = $2
+            """,
+            product_name, authorization,
+        )
+    return bool(rows)
+
+
+async def get_authorized_product_ids(
+        authorization: str,
+        product_name: str | None = None) -> list[str]:
+    """
+    Get the IDs of the products that the given transaction webhook
+    authorization is valid for, optionally only those with the given name.
+    This is checked against the in-memory index of authorization digests
+    (compared in constant time) when it's loaded, or against the database
+    if not.
+    """
+
+    # Check the index
+    credentials = _product_credentials
+    if credentials is not None:
+        digest = _digest(authorization)
+        if product_name is None:
+            products = [i for p in credentials.values() for i in p]
+        else:
+            products = credentials.get(product_name.lower(), [])
+        return [
+            product_id
+            for product_digest, product_id in products
+            if hmac.compare_digest(digest, product_digest)
+        ]
+
+    # Check the database
+    async with vbu.Database() as db:
+        rows = await db.call(
+            """
+            SELECT
+                id
+            FROM
+                checkout_items
+            WHERE
+                transaction_webhook_authorization = $1
+                AND ($2::CITEXT IS NULL OR product_name = $2::CITEXT)
+            """,
+            authorization, product_name,
+        )
+    return [str(r['id']) for r in rows]
+
+
+def _on_notification(payload: str | None) -> None:
+    # A None payload means the listener (re)connected and may have missed
+    # some changes
+    get_authorization_cache().invalidate(payload)
+    if payload is None or payload == "checkout_items":
+        refresh_product_credentials()
+
+
+def setup_authorization_cache(app: Application) -> None:
+    """
+    Drop cached authorization checks when the tables that they're read
+    from change. Product credentials are loaded once the database listener
+    connects, and reloaded when the products change.
+    """
+
+    add_db_listener(NOTIFY_CHANNEL, _on_notification)
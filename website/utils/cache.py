@@ -0,0 +1,716 @@
+from __future__ import annotations
+
+import asyncio
+import base64
+from collections import OrderedDict
+from datetime import timedelta
+from functools import wraps
+import hashlib
+import json
+import logging
+import os
+import struct
+import tempfile
+import time
+from typing import Any, Awaitable, Callable, Iterable, Protocol
+from typing_extensions import Self
+
+from aiohttp.web import Application, Request, Response, StreamResponse
+from discord.ext import vbu
+
+from .db_listeners import add_db_listener
+
+__all__ = (
+    'CacheBackend',
+    'MemoryCacheBackend',
+    'RedisCacheBackend',
+    'DiskCacheBackend',
+    'CacheItem',
+    'get_cache_backend',
+    'set_cache_backend',
+    'cache_by_query',
+    'entitlement_tags',
+    'identity_tags',
+    'invalidate_cache_tags',
+    'invalidate_cache_tags_on_commit',
+    'setup_cache',
+)
+
+log = logging.getLogger("vbu.voxelfox.cache")
+
+
+CR = Callable[
+    [Request],
+    Awaitable[
+        StreamResponse
+        | tuple[StreamResponse, bool]
+        | tuple[StreamResponse, timedelta]
+        | tuple[StreamResponse, bool | timedelta, list[str]]
+    ]
+]
+INVALIDATION_CHANNEL = "website:cache-invalidate"
+INVALIDATION_NOTIFY_CHANNEL = "cache_invalidate"
+MAX_TAGS_PER_NOTIFY = 100  # Keeps each NOTIFY payload well under Postgres' 8000 byte limit
+DISK_CACHE_RESCAN_INTERVAL = 60  # Seconds between recounting the disk cache's directory
+
+
+class CacheBackend(Protocol):
+    """
+    A store that cached values can be put in.
+    """
+
+    stats: dict[str, int]
+
+    async def get(self, key: str) -> bytes | None:
+        ...
+
+    async def set(self, key: str, value: bytes, ttl: float, tags: Iterable[str] = ()) -> None:
+        ...
+
+    async def delete(self, *keys: str) -> None:
+        ...
+
+    async def delete_tagged(self, *tags: str) -> None:
+        ...
+
+
+class MemoryCacheBackend:
+    """
+    An in-process cache that evicts the least recently used items once it
+    goes over its item or byte limit. Expired items are removed by a
+    background sweeper as well as on read.
+
+    Attributes
+    ----------
+    max_items : int
+        The maximum number of items to store.
+    max_bytes : int
+        The maximum number of bytes (keys plus values) to store.
+    sweep_interval : float
+        The number of seconds between removing expired items.
+    stats : dict[str, int]
+        Counters for cache hits, misses, evictions and expirations.
+    """
+
+    def __init__(
+            self,
+            max_items: int = 10_000,
+            max_bytes: int = 1024 * 1024 * 50,
+            sweep_interval: float = 60):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.sweep_interval = sweep_interval
+        self._items: OrderedDict[str, tuple[float, bytes]] = OrderedDict()
+        self._bytes: int = 0
+        self._key_tags: dict[str, tuple[str, ...]] = {}
+        self._tagged: dict[str, set[str]] = {}
+        self._sweeper: asyncio.Task | None = None
+        self.stats: dict[str, int] = {
+            "hits": 0,
+            "misses": 0,
+            "evictions": 0,
+            "expirations": 0,
+        }
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    @property
+    def size(self) -> int:
+        return self._bytes
+
+    def _remove(self, key: str) -> None:
+        _, value = self._items.pop(key)
+        self._bytes -= len(key) + len(value)
+        for tag in self._key_tags.pop(key, ()):
+            keys = self._tagged.get(tag)
+            if keys is None:
+                continue
+            keys.discard(key)
+            if not keys:
+                del self._tagged[tag]
+
+    def _ensure_sweeper(self) -> None:
+        if self._sweeper is None or self._sweeper.done():
+            self._sweeper = asyncio.create_task(self._sweep_forever())
+
+    async def _sweep_forever(self) -> None:
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            self.sweep()
+
+    def sweep(self) -> int:
+        """
+        Remove all expired items from the cache, returning how many were
+        removed.
+        """
+
+        now = time.monotonic()
+        expired = [
+            key
+            for key, (expires_at, _) in self._items.items()
+            if expires_at <= now
+        ]
+        for key in expired:
+            self._remove(key)
+        self.stats["expirations"] += len(expired)
+        return len(expired)
+
+    async def get(self, key: str) -> bytes | None:
+        v = self._items.get(key)
+        if v is None:
+            self.stats["misses"] += 1
+            return None
+        expires_at, value = v
+        if expires_at <= time.monotonic():
+            self._remove(key)
+            self.stats["expirations"] += 1
+            self.stats["misses"] += 1
+            return None
+        self._items.move_to_end(key)
+        self.stats["hits"] += 1
+        return value
+
+    async def set(self, key: str, value: bytes, ttl: float, tags: Iterable[str] = ()) -> None:
+        if key in self._items:
+            self._remove(key)
+        self._items[key] = (time.monotonic() + ttl, value)
+        self._bytes += len(key) + len(value)
+        tags = tuple(tags)
+        if tags:
+            self._key_tags[key] = tags
+            for tag in tags:
+                self._tagged.setdefault(tag, set()).add(key)
+        while self._items and (len(self._items) > self.max_items or self._bytes > self.max_bytes):
+            self._remove(next(iter(self._items)))
+            self.stats["evictions"] += 1
+        self._ensure_sweeper()
+
+    async def delete(self, *keys: str) -> None:
+        for key in keys:
+            if key in self._items:
+                self._remove(key)
+
+    async def delete_tagged(self, *tags: str) -> None:
+        keys: set[str] = set()
+        for tag in tags:
+            keys.update(self._tagged.get(tag, ()))
+        await self.delete(*keys)
+
+
+class RedisCacheBackend:
+    """
+    A cache stored in Redis so that it can be shared between worker
+    processes. Expiry and eviction are left to Redis.
+
+    Attributes
+    ----------
+    prefix : str
+        A prefix added to all keys stored in Redis.
+    stats : dict[str, int]
+        Counters for cache hits and misses seen by this process.
+    """
+
+    def __init__(self, prefix: str = "website:cache:"):
+        self.prefix = prefix
+        self.stats: dict[str, int] = {
+            "hits": 0,
+            "misses": 0,
+            "evictions": 0,
+            "expirations": 0,
+        }
+
+    async def get(self, key: str) -> bytes | None:
+        async with vbu.Redis() as re:
+            value = await re.conn.get(self.prefix + key)
+        if value is None:
+            self.stats["misses"] += 1
+            return None
+        self.stats["hits"] += 1
+        return value
+
+    async def set(self, key: str, value: bytes, ttl: float, tags: Iterable[str] = ()) -> None:
+        expire = max(int(ttl), 1)
+        async with vbu.Redis() as re:
+            await re.conn.set(self.prefix + key, value, expire=expire)
+            for tag in tags:
+                tag_key = f"{self.prefix}tag:{tag}"
+                await re.conn.sadd(tag_key, key)
+                if await re.conn.ttl(tag_key) < expire:
+                    await re.conn.expire(tag_key, expire)
+
+    async def delete(self, *keys: str) -> None:
+        if not keys:
+            return
+        async with vbu.Redis() as re:
+            await re.conn.delete(*(self.prefix + key for key in keys))
+
+    async def delete_tagged(self, *tags: str) -> None:
+        if not tags:
+            return
+        async with vbu.Redis() as re:
+            keys: set[str] = set()
+            for tag in tags:
+                tag_key = f"{self.prefix}tag:{tag}"
+                keys.update(i.decode() for i in await re.conn.smembers(tag_key))
+                await re.conn.delete(tag_key)
+            if keys:
+                await re.conn.delete(*(self.prefix + key for key in keys))
+
+
+class DiskCacheBackend:
+    """
+    A cache stored as files in a directory, so that it survives restarts.
+    The least recently used files are removed once it goes over its byte
+    limit. Files are read and written in a thread so that the event loop
+    isn't blocked. Tags are only tracked for items set by this process.
+
+    The directory can be shared between workers. Each keeps an index of the
+    files in it, which is rebuilt from the directory itself whenever it
+    looks to be over the limit and every so often otherwise, so that the
+    limit (and least recently used order) covers every worker's files.
+
+    Attributes
+    ----------
+    directory : str
+        The directory that cached items are stored in.
+    max_bytes : int
+        The maximum number of bytes to store.
+    stats : dict[str, int]
+        Counters for cache hits, misses, evictions and expirations.
+    """
+
+    HEADER = struct.Struct(">d")  # The expiry time at the start of each file
+
+    def __init__(self, directory: str, max_bytes: int = 1024 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._files: OrderedDict[str, int] | None = None  # filename: size
+        self._bytes: int = 0
+        self._scanned_at: float = 0
+        self._tagged: dict[str, set[str]] = {}
+        self.stats: dict[str, int] = {
+            "hits": 0,
+            "misses": 0,
+            "evictions": 0,
+            "expirations": 0,
+        }
+
+    @property
+    def size(self) -> int:
+        return self._bytes
+
+    def _filename(self, key: str) -> str:
+        return hashlib.sha256(key.encode()).hexdigest()
+
+    def _path(self, filename: str) -> str:
+        return os.path.join(self.directory, filename)
+
+    def _scan(self) -> list[tuple[str, int]]:
+        os.makedirs(self.directory, exist_ok=True)
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".tmp"):
+                continue
+            try:
+                if not entry.is_file():
+                    continue
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, entry.name, stat.st_size,))
+        return [(name, size) for _, name, size in sorted(files)]
+
+    def _scan_and_evict(self, keep: str | None = None) -> tuple[list[tuple[str, int]], int]:
+        """
+        Read the files in the directory, removing the least recently used
+        (other than ``keep``) until they're under the limit. Returns the
+        files that are left (oldest first) and how many were removed.
+        """
+
+        files = self._scan()
+        kept = [i for i in files if i[0] == keep]
+        files = [i for i in files if i[0] != keep]
+        total = sum(size for _, size in files + kept)
+        evicted = 0
+        while files and total > self.max_bytes:
+            filename, size = files.pop(0)
+            self._unlink(filename)
+            total -= size
+            evicted += 1
+        return files + kept, evicted
+
+    async def _rescan(self, keep: str | None = None) -> OrderedDict[str, int]:
+        files, evicted = await asyncio.to_thread(self._scan_and_evict, keep)
+        self._files = OrderedDict(files)
+        self._bytes = sum(self._files.values())
+        self._scanned_at = time.monotonic()
+        self.stats["evictions"] += evicted
+        return self._files
+
+    async def _get_files(self) -> OrderedDict[str, int]:
+        if self._files is None:
+            return await self._rescan()
+        return self._files
+
+    def _read(self, filename: str) -> bytes | None:
+        try:
+            with open(self._path(filename), "rb") as a:
+                data = a.read()
+            os.utime(self._path(filename))
+        except FileNotFoundError:
+            return None
+        return data
+
+    def _write(self, filename: str, data: bytes) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+
+        # Write to a temp file that's unique to this write, so that
+        # concurrent writes of the same key (from this or another worker)
+        # can't rename each other's half written files into place
+        fd, temp = tempfile.mkstemp(dir=self.directory, prefix=f"{filename}.", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as a:
+                a.write(data)
+            os.replace(temp, self._path(filename))
+        except BaseException:
+            try:
+                os.remove(temp)
+            except FileNotFoundError:
+                pass
+            raise
+
+    def _unlink(self, *filenames: str) -> None:
+        for filename in filenames:
+            try:
+                os.remove(self._path(filename))
+            except FileNotFoundError:
+                pass
+
+    async def _remove(self, *filenames: str) -> None:
+        files = await self._get_files()
+        removed = [i for i in filenames if i in files]
+        for filename in removed:
+            self._bytes -= files.pop(filename)
+        if removed:
+            await asyncio.to_thread(self._unlink, *removed)
+
+    async def get(self, key: str) -> bytes | None:
+        files = await self._get_files()
+        filename = self._filename(key)
+        data = await asyncio.to_thread(self._read, filename) if filename in files else None
+        if data is None:
+            self.stats["misses"] += 1
+            return None
+        expires_at, = self.HEADER.unpack_from(data)
+        if expires_at <= time.time():
+            await self._remove(filename)
+            self.stats["expirations"] += 1
+            self.stats["misses"] += 1
+            return None
+        if filename in files:
+            files.move_to_end(filename)
+        self.stats["hits"] += 1
+        return data[self.HEADER.size:]
+
+    async def set(self, key: str, value: bytes, ttl: float, tags: Iterable[str] = ()) -> None:
+        files = await self._get_files()
+        filename = self._filename(key)
+        data = self.HEADER.pack(time.time() + ttl) + value
+        await asyncio.to_thread(self._write, filename, data)
+        self._bytes -= files.pop(filename, 0)
+        files[filename] = len(data)
+        self._bytes += len(data)
+        for tag in tags:
+            self._tagged.setdefault(tag, set()).add(key)
+
+        # Recount the directory (including other workers' files), and
+        # remove the least recently used files until we're under the limit
+        if (
+                self._bytes > self.max_bytes
+                or time.monotonic() - self._scanned_at >= DISK_CACHE_RESCAN_INTERVAL):
+            await self._rescan(keep=filename)
+
+    async def delete(self, *keys: str) -> None:
+        await self._remove(*(self._filename(i) for i in keys))
+
+    async def delete_tagged(self, *tags: str) -> None:
+        keys: set[str] = set()
+        for tag in tags:
+            keys.update(self._tagged.pop(tag, ()))
+        await self.delete(*keys)
+
+
+_cache_backend: CacheBackend = MemoryCacheBackend()
+
+
+def get_cache_backend() -> CacheBackend:
+    """
+    Get the backend that's used to cache responses.
+    """
+
+    return _cache_backend
+
+
+def set_cache_backend(backend: CacheBackend) -> None:
+    """
+    Set the backend that's used to cache responses.
+    """
+
+    global _cache_backend
+    _cache_backend = backend
+
+
+def entitlement_tags(
+        identities: Iterable[tuple[str, Any]],
+        product_ids: Iterable[Any]) -> list[str]:
+    """
+    Get the tags for the cached entitlement checks of the given identities
+    against the given products.
+
+    Parameters
+    ----------
+    identities : Iterable[tuple[str, Any]]
+        Pairs of identity types (eg ``"discord"``, ``"guild"``) and their
+        IDs. Pairs with an empty ID are ignored.
+    product_ids : Iterable[Any]
+        The IDs of the products. Empty IDs are ignored.
+    """
+
+    product_ids = [str(i) for i in product_ids if i]
+    return [
+        f"{kind}:{identity}/{product_id}"
+        for kind, identity in identities
+        if identity
+        for product_id in product_ids
+    ]
+
+
+def identity_tags(identities: Iterable[tuple[str, Any]]) -> list[str]:
+    """
+    Get the tags for every cached entitlement check of the given
+    identities, whatever the product. These should be invalidated when an
+    identity is linked to (or removed from) a user.
+
+    Parameters
+    ----------
+    identities : Iterable[tuple[str, Any]]
+        Pairs of identity types (eg ``"discord"``, ``"vfl"``) and their IDs.
+        Pairs with an empty ID are ignored.
+    """
+
+    return [
+        f"{kind}:{identity}"
+        for kind, identity in identities
+        if identity
+    ]
+
+
+async def invalidate_cache_tags(*tags: str) -> None:
+    """
+    Remove all of the cached items with any of the given tags, both in this
+    process and (via Redis) in every other worker.
+    """
+
+    if not tags:
+        return
+    log.info(f"Invalidating cache tags {tags}")
+    try:
+        await get_cache_backend().delete_tagged(*tags)
+    except Exception:
+        log.warning("Failed to invalidate cache tags", exc_info=True)
+    if not vbu.Redis.enabled:
+        return
+    try:
+        async with vbu.Redis() as re:
+            await re.publish_str(INVALIDATION_CHANNEL, json.dumps(tags))
+    except Exception:
+        log.warning("Failed to publish cache invalidation", exc_info=True)
+
+
+async def invalidate_cache_tags_on_commit(db: vbu.Database, *tags: str) -> None:
+    """
+    Remove all of the cached items with any of the given tags in every
+    worker, once the given connection's transaction commits. This should be
+    used instead of :func:`invalidate_cache_tags` for changes made inside a
+    transaction, so that a request made before the commit can't read (and
+    cache) the old data after it's been invalidated.
+
+    Parameters
+    ----------
+    db : vbu.Database
+        The connection that the change was made with.
+    *tags : str
+        The tags to invalidate.
+    """
+
+    for i in range(0, len(tags), MAX_TAGS_PER_NOTIFY):
+        await db.call(
+            """SELECT PG_NOTIFY($1, $2)""",
+            INVALIDATION_NOTIFY_CHANNEL,
+            json.dumps(tags[i:i + MAX_TAGS_PER_NOTIFY]),
+        )
+
+
+async def _on_invalidation_notification(payload: str | None) -> None:
+    if payload is None:
+        return
+    tags = json.loads(payload)
+    log.info(f"Invalidating committed cache tags {tags}")
+    try:
+        await get_cache_backend().delete_tagged(*tags)
+    except Exception:
+        log.warning("Failed to apply cache invalidation", exc_info=True)
+
+
+async def _listen_for_invalidations() -> None:
+    """
+    Apply cache invalidations published by other workers.
+    """
+
+    async with vbu.Redis() as re:
+        channel, = await re.conn.subscribe(INVALIDATION_CHANNEL)
+    async for message in channel.iter(encoding="utf-8"):
+        try:
+            await get_cache_backend().delete_tagged(*json.loads(message))
+        except Exception:
+            log.warning("Failed to apply cache invalidation", exc_info=True)
+
+
+async def _start_invalidation_listener(app: Application) -> None:
+    if not vbu.Redis.enabled:
+        return
+    app["cache_invalidation_listener"] = asyncio.create_task(_listen_for_invalidations())
+
+
+async def _stop_invalidation_listener(app: Application) -> None:
+    task = app.get("cache_invalidation_listener")
+    if task is not None:
+        task.cancel()
+
+
+def setup_cache(app: Application) -> None:
+    """
+    Register the cache invalidation listeners on the given application so
+    that invalidations from other workers (and committed transactions) are
+    applied to this one.
+    """
+
+    add_db_listener(INVALIDATION_NOTIFY_CHANNEL, _on_invalidation_notification)
+    app.on_startup.append(_start_invalidation_listener)
+    app.on_cleanup.append(_stop_invalidation_listener)
+
+
+class CacheItem:
+    """
+    A cached response.
+    """
+
+    __slots__ = (
+        'body',
+        'status',
+        'headers',
+    )
+
+    def __init__(
+            self,
+            body: bytes,
+            status: int,
+            headers: dict[str, str]):
+        self.body = body
+        self.status = status
+        self.headers = headers
+
+    @classmethod
+    def from_response(cls, response: StreamResponse) -> Self:
+        body = getattr(response, "body", None) or b""
+        if isinstance(body, str):
+            body = body.encode()
+        return cls(
+            body=body,
+            status=response.status,
+            headers=dict(response.headers),
+        )
+
+    @property
+    def response(self) -> Response:
+        return Response(
+            body=self.body,
+            status=self.status,
+            headers=self.headers,
+        )
+
+    def dump(self) -> bytes:
+        return json.dumps({
+            "body": base64.b64encode(self.body).decode(),
+            "status": self.status,
+            "headers": self.headers,
+        }).encode()
+
+    @classmethod
+    def load(cls, data: bytes) -> Self:
+        loaded = json.loads(data)
+        return cls(
+            body=base64.b64decode(loaded["body"]),
+            status=loaded["status"],
+            headers=loaded["headers"],
+        )
+
+    @staticmethod
+    def get_key(request: Request) -> str:
+        keys = sorted(request.query.keys())
+        return (
+            request.url.path
+            + "&".join(f"{key}={request.query[key]}" for key in keys)
+        )
+
+
+def cache_by_query(lifetime: timedelta = timedelta(minutes=1)):
+    """
+    Cache a given request to a URL by its query string.
+
+    The wrapped function can return a tuple of ``(response, keep)``, where
+    ``keep`` is either a boolean (to cache for the default lifetime) or a
+    timedelta (to cache for that long). Plain responses aren't cached. A
+    list of tags can be added as a third item so that the cached response
+    can be removed with :func:`invalidate_cache_tags`.
+    """
+
+    def decorator(func: CR) -> Callable[[Request], Awaitable[StreamResponse]]:
+        @wraps(func)
+        async def wrapper(request: Request) -> StreamResponse:
+            backend = get_cache_backend()
+            key = CacheItem.get_key(request)
+            if request.headers.get("Cache-Control") != "no-cache":
+                try:
+                    cached = await backend.get(key)
+                except Exception:
+                    log.warning("Failed to read from the cache", exc_info=True)
+                    cached = None
+                if cached is not None:
+                    return CacheItem.load(cached).response
+            response = await func(request)
+            keep = False
+            tags: list[str] = []
+            if isinstance(response, tuple):
+                response, keep, *extra = response
+                if extra:
+                    tags = extra[0]
+            if keep is True:
+                ttl = lifetime
+            elif isinstance(keep, timedelta):
+                ttl = keep
+            else:
+                return response
+            try:
+                await backend.set(
+                    key,
+                    CacheItem.from_response(response).dump(),
+                    ttl.total_seconds(),
+                    tags,
+                )
+            except Exception:
+                log.warning("Failed to write to the cache", exc_info=True)
+            return response
+        return wrapper
+    return decorator
@@ -0,0 +1,150 @@
+from __future__ import annotations
+
+import asyncio
+from collections import OrderedDict
+import logging
+import time
+
+from .cache import MemoryCacheBackend
+from .http_sessions import get_session
+from .ics_filter import RawCalendar, filter_calendar_sync
+
+__all__ = (
+    'filter_calendar',
+)
+
+log = logging.getLogger("vbu.voxelfox.calendars")
+
+
+UPSTREAM_FRESH_TTL = 60  # Seconds before an upstream feed is revalidated
+MAX_UPSTREAM_CALENDARS = 128  # Max upstream feeds kept in memory
+OUTPUT_TTL = 60 * 60 * 24  # Seconds that filtered calendars are cached for
+USER_AGENT = "Voxel Fox calendar filter kae@voxelfox.co.uk"
+
+
+class UpstreamCalendar:
+    """
+    A parsed calendar feed, along with what we need to revalidate it.
+    """
+
+    __slots__ = (
+        'calendar',
+        'etag',
+        'last_modified',
+        'fetched_at',
+        'version',
+    )
+
+    def __init__(
+            self,
+            calendar: RawCalendar,
+            etag: str | None,
+            last_modified: str | None,
+            version: int):
+        self.calendar = calendar
+        self.etag = etag
+        self.last_modified = last_modified
+        self.fetched_at = time.monotonic()
+        self.version = version
+
+
+_upstream: OrderedDict[str, UpstreamCalendar] = OrderedDict()
+_upstream_locks: dict[str, asyncio.Lock] = {}
+_upstream_version: int = 0
+_output_cache = MemoryCacheBackend(max_items=1_000, max_bytes=1024 * 1024 * 32)
+
+
+async def _fetch_upstream(url: str) -> UpstreamCalendar:
+    """
+    Get the parsed calendar at a URL. Feeds are kept in memory and
+    revalidated with the upstream server once they're stale; if the server
+    can't be reached, the stale feed is used.
+    """
+
+    global _upstream_version
+    lock = _upstream_locks.setdefault(url, asyncio.Lock())
+    async with lock:
+        cached = _upstream.get(url)
+        if cached is not None:
+            _upstream.move_to_end(url)
+            if time.monotonic() - cached.fetched_at < UPSTREAM_FRESH_TTL:
+                return cached
+
+        # Ask the server if it's changed
+        headers = {"User-Agent": USER_AGENT}
+        if cached is not None and cached.etag:
+            headers["If-None-Match"] = cached.etag
+        if cached is not None and cached.last_modified:
+            headers["If-Modified-Since"] = cached.last_modified
+        try:
+            async with get_session().get(url, headers=headers) as site:
+                if site.status == 304 and cached is not None:
+                    cached.fetched_at = time.monotonic()
+                    return cached
+                site.raise_for_status()
+                calendar_raw = await site.text()
+                etag = site.headers.get("ETag")
+                last_modified = site.headers.get("Last-Modified")
+        except Exception:
+            if cached is None:
+                raise
+            log.warning(f"Failed to revalidate calendar {url}", exc_info=True)
+            return cached
+
+        # Split up the new calendar
+        loop = asyncio.get_running_loop()
+        calendar = await loop.run_in_executor(None, RawCalendar.parse, calendar_raw)
+        _upstream_version += 1
+        upstream = _upstream[url] = UpstreamCalendar(
+            calendar,
+            etag,
+            last_modified,
+            _upstream_version,
+        )
+        _upstream.move_to_end(url)
+        while len(_upstream) > MAX_UPSTREAM_CALENDARS:
+            oldest, _ = _upstream.popitem(last=False)
+            _upstream_locks.pop(oldest, None)
+        return upstream
+
+
+async def filter_calendar(
+        url: str,
+        filters: list[str],
+        combine_similar: bool) -> str:
+    """
+    Get the calendar at a URL, remove any events whose names contain any of
+    the filters, and optionally combine back-to-back events with similar
+    names. Both the upstream calendar and the output are cached.
+
+    Parameters
+    ----------
+    url : str
+        The URL of the ICS feed.
+    filters : list[str]
+        Case insensitive strings to remove events by.
+    combine_similar : bool
+        Whether to combine similar events.
+
+    Returns
+    -------
+    str
+        The serialized calendar.
+    """
+
+    upstream = await _fetch_upstream(url)
+    filters = sorted({i.casefold() for i in filters})
+    key = "\0".join((url, str(upstream.version), str(combine_similar), *filters))
+    cached = await _output_cache.get(key)
+    if cached is not None:
+        return cached.decode()
+    loop = asyncio.get_running_loop()
+    output = await loop.run_in_executor(
+        None,
+        filter_calendar_sync,
+        upstream.calendar,
+        filters,
+        combine_similar,
+    )
+    await _output_cache.set(key, output.encode(), OUTPUT_TTL)
+    return output
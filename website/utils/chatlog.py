@@ -0,0 +1,517 @@
+from __future__ import annotations
+
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import re
+import time
+from typing import Any
+
+from aiohttp.web import Application, Request, StreamResponse
+import htmlmin
+from jinja2 import Environment, FileSystemLoader
+
+from .cache import CacheBackend, DiskCacheBackend, MemoryCacheBackend
+from .text_rendering import register_filters
+
+__all__ = (
+    'ChatlogRendererBusy',
+    'load_static_text',
+    'render_chatlog_sync',
+    'render_chatlog',
+    'render_png',
+    'stream_chatlog',
+    'get_chatlog_metrics',
+    'chatlog_cache_key',
+    'get_cached_chatlog',
+    'cache_chatlog',
+    'setup_chatlog_renderer',
+)
+
+log = logging.getLogger("vbu.voxelfox.chatlog")
+
+
+CHATLOG_TEMPLATE = "project-pages/discord_page.html.j2"
+CHATLOG_CSS_FILES = (
+    "website/static/css/discord/core.min.css",
+    "website/static/css/discord/dark.min.css",
+)
+RENDER_WORKERS = os.cpu_count() or 1  # Processes used to render chatlogs
+MAX_PENDING_RENDERS = RENDER_WORKERS * 2  # Renders running or queued before we reject
+STREAM_CHUNK_SIZE = 64 * 1024  # Characters rendered before a chunk is sent
+RENDER_WORKER_MAX_JOBS = 100  # Renders per process before the pool's processes are replaced
+WKHTMLTOIMAGE = "wkhtmltoimage"  # Path to the wkhtmltoimage executable
+IMAGE_CONCURRENCY = 2  # Max wkhtmltoimage processes running at once
+MAX_QUEUED_IMAGES = 8  # Images waiting for a process before we reject
+IMAGE_TIMEOUT = 30  # Seconds before a wkhtmltoimage process is killed
+CACHE_LIFETIME = 60 * 60 * 24 * 7  # Seconds that rendered chatlogs are cached for
+
+_static_text: dict[str, tuple[float, str]] = {}
+_environment: Environment | None = None
+_executor: ProcessPoolExecutor | None = None
+_executor_jobs: int = 0
+_pending: int = 0
+_image_semaphore: asyncio.Semaphore | None = None
+_queued_images: int = 0
+_running_images: int = 0
+_memory_cache: CacheBackend = MemoryCacheBackend(max_items=1_000, max_bytes=1024 * 1024 * 64)
+_disk_cache: CacheBackend | None = None
+_metrics: dict[str, float] = {
+    "images_rendered": 0,
+    "images_failed": 0,
+    "images_timed_out": 0,
+    "images_rejected": 0,
+    "image_seconds": 0,
+    "renders_rejected": 0,
+}
+
+
+class ChatlogRendererBusy(Exception):
+    """
+    Raised when too many chatlogs are already being rendered.
+    """
+
+
+def load_static_text(path: str) -> str:
+    """
+    Get the contents of a text file. The file is only read again if it's
+    been changed since the last time it was loaded.
+
+    Parameters
+    ----------
+    path : str
+        The path of the file to read.
+    """
+
+    mtime = os.stat(path).st_mtime
+    cached = _static_text.get(path)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    log.info(f"Loading static file {path}")
+    with open(path) as a:
+        text = a.read()
+    _static_text[path] = (mtime, text)
+    return text
+
+
+def _get_environment() -> Environment:
+    """
+    Get a Jinja environment for rendering chatlogs in this process. This
+    matches the environment that aiohttp_jinja2 sets up for the website.
+    """
+
+    global _environment
+    if _environment is None:
+        _environment = Environment(
+            loader=FileSystemLoader(os.getcwd() + "/website/templates"),
+            autoescape=True,
+        )
+        register_filters(_environment)
+    return _environment
+
+
+def render_chatlog_sync(
+        data: dict[str, Any],
+        *,
+        image: bool = False) -> str:
+    """
+    Render a Discord chatlog as HTML. This blocks, so should be run
+    through :func:`render_chatlog` from async code.
+
+    Parameters
+    ----------
+    data : dict[str, Any]
+        The chatlog data, as given to the chatlog endpoint.
+    image : bool
+        Whether the page is going to be rendered into an image. This
+        removes the preamble and inlines the page's CSS (so that it isn't
+        fetched by the renderer), and skips minifying the page since the
+        output size doesn't matter.
+
+    Returns
+    -------
+    str
+        The rendered HTML page.
+    """
+
+    core_css, dark_css = (load_static_text(i) for i in CHATLOG_CSS_FILES)
+    rendered = _get_environment().get_template(CHATLOG_TEMPLATE).render(
+        data=data,
+        core_css=core_css,
+        dark_css=dark_css,
+        image=image,
+    )
+    if image:
+        return rendered
+    return htmlmin.minify(
+        rendered,
+        remove_comments=True,
+        remove_empty_space=True,
+        reduce_boolean_attributes=True
+    )
+
+
+class _StreamMinifier:
+    """
+    Collapse runs of whitespace and remove comments in HTML as it's
+    streamed, leaving the contents of ``<pre>``, ``<textarea>``,
+    ``<script>`` and ``<style>`` tags alone. Anything that could continue into the next chunk (an unclosed
+    tag or comment, or trailing whitespace) is held back until it's
+    complete.
+    """
+
+    TOKEN = re.compile(
+        r"<!--.*?-->|<(/?)(?:pre|textarea|script|style)\b[^>]*>|\s+",
+        re.IGNORECASE | re.DOTALL,
+    )
+
+    def __init__(self):
+        self._pending: str = ""
+        self._preserve: int = 0
+
+    def _replace(self, match: re.Match) -> str:
+        token = match.group(0)
+        if token.startswith("<!--"):
+            return token if self._preserve else ""
+        if token.startswith("<"):
+            if match.group(1):
+                self._preserve = max(self._preserve - 1, 0)
+            else:
+                self._preserve += 1
+            return token
+        return token if self._preserve else " "
+
+    def feed(self, text: str) -> str:
+        text = self._pending + text
+        cut = len(text.rstrip())
+        tag_start = text.rfind("<", 0, cut)
+        if tag_start != -1 and text.find(">", tag_start) == -1:
+            cut = tag_start
+        comment_start = text.rfind("<!--", 0, cut)
+        if comment_start != -1 and text.find("-->", comment_start) == -1:
+            cut = comment_start
+        self._pending = text[cut:]
+        return self.TOKEN.sub(self._replace, text[:cut])
+
+    def finish(self) -> str:
+        text, self._pending = self._pending, ""
+        return self.TOKEN.sub(self._replace, text)
+
+
+def _get_executor() -> ProcessPoolExecutor:
+    """
+    Get the pool that a chatlog should be rendered in. The pool is replaced
+    once it's done enough renders, so that memory leaked while rendering is
+    given back; renders already sent to the old pool still finish.
+
+    Render processes are forked from a server process that imports this
+    module once, rather than from the website itself (which has threads and
+    an event loop running) or spawned (which would import the whole package
+    again for every new process).
+    """
+
+    global _executor, _executor_jobs
+    if _executor is not None and _executor_jobs >= RENDER_WORKER_MAX_JOBS * RENDER_WORKERS:
+        log.info("Replacing chatlog renderer processes")
+        _executor.shutdown(wait=False)
+        _executor = None
+    if _executor is None:
+        log.info(f"Starting chatlog renderer with {RENDER_WORKERS} processes")
+        context = multiprocessing.get_context("forkserver")
+        context.set_forkserver_preload([__name__])
+        _executor = ProcessPoolExecutor(
+            max_workers=RENDER_WORKERS,
+            mp_context=context,
+        )
+        _executor_jobs = 0
+    _executor_jobs += 1
+    return _executor
+
+
+async def render_png(html: str) -> bytes:
+    """
+    Render a HTML page into a PNG with wkhtmltoimage. Only a limited
+    number of processes are run at once; other pages are queued.
+
+    Parameters
+    ----------
+    html : str
+        The page to render.
+
+    Raises
+    ------
+    ChatlogRendererBusy
+        If the queue of pages waiting to be rendered is full.
+    asyncio.TimeoutError
+        If the page took too long to render.
+    RuntimeError
+        If wkhtmltoimage failed to render the page.
+    """
+
+    global _image_semaphore, _queued_images, _running_images
+    if _image_semaphore is None:
+        _image_semaphore = asyncio.Semaphore(IMAGE_CONCURRENCY)
+    if _queued_images >= MAX_QUEUED_IMAGES:
+        _metrics["images_rejected"] += 1
+        raise ChatlogRendererBusy()
+
+    # Wait for a free slot
+    _queued_images += 1
+    try:
+        await _image_semaphore.acquire()
+    finally:
+        _queued_images -= 1
+
+    # Run the renderer
+    _running_images += 1
+    start = time.monotonic()
+    try:
+        process = await asyncio.create_subprocess_exec(
+            WKHTMLTOIMAGE,
+            "--quiet",
+            "--format", "png",
+            "-", "-",
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        try:
+            stdout, stderr = await asyncio.wait_for(
+                process.communicate(html.encode()),
+                timeout=IMAGE_TIMEOUT,
+            )
+        except BaseException as e:
+            if process.returncode is None:
+                process.kill()
+                await process.wait()
+            if isinstance(e, asyncio.TimeoutError):
+                _metrics["images_timed_out"] += 1
+            raise
+        if process.returncode != 0 or not stdout:
+            _metrics["images_failed"] += 1
+            raise RuntimeError(f"wkhtmltoimage failed: {stderr.decode(errors='replace')}")
+        _metrics["images_rendered"] += 1
+        return stdout
+    finally:
+        _metrics["image_seconds"] += time.monotonic() - start
+        _running_images -= 1
+        _image_semaphore.release()
+
+
+def get_chatlog_metrics() -> dict[str, float]:
+    """
+    Get the current state and counters of the chatlog renderers.
+    """
+
+    return {
+        "memory_cache_bytes": getattr(_memory_cache, "size", 0),
+        "memory_cache_hits": _memory_cache.stats["hits"],
+        "memory_cache_misses": _memory_cache.stats["misses"],
+        "disk_cache_bytes": getattr(_disk_cache, "size", 0),
+        "disk_cache_hits": _disk_cache.stats["hits"] if _disk_cache else 0,
+        "disk_cache_misses": _disk_cache.stats["misses"] if _disk_cache else 0,
+        "pending_renders": _pending,
+        "max_pending_renders": MAX_PENDING_RENDERS,
+        "queued_images": _queued_images,
+        "max_queued_images": MAX_QUEUED_IMAGES,
+        "running_images": _running_images,
+        **_metrics,
+    }
+
+
+async def render_chatlog(
+        data: dict[str, Any],
+        *,
+        image: bool = False) -> str | bytes:
+    """
+    Render a Discord chatlog in the renderer process pool, and then into a
+    PNG if ``image`` is set. See :func:`render_chatlog_sync` for the
+    parameters.
+
+    Raises
+    ------
+    ChatlogRendererBusy
+        If there are already too many chatlogs being rendered.
+    """
+
+    global _executor, _pending
+    if _pending >= MAX_PENDING_RENDERS or (image and _queued_images >= MAX_QUEUED_IMAGES):
+        _metrics["renders_rejected"] += 1
+        raise ChatlogRendererBusy()
+    loop = asyncio.get_running_loop()
+
+    def done(_) -> None:
+        global _pending
+        _pending -= 1
+
+    # Count the render as pending until the process finishes with it, even
+    # if the request is cancelled before then
+    try:
+        future = _get_executor().submit(render_chatlog_sync, data, image=image)
+    except BrokenProcessPool:
+        log.error("Chatlog renderer pool broke - restarting it")
+        _executor = None
+        future = _get_executor().submit(render_chatlog_sync, data, image=image)
+    _pending += 1
+    future.add_done_callback(lambda f: loop.call_soon_threadsafe(done, f))
+    html = await asyncio.wrap_future(future)
+    if image:
+        return await render_png(html)
+    return html
+
+
+async def stream_chatlog(
+        request: Request,
+        data: dict[str, Any]) -> StreamResponse:
+    """
+    Render a Discord chatlog as HTML, sending it to the client in chunks
+    as it's rendered. Chunks are rendered in a thread so that the event
+    loop isn't blocked, and are minified as they go; the whole page is
+    never held in memory.
+
+    Parameters
+    ----------
+    request : Request
+        The request to respond to.
+    data : dict[str, Any]
+        The chatlog data, as given to the chatlog endpoint.
+
+    Raises
+    ------
+    ChatlogRendererBusy
+        If there are already too many chatlogs being rendered.
+    """
+
+    global _pending
+    if _pending >= MAX_PENDING_RENDERS:
+        _metrics["renders_rejected"] += 1
+        raise ChatlogRendererBusy()
+    _pending += 1
+    try:
+        core_css, dark_css = (load_static_text(i) for i in CHATLOG_CSS_FILES)
+        generator = _get_environment().get_template(CHATLOG_TEMPLATE).generate(
+            data=data,
+            core_css=core_css,
+            dark_css=dark_css,
+            image=False,
+        )
+        minifier = _StreamMinifier()
+
+        def render_chunk() -> tuple[str, bool]:
+            parts: list[str] = []
+            size = 0
+            for part in generator:
+                parts.append(part)
+                size += len(part)
+                if size >= STREAM_CHUNK_SIZE:
+                    return minifier.feed("".join(parts)), False
+            return minifier.feed("".join(parts)) + minifier.finish(), True
+
+        # Send the page as it's rendered
+        loop = asyncio.get_running_loop()
+        response = StreamResponse(headers={"Content-Type": "text/html"})
+        response.enable_chunked_encoding()
+        await response.prepare(request)
+        finished = False
+        while not finished:
+            chunk, finished = await loop.run_in_executor(None, render_chunk)
+            if chunk:
+                await response.write(chunk.encode())
+        await response.write_eof()
+        return response
+    finally:
+        _pending -= 1
+
+
+def chatlog_cache_key(data: dict[str, Any], *, image: bool = False) -> str:
+    """
+    Get a key for a rendered chatlog from a hash of its data, its output
+    type, and the files that it's rendered with, so that the same data
+    always gives the same key until the template or CSS change.
+
+    Parameters
+    ----------
+    data : dict[str, Any]
+        The chatlog data, as given to the chatlog endpoint.
+    image : bool
+        Whether the chatlog is rendered into a PNG.
+    """
+
+    h = hashlib.sha256()
+    h.update(b"png" if image else b"html")
+    for path in (f"website/templates/{CHATLOG_TEMPLATE}", *CHATLOG_CSS_FILES):
+        h.update(str(os.stat(path).st_mtime).encode())
+    h.update(json.dumps(data, sort_keys=True, separators=(",", ":")).encode())
+    return h.hexdigest()
+
+
+async def get_cached_chatlog(key: str) -> bytes | None:
+    """
+    Get a rendered chatlog from the memory or disk cache.
+    """
+
+    try:
+        cached = await _memory_cache.get(key)
+        if cached is None and _disk_cache is not None:
+            cached = await _disk_cache.get(key)
+            if cached is not None:
+                await _memory_cache.set(key, cached, CACHE_LIFETIME)
+    except Exception:
+        log.warning("Failed to read cached chatlog", exc_info=True)
+        return None
+    return cached
+
+
+async def cache_chatlog(key: str, body: bytes) -> None:
+    """
+    Store a rendered chatlog in the memory and disk caches.
+    """
+
+    try:
+        await _memory_cache.set(key, body, CACHE_LIFETIME)
+        if _disk_cache is not None:
+            await _disk_cache.set(key, body, CACHE_LIFETIME)
+    except Exception:
+        log.warning("Failed to cache chatlog", exc_info=True)
+
+
+async def _stop_chatlog_renderer(_: Application) -> None:
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+
+def setup_chatlog_renderer(app: Application) -> None:
+    """
+    Configure the chatlog renderers from the ``[chatlog]`` section of the
+    application's config, and shut them down on cleanup.
+    """
+
+    global RENDER_WORKERS, MAX_PENDING_RENDERS, RENDER_WORKER_MAX_JOBS
+    global WKHTMLTOIMAGE, IMAGE_CONCURRENCY, MAX_QUEUED_IMAGES, IMAGE_TIMEOUT
+    global _memory_cache, _disk_cache
+    config = app['config'].get('chatlog', {})
+    RENDER_WORKERS = config.get('render_workers', RENDER_WORKERS)
+    MAX_PENDING_RENDERS = config.get('max_pending_renders', RENDER_WORKERS * 2)
+    RENDER_WORKER_MAX_JOBS = config.get('render_worker_max_jobs', RENDER_WORKER_MAX_JOBS)
+    WKHTMLTOIMAGE = config.get('wkhtmltoimage', WKHTMLTOIMAGE)
+    IMAGE_CONCURRENCY = config.get('image_concurrency', IMAGE_CONCURRENCY)
+    MAX_QUEUED_IMAGES = config.get('max_queued_images', MAX_QUEUED_IMAGES)
+    IMAGE_TIMEOUT = config.get('image_timeout', IMAGE_TIMEOUT)
+    if 'memory_cache_max_bytes' in config:
+        _memory_cache = MemoryCacheBackend(
+            max_items=1_000,
+            max_bytes=config['memory_cache_max_bytes'],
+        )
+    if config.get('cache_directory'):
+        _disk_cache = DiskCacheBackend(
+            config['cache_directory'],
+            max_bytes=config.get('cache_max_bytes', 1024 * 1024 * 1024),
+        )
+    app.on_cleanup.append(_stop_chatlog_renderer)
@@ -0,0 +1,110 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+from typing import Any, Callable
+
+from aiohttp.web import Application
+from discord.ext import vbu
+
+__all__ = (
+    'add_db_listener',
+    'setup_db_listeners',
+)
+
+log = logging.getLogger("vbu.voxelfox.db_listeners")
+
+
+RECONNECT_DELAY = 5  # Seconds to wait before reconnecting a dropped listener
+
+DBListener = Callable[[str | None], Any]
+_listeners: dict[str, list[DBListener]] = {}
+
+
+def add_db_listener(channel: str, callback: DBListener) -> None:
+    """
+    Call a function whenever a Postgres ``NOTIFY`` is sent on the given
+    channel by any process.
+
+    Parameters
+    ----------
+    channel : str
+        The channel to listen on.
+    callback : Callable[[str | None], Any]
+        The function to call. This is given the payload of the notification,
+        or ``None`` when the listener has (re)connected - notifications may
+        have been missed, so anything relying on them should do a full
+        refresh. If a coroutine is returned it's run as a task.
+    """
+
+    _listeners.setdefault(channel, []).append(callback)
+
+
+def _call_listeners(channel: str, payload: str | None) -> None:
+    for callback in _listeners.get(channel, ()):
+        try:
+            ret = callback(payload)
+            if asyncio.iscoroutine(ret):
+                asyncio.create_task(ret)
+        except Exception:
+            log.error(f"Failed to run listener for {channel}", exc_info=True)
+
+
+def _on_notification(_conn: Any, _pid: int, channel: str, payload: str) -> None:
+    _call_listeners(channel, payload)
+
+
+async def _listen_forever() -> None:
+    """
+    Hold a connection open that listens on every registered channel,
+    reconnecting if it drops.
+    """
+
+    while True:
+        db: vbu.Database | None = None
+        try:
+            db = await vbu.Database.get_connection()
+            closed = asyncio.Event()
+            db.conn.add_termination_listener(lambda _: closed.set())
+            for channel in _listeners:
+                await db.conn.add_listener(channel, _on_notification)
+            log.info(f"Listening for database notifications on {list(_listeners)}")
+            for channel in _listeners:
+                _call_listeners(channel, None)
+            await closed.wait()
+            log.warning("Database listener connection closed")
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            log.error("Database listener failed", exc_info=True)
+        finally:
+            if db is not None:
+                try:
+                    await db.disconnect()
+                except Exception:
+                    pass
+        await asyncio.sleep(RECONNECT_DELAY)
+
+
+async def _start_db_listeners(app: Application) -> None:
+    if not _listeners or not app["config"].get("database", {}).get("enabled", False):
+        return
+    app["db_listener"] = asyncio.create_task(_listen_forever())
+
+
+async def _stop_db_listeners(app: Application) -> None:
+    task = app.get("db_listener")
+    if task is not None:
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+
+def setup_db_listeners(app: Application) -> None:
+    """
+    Register the database listener on the given application. Listeners
+    should be added with :func:`add_db_listener` before the application
+    starts. Nothing is listened to if the database isn't enabled.
+    """
+
+    app.on_startup.append(_start_db_listeners)
+    app.on_cleanup.append(_stop_db_listeners)
@@ -6,10 +6,12 @@ from typing import Any, Optional, overload
 from typing_extensions import Self
 import uuid
 
-import aiohttp
 from discord.ext import vbu
 
+from .cache import entitlement_tags, invalidate_cache_tags_on_commit
 from .flags import RequiredLogins
+from .prices import get_prices
+from .purchase_events import record_purchase_event
 
 __all__ = (
     'User',
@@ -513,9 +515,34 @@ class CheckoutItem:
             return self._cancel_url
         return f"https://voxelfox.co.uk/portal/{self.product_group}"
 
+    @property
+    def _price_key(self) -> tuple[str | None, str]:
+        return (self.user.stripe_id if self.user else None, self.stripe_price_id,)
+
+    def _set_price(self, price_data: dict[str, Any] | None) -> str:
+        """
+        Set the price attributes from some price data returned by Stripe.
+        """
+
+        if price_data:
+            self.price = f"{price_data['unit_amount'] / 100:.2f}"
+            self.price_number = price_data['unit_amount']
+            self.currency_code = price_data['currency'].upper()
+            self._currency_symbol = None
+        else:
+            self.price = "0.00"
+            self.price_number = 0
+            self.currency_code = "GBP"
+            self._currency_symbol = None
+
+        if self.subscription:
+            self.price = f"{self.price} per month"
+        return self.price
+
     async def fetch_price(self, stripe_api_key: str) -> str:
         """
-        Fetches the price of the item from Stripe.
+        Fetches the price of the item from Stripe. Prices are cached, so this
+        won't always talk to Stripe.
 
         Parameters
         ----------
@@ -531,30 +558,31 @@ class CheckoutItem:
 
         if self.price is not None:
             return self.price
+        prices = await get_prices(stripe_api_key, [self._price_key])
+        return self._set_price(prices[self._price_key])
 
-        async with aiohttp.ClientSession() as session:
-            url = f"https://api.stripe.com/v1/prices/{self.stripe_price_id}"
-            auth = aiohttp.BasicAuth(stripe_api_key)
-            headers = {}
-            if self.user and self.user.stripe_id:
-                headers['Stripe-Account'] = self.user.stripe_id
-            resp = await session.get(url, auth=auth, headers=headers)
-            product_data = await resp.json()
-
-        if resp.ok:
-            self.price = f"{product_data['unit_amount'] / 100:.2f}"
-            self.price_number = product_data['unit_amount']
-            self.currency_code = product_data['currency'].upper()
-            self._currency_symbol = None
-        else:
-            self.price = "0.00"
-            self.price_number = 0
-            self.currency_code = "GBP"
-            self._currency_symbol = None
+    @staticmethod
+    async def fetch_prices(
+            items: list[CheckoutItem],
+            stripe_api_key: str) -> None:
+        """
+        Fetch the prices of many items at once. Any prices that aren't cached
+        are fetched from Stripe concurrently.
 
-        if self.subscription:
-            self.price = f"{self.price} per month"
-        return self.price
+        Parameters
+        ----------
+        items : list[CheckoutItem]
+            The items to fetch the prices for. Their users should have been
+            fetched already.
+        stripe_api_key : str
+            The API key associated with the account you're fetching the
+            prices from.
+        """
+
+        items = [i for i in items if i.price is None]
+        prices = await get_prices(stripe_api_key, (i._price_key for i in items))
+        for i in items:
+            i._set_price(prices[i._price_key])
 
     @classmethod
     def from_row(cls, row: dict) -> Self:
@@ -670,6 +698,96 @@ class CheckoutItem:
             return None
         return cls.from_row(item_rows[0])
 
+    @classmethod
+    async def fetch_by_stripe_product_ids(
+            cls,
+            db: vbu.Database,
+            ids: list[str]) -> list[Self]:
+        """
+        Get all of the checkout items from the database that match any of
+        the given Stripe product IDs.
+
+        Parameters
+        ----------
+        db : vbu.Database
+            An open database instance.
+        ids : list[str]
+            The product IDs.
+
+        Returns
+        -------
+        list[Self]
+            The fetched checkout item instances. Product IDs that don't exist
+            in the database are ignored.
+        """
+
+        item_rows = await db.call(
+            """
+            SELECT
+                *
+            FROM
+                checkout_items
+            WHERE
+                stripe_product_id = ANY($1)
+            """,
+            list(set(ids)),
+        )
+        return [cls.from_row(i) for i in item_rows]
+
+    @classmethod
+    async def fetch_group(
+            cls,
+            db: vbu.Database,
+            product_group: str) -> list[Self]:
+        """
+        Get all of the checkout items in a product group, along with the
+        users who created them.
+
+        Parameters
+        ----------
+        db : vbu.Database
+            An open database instance.
+        product_group : str
+            The name of the group. This is case insensitive.
+
+        Returns
+        -------
+        list[Self]
+            The fetched checkout item instances, with their ``user``
+            attribute set.
+        """
+
+        item_rows = await db.call(
+            """
+            SELECT
+                checkout_items.*,
+                manager_users.stripe_id AS manager_stripe_id,
+                manager_users.paypal_id AS manager_paypal_id,
+                manager_users.paypal_client_id AS manager_paypal_client_id,
+                manager_users.paypal_client_secret AS manager_paypal_client_secret
+            FROM
+                checkout_items
+            LEFT JOIN
+                manager_users
+                ON checkout_items.creator_id = manager_users.id
+            WHERE
+                LOWER(checkout_items.product_group) = LOWER($1)
+            """,
+            product_group,
+        )
+        items = []
+        for row in item_rows:
+            item = cls.from_row(row)
+            item.user = ManagerUser(
+                id=row['creator_id'],
+                stripe_id=row['manager_stripe_id'],
+                paypal_id=row['manager_paypal_id'],
+                paypal_client_id=row['manager_paypal_client_id'],
+                paypal_client_secret=row['manager_paypal_client_secret'],
+            )
+            items.append(item)
+        return items
+
     @classmethod
     async def fetch_by_name(
             cls,
@@ -985,12 +1103,60 @@ class Purchase:
             for r in rows
         ]
 
+    @classmethod
+    async def fetch_active_by_user(
+            cls,
+            db: vbu.Database,
+            user: User,
+            products: list[CheckoutItem]) -> list[Self]:
+        """
+        Fetch a user's unexpired purchases of any of the given products.
+
+        Parameters
+        ----------
+        db : vbu.Database
+            An open database connection.
+        user : User
+            The user who purchased the items.
+        products : list[CheckoutItem]
+            The items to get purchases of. Each purchase's ``_item`` is set
+            to the matching item.
+        """
+
+        if not products:
+            return []
+        rows = await db.call(
+            """
+            SELECT
+                *
+            FROM
+                purchases
+            WHERE
+                user_id = $1
+                AND product_id = ANY($2::UUID[])
+                AND (
+                    expiry_time IS NULL
+                    OR expiry_time > TIMEZONE('UTC', NOW())
+                )
+            ORDER BY
+                timestamp DESC
+            """,
+            user.id,
+            [i.id for i in products],
+        )
+        items = {i.id: i for i in products}
+        purchases = [cls.from_row(r) for r in rows]
+        for i in purchases:
+            i._item = items[i.product_id]
+        return purchases
+
     async def delete(self, db: vbu.Database) -> None:
         """
         Delete this purchase from the database.
         """
 
         await self.update_by_id(db, self.id, delete=True)
+        await self._changed(db, "delete")
 
     @staticmethod
     async def update_by_id(
@@ -1063,6 +1229,10 @@ class Purchase:
             self.id,
             *kwargs.values(),
         )
+        old_guild_id = self.discord_guild_id
+        for key, value in kwargs.items():
+            setattr(self, key, value)
+        await self._changed(db, "update", guild_ids=[old_guild_id])
 
     @classmethod
     async def create(
@@ -1155,7 +1325,58 @@ class Purchase:
             identifier,  # identifier
             quantity,  # quantity
         )
-        return Purchase.from_row(added_rows[0])
+        purchase = Purchase.from_row(added_rows[0])
+        await purchase._changed(db, "create", user=user, product=product)
+        return purchase
+
+    async def _changed(
+            self,
+            db: vbu.Database,
+            event: str,
+            *,
+            user: User | None = None,
+            product: CheckoutItem | None = None,
+            guild_ids: list[int | None] | None = None) -> None:
+        """
+        Remove any cached entitlement checks that a change to this purchase
+        would affect, and send the change to the purchase event feed. Both
+        happen once the given connection's transaction commits.
+
+        Parameters
+        ----------
+        db : vbu.Database
+            An open database connection.
+        event : str
+            The type of change - ``"create"``, ``"update"`` or ``"delete"``.
+        user : User | None
+            The user who owns the purchase. Fetched if not given.
+        product : CheckoutItem | None
+            The product that was purchased. Fetched if not given.
+        guild_ids : list[int | None] | None
+            Any guild IDs that the purchase has been moved to or from,
+            besides its current one.
+        """
+
+        if user is None:
+            user = await User.fetch(db, id=self.user_id)
+        if product is None:
+            product = self._item or await CheckoutItem.fetch(db, self.product_id)
+        identities: list[tuple[str, Any]] = [
+            ("guild", guild_id)
+            for guild_id in {self.discord_guild_id, *(guild_ids or [])}
+        ]
+        if user is not None:
+            identities.extend([
+                ("vfl", user.id),
+                ("discord", user.discord_user_id),
+                ("google", user.google_user_id),
+                ("facebook", user.facebook_user_id),
+            ])
+        product_ids = [self.product_id]
+        if product is not None:
+            product_ids.append(product.base_product_id)
+        await invalidate_cache_tags_on_commit(db, *entitlement_tags(identities, product_ids))
+        await record_purchase_event(db, event, self, user, product)
 
     async def fetch_product(self, db: vbu.Database) -> CheckoutItem:
         """
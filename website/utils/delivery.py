@@ -0,0 +1,331 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+from typing import Any
+import uuid
+
+from aiohttp.web import Application
+from discord.ext import vbu
+
+from .db_models import CheckoutItem
+from .webhook_util import send_webhook, send_sql
+
+__all__ = (
+    'enqueue_delivery',
+    'wake_delivery_workers',
+    'start_delivery_workers',
+    'stop_delivery_workers',
+    'setup_delivery_workers',
+)
+
+log = logging.getLogger("vbu.voxelfox.delivery")
+
+
+WORKER_COUNT = 4  # Number of tasks pulling from the outbox
+BATCH_SIZE = 20  # Max deliveries claimed by a worker at once
+DESTINATION_CONCURRENCY = 2  # Max in-flight deliveries per destination
+MAX_ATTEMPTS = 10  # Attempts before a delivery is marked as failed
+MAX_BACKOFF = 60 * 60  # Max seconds between attempts
+CLAIM_LEASE = 60 * 5  # Seconds before a claimed delivery can be retried
+CLAIM_RENEW_INTERVAL = 60  # Seconds between extending the lease on deliveries still being sent
+DELIVERY_TIMEOUT = 30  # Max seconds a single webhook or SQL delivery can take
+POLL_INTERVAL = 30  # Seconds between outbox checks when idle
+
+_wakeup = asyncio.Event()
+_workers: list[asyncio.Task] = []
+_destination_locks: dict[str, asyncio.Semaphore] = {}
+
+
+async def enqueue_delivery(
+        db: vbu.Database,
+        item: CheckoutItem,
+        data: dict[str, Any]) -> None:
+    """
+    Store the webhook and SQL deliveries for an item in the outbox. These
+    will be sent by the delivery workers once the given database connection
+    has committed; call :func:`wake_delivery_workers` after that happens.
+
+    Parameters
+    ----------
+    db : vbu.Database
+        An open database connection. This can be inside of a transaction so
+        that the deliveries are stored alongside the purchase.
+    item : CheckoutItem
+        The item that the delivery is for.
+    data : dict[str, Any]
+        The payload to send.
+    """
+
+    kinds: list[str] = []
+    if item.webhook:
+        kinds.append("webhook")
+    if item.dsn and item.sql:
+        kinds.append("sql")
+    if not kinds:
+        log.info(f"No deliveries found for item {item} {data}")
+        return
+    for kind in kinds:
+        log.info(f"Queueing {kind} delivery for {item} {data}")
+        await db.call(
+            """
+            INSERT INTO
+                delivery_outbox
+                (
+                    product_id,
+                    kind,
+                    payload
+                )
+            VALUES
+                (
+                    $1,
+                    $2,
+                    $3::JSONB
+                )
+            """,
+            item.id,
+            kind,
+            json.dumps(data),
+        )
+
+
+def wake_delivery_workers() -> None:
+    """
+    Tell the delivery workers that there's something new in the outbox,
+    starting them if they aren't running already.
+    """
+
+    if not _workers:
+        start_delivery_workers()
+    _wakeup.set()
+
+
+def start_delivery_workers() -> None:
+    """
+    Start the tasks that send deliveries from the outbox.
+    """
+
+    if _workers:
+        return
+    for _ in range(WORKER_COUNT):
+        _workers.append(asyncio.create_task(_delivery_worker()))
+
+
+async def _start_delivery_workers(app: Application) -> None:
+    if not app["config"].get("database", {}).get("enabled", False):
+        return
+    start_delivery_workers()
+
+
+async def stop_delivery_workers(_: Application | None = None) -> None:
+    """
+    Stop the delivery workers. Anything that they'd claimed but not sent is
+    left in the outbox and will be retried after its lease expires.
+    """
+
+    for task in _workers:
+        task.cancel()
+    await asyncio.gather(*_workers, return_exceptions=True)
+    _workers.clear()
+
+
+def setup_delivery_workers(app: Application) -> None:
+    """
+    Register the delivery workers on the given application so that they're
+    started on startup (sending anything left over in the outbox) and
+    stopped on cleanup. They aren't started if the database isn't enabled.
+    """
+
+    app.on_startup.append(_start_delivery_workers)
+    app.on_cleanup.append(stop_delivery_workers)
+
+
+async def _claim_deliveries(db: vbu.Database, claim_id: uuid.UUID) -> list[dict[str, Any]]:
+    """
+    Claim a batch of due deliveries from the outbox. Claimed rows are pushed
+    back by the lease time so that other workers (in this process or
+    another) skip them, and are marked with the given claim ID so that
+    they're only updated by this worker while the claim is held.
+    """
+
+    return await db.call(
+        """
+        UPDATE
+            delivery_outbox
+        SET
+            next_attempt_at = TIMEZONE('UTC', NOW()) + MAKE_INTERVAL(secs => $2),
+            claim_id = $3
+        WHERE
+            id IN (
+                SELECT
+                    id
+                FROM
+                    delivery_outbox
+                WHERE
+                    failed = FALSE
+                AND
+                    next_attempt_at <= TIMEZONE('UTC', NOW())
+                ORDER BY
+                    next_attempt_at
+                LIMIT $1
+                FOR UPDATE SKIP LOCKED
+            )
+        RETURNING
+            *
+        """,
+        BATCH_SIZE,
+        CLAIM_LEASE,
+        claim_id,
+    )
+
+
+async def _renew_claim(claim_id: uuid.UUID) -> None:
+    """
+    Keep pushing back the lease on a claimed batch's deliveries that
+    haven't been finished yet, so that they aren't picked up by another
+    worker while they're still being sent.
+    """
+
+    while True:
+        await asyncio.sleep(CLAIM_RENEW_INTERVAL)
+        try:
+            async with vbu.Database() as db:
+                await db.call(
+                    """
+                    UPDATE
+                        delivery_outbox
+                    SET
+                        next_attempt_at = TIMEZONE('UTC', NOW()) + MAKE_INTERVAL(secs => $2)
+                    WHERE
+                        claim_id = $1
+                    """,
+                    claim_id,
+                    CLAIM_LEASE,
+                )
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            log.warning("Failed to renew delivery claim", exc_info=True)
+
+
+async def _deliver(row: dict[str, Any], item: CheckoutItem | None) -> None:
+    """
+    Send a single delivery, and update the outbox based on the result.
+    """
+
+    # Send the delivery
+    error: str | None = None
+    if item is None:
+        error = "Product no longer exists."
+    else:
+        payload = row['payload']
+        if isinstance(payload, str):
+            payload = json.loads(payload)
+        if row['kind'] == "webhook":
+            destination = f"webhook:{item.webhook}"
+            sender = send_webhook
+        else:
+            destination = f"sql:{item.dsn}"
+            sender = send_sql
+        lock = _destination_locks.setdefault(
+            destination,
+            asyncio.Semaphore(DESTINATION_CONCURRENCY),
+        )
+        try:
+            async with lock:
+                await asyncio.wait_for(sender(item, payload), DELIVERY_TIMEOUT)
+        except Exception as e:
+            error = f"{e.__class__.__name__}: {e}"
+
+    # Update the outbox, as long as the delivery hasn't been claimed by
+    # another worker since
+    async with vbu.Database() as db:
+        if error is None:
+            deleted = await db.call(
+                """DELETE FROM delivery_outbox WHERE id = $1 AND claim_id = $2 RETURNING id""",
+                row['id'],
+                row['claim_id'],
+            )
+            if not deleted:
+                log.warning(f"Delivery {row['id']} was sent after its claim was lost")
+            return
+        attempts = row['attempts'] + 1
+        failed = attempts >= MAX_ATTEMPTS
+        if failed:
+            log.error(f"Giving up on delivery {row['id']} after {attempts} attempts ({error})")
+        else:
+            log.warning(f"Delivery {row['id']} failed on attempt {attempts} ({error})")
+        updated = await db.call(
+            """
+            UPDATE
+                delivery_outbox
+            SET
+                attempts = $3,
+                last_error = $4,
+                failed = $5,
+                next_attempt_at = TIMEZONE('UTC', NOW()) + MAKE_INTERVAL(secs => $6),
+                claim_id = NULL
+            WHERE
+                id = $1
+            AND
+                claim_id = $2
+            RETURNING
+                id
+            """,
+            row['id'],
+            row['claim_id'],
+            attempts,
+            error,
+            failed,
+            min(2 ** attempts, MAX_BACKOFF),
+        )
+        if not updated:
+            log.warning(f"Delivery {row['id']} failed after its claim was lost")
+
+
+async def _delivery_worker() -> None:
+    """
+    Pull deliveries from the outbox and send them, forever.
+    """
+
+    while True:
+        _wakeup.clear()
+        claim_id = uuid.uuid4()
+        try:
+            async with vbu.Database() as db:
+                rows = await _claim_deliveries(db, claim_id)
+                item_rows = await db.call(
+                    """SELECT * FROM checkout_items WHERE id = ANY($1)""",
+                    list({str(r['product_id']) for r in rows}),
+                ) if rows else []
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            log.error("Failed to claim deliveries", exc_info=True)
+            rows = []
+
+        # Nothing to do - wait until we're told there is
+        if not rows:
+            try:
+                await asyncio.wait_for(_wakeup.wait(), timeout=POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            continue
+
+        # Send what we claimed
+        items = {
+            i.id: i
+            for i in (CheckoutItem.from_row(r) for r in item_rows)
+        }
+        renewer = asyncio.create_task(_renew_claim(claim_id))
+        try:
+            await asyncio.gather(
+                *(
+                    _deliver(r, items.get(str(r['product_id'])))
+                    for r in rows
+                ),
+                return_exceptions=True,
+            )
+        finally:
+            renewer.cancel()
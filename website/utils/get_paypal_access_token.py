@@ -4,6 +4,8 @@ import aiohttp
 from aiohttp.web import Request
 from discord.ext import vbu
 
+from .http_sessions import get_session
+
 __all__ = (
     'get_paypal_basicauth',
     'get_paypal_access_token',
@@ -50,11 +52,10 @@ async def get_paypal_access_token(request: Request) -> str:
 
     # Grab a new token from PayPal
     auth = await get_paypal_basicauth()
-    async with aiohttp.ClientSession() as session:
-        url = PAYPAL_BASE + "/v1/oauth2/token"
-        data = {"grant_type": "client_credentials"}
-        async with session.post(url, data=data, auth=auth) as r:
-            response = await r.json()
+    url = PAYPAL_BASE + "/v1/oauth2/token"
+    data = {"grant_type": "client_credentials"}
+    async with get_session("paypal").post(url, data=data, auth=auth) as r:
+        response = await r.json()
     PAYPAL_TOKEN_CACHE.update(response)
     PAYPAL_TOKEN_CACHE.update({
         "expires_at": dt.utcnow() + timedelta(seconds=response.get('expires_in', 60))
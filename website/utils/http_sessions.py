@@ -0,0 +1,92 @@
+from __future__ import annotations
+
+import logging
+from typing import Any
+
+import aiohttp
+from aiohttp.web import Application
+
+__all__ = (
+    'get_session',
+    'setup_sessions',
+    'close_sessions',
+)
+
+log = logging.getLogger("vbu.voxelfox.http_sessions")
+
+
+# The maximum number of open connections to a single host for each of the
+# providers that we talk to
+PROVIDER_LIMITS: dict[str, int] = {
+    "default": 20,
+    "stripe": 20,
+    "paypal": 10,
+    "discord": 10,
+    "google": 5,
+    "webhook": 10,
+}
+# The maximum number of seconds that a request to a provider can take, for
+# the providers that need one shorter than aiohttp's default
+PROVIDER_TIMEOUTS: dict[str, float] = {
+    "webhook": 30,
+}
+SESSIONS: dict[str, aiohttp.ClientSession] = {}
+
+
+def get_session(provider: str = "default") -> aiohttp.ClientSession:
+    """
+    Get the shared client session for a given provider, creating it if one
+    hasn't been made yet. The returned session should *not* be closed by the
+    caller.
+
+    Parameters
+    ----------
+    provider : str
+        The name of the provider that the session will be talking to.
+
+    Returns
+    -------
+    aiohttp.ClientSession
+        A session with keep-alive connections to the provider.
+    """
+
+    session = SESSIONS.get(provider)
+    if session is None or session.closed:
+        connector = aiohttp.TCPConnector(
+            limit_per_host=PROVIDER_LIMITS.get(provider, PROVIDER_LIMITS["default"]),
+            ttl_dns_cache=300,
+            keepalive_timeout=30,
+        )
+        kwargs: dict[str, Any] = {}
+        if provider in PROVIDER_TIMEOUTS:
+            kwargs["timeout"] = aiohttp.ClientTimeout(total=PROVIDER_TIMEOUTS[provider])
+        session = aiohttp.ClientSession(connector=connector, **kwargs)
+        SESSIONS[provider] = session
+    return session
+
+
+async def _start_sessions(_: Application) -> None:
+    for provider in PROVIDER_LIMITS:
+        get_session(provider)
+
+
+async def close_sessions(_: Application | None = None) -> None:
+    """
+    Close all of the shared client sessions.
+    """
+
+    for provider, session in list(SESSIONS.items()):
+        log.info("Closing HTTP session for provider %s", provider)
+        await session.close()
+    SESSIONS.clear()
+
+
+def setup_sessions(app: Application) -> None:
+    """
+    Register the shared client sessions on the given application so that
+    they're opened on startup and closed on cleanup.
+    """
+
+    app["http_sessions"] = SESSIONS
+    app.on_startup.append(_start_sessions)
+    app.on_cleanup.append(close_sessions)
@@ -0,0 +1,533 @@
+from __future__ import annotations
+
+import copy
+from datetime import datetime as dt, timedelta, timezone
+from functools import lru_cache
+import re
+from typing import Iterator, Literal
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+import ics
+
+__all__ = (
+    'RawEvent',
+    'RawCalendar',
+    'calendar_names_are_similar',
+    'filter_calendar_sync',
+)
+
+
+# The value of a content line, after its name and (possibly quoted) params
+PROPERTY_VALUE_REGEX = re.compile(r'[^:"]*(?:"[^"]*"[^:"]*)*:(.*)', re.DOTALL)
+TEXT_ESCAPE_REGEX = re.compile(r"\\(.)")
+TEXT_ESCAPES = {"n": "\n", "N": "\n"}
+TZID_REGEX = re.compile(r';TZID=("[^"]*"|[^;:]*)', re.IGNORECASE)
+DURATION_REGEX = re.compile(
+    r"([+-])?P(?:(\d+)W)?(?:(\d+)D)?(?:T(?:(\d+)H)?(?:(\d+)M)?(?:(\d+)S)?)?",
+    re.IGNORECASE,
+)
+TRACKED_PROPERTIES = (
+    "SUMMARY:", "SUMMARY;",
+    "DTSTART:", "DTSTART;",
+    "DTEND:", "DTEND;",
+    "DURATION:", "DURATION;",
+)
+MERGE_REPLACED_PROPERTIES = {"SUMMARY", "DESCRIPTION", "DTEND", "DURATION"}
+MAX_LINE_OCTETS = 75
+
+SHIFT_NAME_REGEX = re.compile(r"(.+) \((.+)\)")
+UNIVERSAL_SHIFTS = frozenset(["Meeting", "Auditorium Turnaround", "Training"])
+TECH_SHIFTS = frozenset(["Tech", "Tech projection", "Tech Usher", "Followspot", "Outside Steward"])
+DM_SHIFTS = frozenset(["Duty Manager"])
+TECH_OR_UNIVERSAL_SHIFTS = TECH_SHIFTS | UNIVERSAL_SHIFTS
+DM_OR_UNIVERSAL_SHIFTS = DM_SHIFTS | UNIVERSAL_SHIFTS
+TECH_OR_DM_SHIFTS = TECH_SHIFTS | DM_SHIFTS
+
+
+class RawEvent:
+    """
+    A single VEVENT from a calendar feed, kept as its original lines. Only
+    its summary and the (unfolded) lines of its times are read.
+    """
+
+    __slots__ = (
+        'lines',
+        'summary',
+        'times',
+    )
+
+    def __init__(self, lines: list[str], summary: str, times: dict[str, str] | None = None):
+        self.lines = lines
+        self.summary = summary
+        self.times = times or {}
+
+    @classmethod
+    def from_properties(cls, lines: list[str], properties: dict[str, list[str]]) -> RawEvent:
+        summary = ""
+        if "SUMMARY" in properties:
+            summary = _unescape(_split_property("".join(properties.pop("SUMMARY")))[1])
+        return cls(
+            lines,
+            summary,
+            {name: "".join(parts) for name, parts in properties.items()},
+        )
+
+    def span(self) -> tuple[dt, dt, bool] | None:
+        """
+        Get the start and end of the event, and whether it's all day.
+        Returns ``None`` if its times can't be read without the calendar's
+        own timezone definitions.
+        """
+
+        start = self.times.get("DTSTART")
+        begin = _parse_time(start) if start else None
+        if begin is None:
+            return None
+        begin_time, all_day = begin
+        if "DTEND" in self.times:
+            end = _parse_time(self.times["DTEND"])
+            if end is None:
+                return None
+            return begin_time, end[0], all_day
+        if "DURATION" in self.times:
+            duration = _parse_duration(_split_property(self.times["DURATION"])[1])
+            if duration is None:
+                return None
+            return begin_time, begin_time + duration, all_day
+        return begin_time, begin_time + timedelta(days=1) if all_day else begin_time, all_day
+
+
+class RawCalendar:
+    """
+    A calendar feed split into its events and everything around them,
+    without parsing the events' contents beyond their summary.
+    """
+
+    __slots__ = (
+        'header',
+        'events',
+        'footer',
+    )
+
+    def __init__(self, header: list[str], events: list[RawEvent], footer: list[str]):
+        self.header = header
+        self.events = events
+        self.footer = footer
+
+    @classmethod
+    def parse(cls, text: str) -> RawCalendar:
+        """
+        Split an ICS feed into its events. Only the summary and times of
+        each event are read; the properties of components nested inside an
+        event (like alarms) are ignored.
+        """
+
+        header: list[str] = []
+        events: list[RawEvent] = []
+        footer: list[str] = []
+        current: list[str] | None = None
+        properties: dict[str, list[str]] = {}
+        collecting: list[str] | None = None
+        depth = 0  # Components open inside the current event
+        for line in text.splitlines():
+            if not line:
+                continue
+
+            # Folded lines continue whatever came before them
+            if line[0] in " \t":
+                if current is not None:
+                    current.append(line)
+                    if collecting is not None:
+                        collecting.append(line[1:])
+                elif footer:
+                    footer.append(line)
+                else:
+                    header.append(line)
+                continue
+            collecting = None
+
+            # Work out where the line goes
+            upper = line[:12].upper()
+            if current is None:
+                if upper.startswith("BEGIN:VEVENT"):
+                    current = [line]
+                    properties = {}
+                    depth = 0
+                elif upper.startswith("END:VCALENDA") or footer:
+                    footer.append(line)
+                else:
+                    header.append(line)
+                continue
+            current.append(line)
+            if upper.startswith("BEGIN:"):
+                depth += 1
+            elif depth:
+                if upper.startswith("END:"):
+                    depth -= 1
+            elif upper.startswith("END:VEVENT"):
+                events.append(RawEvent.from_properties(current, properties))
+                current = None
+            elif upper.startswith(TRACKED_PROPERTIES):
+                name = upper.split(":", 1)[0].split(";", 1)[0]
+                collecting = properties[name] = [line]
+        return cls(header, events, footer)
+
+    def serialize(self, events: list[RawEvent] | None = None) -> str:
+        """
+        Join the calendar back into a feed, optionally with only the given
+        events.
+        """
+
+        lines = list(self.header)
+        for event in (self.events if events is None else events):
+            lines.extend(event.lines)
+        lines.extend(self.footer)
+        return "\r\n".join(lines) + "\r\n"
+
+
+def _unescape(value: str) -> str:
+    return TEXT_ESCAPE_REGEX.sub(lambda m: TEXT_ESCAPES.get(m.group(1), m.group(1)), value)
+
+
+def _escape(value: str) -> str:
+    return (
+        value
+        .replace("\\", "\\\\")
+        .replace(";", "\\;")
+        .replace(",", "\\,")
+        .replace("\r\n", "\\n")
+        .replace("\n", "\\n")
+    )
+
+
+def _split_property(line: str) -> tuple[str, str]:
+    """
+    Split an unfolded content line into its name (with any params) and its
+    value.
+    """
+
+    match = PROPERTY_VALUE_REGEX.match(line)
+    if match is None:
+        return line, ""
+    return line[:match.start(1) - 1], match.group(1)
+
+
+def _property_name(line: str) -> str:
+    return _split_property(line)[0].split(";", 1)[0].upper()
+
+
+def _unfold(lines: list[str]) -> list[str]:
+    unfolded: list[str] = []
+    for line in lines:
+        if line[0] in " \t" and unfolded:
+            unfolded[-1] += line[1:]
+        else:
+            unfolded.append(line)
+    return unfolded
+
+
+def _event_body(lines: list[str]) -> Iterator[tuple[str, bool]]:
+    """
+    Get the unfolded lines between an event's BEGIN and END lines, and
+    whether each is one of the event's own properties rather than part of a
+    nested component.
+    """
+
+    depth = 0
+    for line in _unfold(lines)[1:-1]:
+        upper = line[:6].upper()
+        if upper.startswith("BEGIN:"):
+            depth += 1
+            yield line, False
+        elif upper.startswith("END:"):
+            depth -= 1
+            yield line, False
+        else:
+            yield line, depth == 0
+
+
+def _fold(line: str) -> list[str]:
+    """
+    Split a content line so that no physical line is longer than 75 octets.
+    """
+
+    if len(line.encode()) <= MAX_LINE_OCTETS:
+        return [line]
+    lines: list[str] = []
+    current = ""
+    size = 0
+    for char in line:
+        char_size = len(char.encode())
+        if size + char_size > MAX_LINE_OCTETS:
+            lines.append(current)
+            current = " "
+            size = 1
+        current += char
+        size += char_size
+    lines.append(current)
+    return lines
+
+
+def _parse_time(line: str) -> tuple[dt, bool] | None:
+    """
+    Read a DTSTART or DTEND line as an aware datetime, and whether it's a
+    date. Floating times are read as UTC. Returns ``None`` if its timezone
+    isn't one that we know about.
+    """
+
+    params, value = _split_property(line)
+    value = value.strip()
+    try:
+        if "T" not in value:
+            return dt.strptime(value, "%Y%m%d").replace(tzinfo=timezone.utc), True
+        if value.endswith(("Z", "z")):
+            return dt.strptime(value[:-1], "%Y%m%dT%H%M%S").replace(tzinfo=timezone.utc), False
+        moment = dt.strptime(value, "%Y%m%dT%H%M%S")
+    except ValueError:
+        return None
+    tzid = TZID_REGEX.search(params)
+    if tzid is None:
+        return moment.replace(tzinfo=timezone.utc), False
+    try:
+        zone = ZoneInfo(tzid.group(1).strip('"'))
+    except (ZoneInfoNotFoundError, ValueError):
+        return None
+    return moment.replace(tzinfo=zone), False
+
+
+def _parse_duration(value: str) -> timedelta | None:
+    match = DURATION_REGEX.fullmatch(value.strip())
+    if match is None:
+        return None
+    sign, weeks, days, hours, minutes, seconds = match.groups()
+    duration = timedelta(
+        weeks=int(weeks or 0),
+        days=int(days or 0),
+        hours=int(hours or 0),
+        minutes=int(minutes or 0),
+        seconds=int(seconds or 0),
+    )
+    return -duration if sign == "-" else duration
+
+
+@lru_cache(maxsize=4096)
+def _split_shift_name(name: str) -> tuple[str, tuple[str, ...]] | None:
+    """
+    Split an event name like "Show (Tech, Usher)" into its name and shifts.
+    """
+
+    match = SHIFT_NAME_REGEX.search(name)
+    if match is None:
+        return None
+    return match.group(1), tuple(i.strip() for i in match.group(2).split(","))
+
+
+def calendar_names_are_similar(name1: str, name2: str) -> Literal[False] | str:
+    """
+    Return whether or not two calendar event names are "similar" (mostly according to Dylan's
+    Rotacloud rules)
+    """
+
+    if name1 == name2:
+        return name1
+
+    split1 = _split_shift_name(name1)
+    if split1 is None:
+        return False
+    split2 = _split_shift_name(name2)
+    if split2 is None:
+        return False
+    if split1[0] != split2[0]:
+        return False
+
+    # everything from now will have the same group 1
+
+    shift1 = set(split1[1])
+    shift2 = set(split2[1])
+
+    joined_shift = list(split1[1])
+    for i in split2[1]:
+        if i not in joined_shift:
+            joined_shift.append(i)
+    joined_name = f"{split1[0]} ({', '.join(joined_shift)})"
+
+    if TECH_OR_UNIVERSAL_SHIFTS.intersection(shift1) and TECH_OR_UNIVERSAL_SHIFTS.intersection(shift2):
+        return joined_name
+    if DM_OR_UNIVERSAL_SHIFTS.intersection(shift1) and DM_OR_UNIVERSAL_SHIFTS.intersection(shift2):
+        return joined_name
+    if UNIVERSAL_SHIFTS.intersection(shift1) and TECH_OR_DM_SHIFTS.intersection(shift2):
+        return joined_name
+
+    return False
+
+
+def _merge_events(run: list[RawEvent], name: str, end: dt, all_day: bool) -> RawEvent:
+    """
+    Write a single event covering a run of back-to-back events - the first
+    event with the run's name, all of their descriptions, and the last
+    event's end.
+    """
+
+    descriptions: list[str | None] = []
+    for event in run:
+        description = None
+        for line, top_level in _event_body(event.lines):
+            if top_level and _property_name(line) == "DESCRIPTION":
+                description = _unescape(_split_property(line)[1])
+                break
+        descriptions.append(description)
+    description = (descriptions[0] or "") + "".join(
+        "\n----------\n" + (i or "")
+        for i in descriptions[1:]
+    )
+
+    # Work out the end
+    last = run[-1]
+    if "DTEND" in last.times:
+        end_line = last.times["DTEND"]
+    elif all_day:
+        end_line = f"DTEND;VALUE=DATE:{end:%Y%m%d}"
+    else:
+        end_line = f"DTEND:{end.astimezone(timezone.utc):%Y%m%dT%H%M%SZ}"
+
+    # Rebuild the first event with the new properties, before any nested
+    # components
+    new_lines = [
+        f"SUMMARY:{_escape(name)}",
+        f"DESCRIPTION:{_escape(description)}",
+        end_line,
+    ]
+    lines: list[str] = [run[0].lines[0]]
+    for line, top_level in _event_body(run[0].lines):
+        if not top_level and new_lines:
+            for new_line in new_lines:
+                lines.extend(_fold(new_line))
+            new_lines = []
+        if top_level and _property_name(line) in MERGE_REPLACED_PROPERTIES:
+            continue
+        lines.extend(_fold(line))
+    for new_line in new_lines:
+        lines.extend(_fold(new_line))
+    lines.append("END:VEVENT")
+    times = {
+        key: value
+        for key, value in run[0].times.items()
+        if key not in MERGE_REPLACED_PROPERTIES
+    }
+    times["DTEND"] = end_line
+    return RawEvent(lines, name, times)
+
+
+def _combine_similar_raw(events: list[RawEvent]) -> list[RawEvent] | None:
+    """
+    Combine back-to-back events with similar names, only rewriting the
+    events that are merged. Returns ``None`` if any event's times can't be
+    read without parsing the whole calendar.
+    """
+
+    spans: list[tuple[dt, dt, bool, RawEvent]] = []
+    for event in events:
+        span = event.span()
+        if span is None:
+            return None
+        spans.append((*span, event))
+    spans.sort(key=lambda i: i[0])
+
+    combined: list[RawEvent] = []
+    run: list[RawEvent] = []
+    name = ""
+    end: dt | None = None
+    all_day = False
+    for begin, event_end, event_all_day, event in spans:
+        if run:
+            new_name = calendar_names_are_similar(name, event.summary)
+            if new_name is not False and end == begin:
+                run.append(event)
+                name = new_name
+                end = event_end
+                all_day = event_all_day
+                continue
+            assert end is not None
+            combined.append(run[0] if len(run) == 1 else _merge_events(run, name, end, all_day))
+        run = [event]
+        name = event.summary
+        end = event_end
+        all_day = event_all_day
+    if run:
+        assert end is not None
+        combined.append(run[0] if len(run) == 1 else _merge_events(run, name, end, all_day))
+    return combined
+
+
+def _combine_similar(calendar: ics.Calendar) -> ics.Calendar:
+    """
+    Combine back-to-back events with similar names. The given calendar's
+    events aren't changed. This is only used when an event's times can't be
+    read from its raw lines.
+    """
+
+    new_calendar = ics.Calendar()
+    previous: ics.Event | None = None
+    for event in sorted(calendar.events, key=lambda e: e.begin):
+        if previous is None:
+            previous = copy.copy(event)
+            continue
+        assert previous is not None
+        new_name = calendar_names_are_similar(previous.name, event.name)
+        if new_name is not False and previous.end == event.begin:
+            if not isinstance(previous.description, str):
+                previous.description = ""
+            previous.name = new_name
+            previous.description += "\n----------\n" + (event.description or "")
+            previous.end = event.end
+        else:
+            new_calendar.events.add(previous)
+            previous = copy.copy(event)
+    if previous is not None:
+        new_calendar.events.add(previous)
+    return new_calendar
+
+
+def filter_calendar_sync(
+        calendar: RawCalendar,
+        filters: list[str],
+        combine_similar: bool) -> str:
+    """
+    Filter and serialize a calendar. Events are removed by matching their
+    summaries against all of the filters at once. When combining, events
+    are sorted by their raw start times and only the ones that are merged
+    are rewritten; everything else is passed through as-is. This blocks, so
+    should be run in an executor.
+
+    Parameters
+    ----------
+    calendar : RawCalendar
+        The calendar to filter. This isn't changed.
+    filters : list[str]
+        Casefolded strings to remove events by.
+    combine_similar : bool
+        Whether to combine back-to-back events with similar names.
+
+    Returns
+    -------
+    str
+        The serialized calendar.
+    """
+
+    events = calendar.events
+    if filters:
+        matcher = re.compile("|".join(re.escape(i) for i in filters))
+        events = [
+            i for i in events
+            if not matcher.search(i.summary.casefold())
+        ]
+    if not combine_similar:
+        return calendar.serialize(events)
+    combined = _combine_similar_raw(events)
+    if combined is not None:
+        return calendar.serialize(combined)
+
+    # Some of the times use a timezone that's only defined in the calendar
+    # itself, so let ics work them out
+    parsed = ics.Calendar(calendar.serialize(events))
+    return _combine_similar(parsed).serialize()
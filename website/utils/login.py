@@ -3,7 +3,8 @@ from typing import Callable, Awaitable, Any
 
 from aiohttp.web import Request, StreamResponse, HTTPFound
 import aiohttp_session
-from discord.ext import vbu
+
+from .authorization import is_manager
 
 __all__ = (
     '_require_login_wrapper',
@@ -36,7 +37,8 @@ def requires_login() -> RouteWrapper:
 
 def requires_manager_login(location: str = "/") -> RouteWrapper:
     """
-    Check if the user is in the payment processor users.
+    Check if the user is in the payment processor users. This is cached,
+    and refreshed when the manager users change.
     """
 
     def inner(func: RouteFunc):
@@ -44,20 +46,7 @@ def requires_manager_login(location: str = "/") -> RouteWrapper:
             if (x := await _require_login_wrapper(request)):
                 return x
             session = await aiohttp_session.get_session(request)
-            user_id = session['id']
-            async with vbu.Database() as db:
-                rows = await db.call(
-                    """
-                    SELECT
-                        1
-                    FROM
-                        manager_users
-                    WHERE
-                        login_id = $1
-                    """,
-                    user_id,
-                )
-            if not rows:
+            if not await is_manager(session['id']):
                 return HTTPFound(location)
             return await func(request)
         return wrapper
@@ -0,0 +1,149 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import time
+from typing import Any, Iterable
+
+import aiohttp
+from discord.ext import vbu
+
+from .cache import get_cache_backend, invalidate_cache_tags, invalidate_cache_tags_on_commit
+from .http_sessions import get_session
+
+__all__ = (
+    'get_prices',
+    'invalidate_price',
+)
+
+log = logging.getLogger("vbu.voxelfox.prices")
+
+
+PRICE_FRESH_TTL = 60 * 5  # Seconds before a cached price is refreshed
+PRICE_STALE_TTL = 60 * 60 * 24  # Seconds that a stale price can still be shown
+
+PriceKey = tuple[str | None, str]  # (stripe_account, price_id)
+_in_flight: dict[PriceKey, asyncio.Future[dict[str, Any] | None]] = {}
+
+
+def _cache_key(key: PriceKey) -> str:
+    account, price_id = key
+    return f"stripe-price:{account or ''}:{price_id}"
+
+
+def _cache_tag(price_id: str) -> str:
+    return f"stripe-price:{price_id}"
+
+
+async def _fetch_price(stripe_api_key: str, key: PriceKey) -> dict[str, Any] | None:
+    """
+    Fetch a price from Stripe and store it in the cache.
+    """
+
+    account, price_id = key
+    headers = {}
+    if account:
+        headers['Stripe-Account'] = account
+    try:
+        async with get_session("stripe").get(
+                f"https://api.stripe.com/v1/prices/{price_id}",
+                auth=aiohttp.BasicAuth(stripe_api_key),
+                headers=headers) as resp:
+            price_data = await resp.json()
+            if not resp.ok:
+                log.warning(f"Failed to fetch price {price_id} ({resp.status})")
+                return None
+    except Exception:
+        log.warning(f"Failed to fetch price {price_id}", exc_info=True)
+        return None
+    price = {
+        "unit_amount": price_data['unit_amount'],
+        "currency": price_data['currency'],
+        "fetched_at": time.time(),
+    }
+    try:
+        await get_cache_backend().set(
+            _cache_key(key),
+            json.dumps(price).encode(),
+            PRICE_STALE_TTL,
+            [_cache_tag(price_id)],
+        )
+    except Exception:
+        log.warning("Failed to cache price", exc_info=True)
+    return price
+
+
+def _fetch_price_once(stripe_api_key: str, key: PriceKey) -> asyncio.Future[dict[str, Any] | None]:
+    """
+    Fetch a price from Stripe, sharing the request with anything else that
+    asks for the same price at the same time.
+    """
+
+    future = _in_flight.get(key)
+    if future is None:
+        future = asyncio.ensure_future(_fetch_price(stripe_api_key, key))
+        _in_flight[key] = future
+        future.add_done_callback(lambda _: _in_flight.pop(key, None))
+    return future
+
+
+async def _get_price(stripe_api_key: str, key: PriceKey) -> dict[str, Any] | None:
+    try:
+        cached = await get_cache_backend().get(_cache_key(key))
+    except Exception:
+        log.warning("Failed to read cached price", exc_info=True)
+        cached = None
+    if cached is not None:
+        price = json.loads(cached)
+        if time.time() - price["fetched_at"] > PRICE_FRESH_TTL:
+            _fetch_price_once(stripe_api_key, key)  # Refresh in the background
+        return price
+    return await asyncio.shield(_fetch_price_once(stripe_api_key, key))
+
+
+async def get_prices(
+        stripe_api_key: str,
+        keys: Iterable[PriceKey]) -> dict[PriceKey, dict[str, Any] | None]:
+    """
+    Get a set of prices from Stripe. Prices are cached, and stale prices
+    are returned while they're refreshed in the background. Any prices that
+    aren't cached are fetched concurrently.
+
+    Parameters
+    ----------
+    stripe_api_key : str
+        The API key used to fetch prices.
+    keys : Iterable[tuple[str | None, str]]
+        Pairs of the Stripe account that owns each price (or ``None`` for
+        the platform account) and the price ID.
+
+    Returns
+    -------
+    dict[tuple[str | None, str], dict[str, Any] | None]
+        Each key mapped to its price's ``unit_amount`` and ``currency``, or
+        ``None`` if the price couldn't be fetched.
+    """
+
+    keys = list(set(keys))
+    prices = await asyncio.gather(*(_get_price(stripe_api_key, k) for k in keys))
+    return dict(zip(keys, prices))
+
+
+async def invalidate_price(price_id: str) -> None:
+    """
+    Remove a price from the cache in every worker, so that it's fetched
+    again the next time that it's shown. Other workers are told through the
+    database if it's enabled, and through Redis otherwise.
+    """
+
+    tag = _cache_tag(price_id)
+    if not vbu.Database.enabled:
+        await invalidate_cache_tags(tag)
+        return
+    try:
+        async with vbu.Database() as db:
+            await invalidate_cache_tags_on_commit(db, tag)
+    except Exception:
+        log.warning("Failed to notify workers of a price change", exc_info=True)
+        await invalidate_cache_tags(tag)
@@ -0,0 +1,250 @@
+from __future__ import annotations
+
+import asyncio
+from datetime import timedelta
+import json
+import logging
+from typing import TYPE_CHECKING, Any
+
+from aiohttp.web import Application
+from discord.ext import vbu
+
+from .db_listeners import add_db_listener
+from .json_utils import serialize
+
+if TYPE_CHECKING:
+    from .db_models import CheckoutItem, Purchase, User
+
+__all__ = (
+    'record_purchase_event',
+    'fetch_purchase_events',
+    'get_purchase_event_cursor',
+    'next_purchase_event',
+    'setup_purchase_events',
+)
+
+log = logging.getLogger("vbu.voxelfox.purchase_events")
+
+
+NOTIFY_CHANNEL = "purchase_events"
+EVENT_RETENTION = timedelta(days=7)  # How long events are kept for replay
+PRUNE_INTERVAL = 60 * 60  # Seconds between removing old events
+
+_new_event = asyncio.Event()
+
+
+async def record_purchase_event(
+        db: vbu.Database,
+        event: str,
+        purchase: Purchase,
+        user: User | None,
+        product: CheckoutItem | None) -> None:
+    """
+    Store a change to a purchase so that it can be sent to the event feed.
+    Subscribers are notified once the given connection commits.
+
+    Parameters
+    ----------
+    db : vbu.Database
+        An open database connection.
+    event : str
+        The type of change - ``"create"``, ``"update"`` or ``"delete"``.
+    purchase : Purchase
+        The purchase that was changed.
+    user : User | None
+        The user who owns the purchase.
+    product : CheckoutItem | None
+        The product that was purchased.
+    """
+
+    base_product_id = product.base_product_id if product else None
+    payload = serialize({
+        "id": purchase.id,
+        "product_id": purchase.product_id,
+        "base_product_id": base_product_id,
+        "quantity": purchase.quantity,
+        "discord_guild_id": purchase.discord_guild_id,
+        "expiry_time": purchase.expiry_time,
+        "timestamp": purchase.timestamp,
+        "user": {
+            "id": user.id,
+            "discord_user_id": user.discord_user_id,
+        } if user else None,
+    })
+    await db.call(
+        """
+        WITH inserted AS (
+            INSERT INTO
+                purchase_events
+                (
+                    product_id,
+                    base_product_id,
+                    event,
+                    payload
+                )
+            VALUES
+                (
+                    $1,
+                    $2,
+                    $3,
+                    $4::JSONB
+                )
+            RETURNING
+                id
+        )
+        SELECT
+            PG_NOTIFY($5, id::TEXT)
+        FROM
+            inserted
+        """,
+        purchase.product_id,
+        base_product_id,
+        event,
+        json.dumps(payload),
+        NOTIFY_CHANNEL,
+    )
+
+
+async def fetch_purchase_events(
+        db: vbu.Database,
+        product_ids: list[str],
+        after: int,
+        limit: int = 100) -> list[dict[str, Any]]:
+    """
+    Get the purchase events for any of the given products, oldest first.
+    Events are only returned once every transaction that started before
+    them has finished, so that an event with a lower cursor can't be
+    committed after one with a higher cursor has been sent.
+
+    Parameters
+    ----------
+    db : vbu.Database
+        An open database connection.
+    product_ids : list[str]
+        The products to get events for. Events for products that are based
+        on these are included.
+    after : int
+        The cursor to get events after.
+    limit : int
+        The maximum number of events to get.
+    """
+
+    rows = await db.call(
+        """
+        SELECT
+            id,
+            event,
+            payload,
+            created_at
+        FROM
+            purchase_events
+        WHERE
+            id > $1
+        AND
+            txid < TXID_SNAPSHOT_XMIN(TXID_CURRENT_SNAPSHOT())
+        AND
+            (
+                    product_id = ANY($2::UUID[])
+                OR
+                    base_product_id = ANY($2::UUID[])
+            )
+        ORDER BY
+            id
+        LIMIT $3
+        """,
+        after,
+        product_ids,
+        limit,
+    )
+    events: list[dict[str, Any]] = []
+    for r in rows:
+        purchase = (
+            json.loads(r['payload'])
+            if isinstance(r['payload'], str)
+            else r['payload']
+        )
+
+        # Older events were stored with every identity the user had
+        if purchase.get("user"):
+            purchase["user"] = {
+                "id": purchase["user"].get("id"),
+                "discord_user_id": purchase["user"].get("discord_user_id"),
+            }
+        events.append({
+            "cursor": r['id'],
+            "event": r['event'],
+            "purchase": purchase,
+            "created_at": r['created_at'].isoformat(),
+        })
+    return events
+
+
+async def get_purchase_event_cursor(db: vbu.Database) -> int:
+    """
+    Get the cursor of the most recent purchase event.
+    """
+
+    rows = await db.call("""SELECT MAX(id) AS id FROM purchase_events""")
+    return rows[0]['id'] or 0
+
+
+def next_purchase_event() -> asyncio.Event:
+    """
+    Get an event that's set when the next purchase event is stored by any
+    worker. Get this *before* reading events so that none are missed.
+    """
+
+    return _new_event
+
+
+def _on_notification(_: str | None) -> None:
+    global _new_event
+    event, _new_event = _new_event, asyncio.Event()
+    event.set()
+
+
+async def _prune_forever() -> None:
+    """
+    Remove events that are too old to be replayed.
+    """
+
+    while True:
+        try:
+            async with vbu.Database() as db:
+                await db.call(
+                    """
+                    DELETE FROM
+                        purchase_events
+                    WHERE
+                        created_at < TIMEZONE('UTC', NOW()) - MAKE_INTERVAL(secs => $1)
+                    """,
+                    EVENT_RETENTION.total_seconds(),
+                )
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            log.error("Failed to prune purchase events", exc_info=True)
+        await asyncio.sleep(PRUNE_INTERVAL)
+
+
+async def _start_pruning(app: Application) -> None:
+    if not app["config"].get("database", {}).get("enabled", False):
+        return
+    app["purchase_event_pruner"] = asyncio.create_task(_prune_forever())
+
+
+async def _stop_pruning(app: Application) -> None:
+    task = app.get("purchase_event_pruner")
+    if task is not None:
+        task.cancel()
+
+
+def setup_purchase_events(app: Application) -> None:
+    """
+    Listen for purchase events from every worker, and remove old events in
+    the background.
+    """
+
+    add_db_listener(NOTIFY_CHANNEL, _on_notification)
+    app.on_startup.append(_start_pruning)
+    app.on_cleanup.append(_stop_pruning)
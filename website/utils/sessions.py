@@ -0,0 +1,214 @@
+from __future__ import annotations
+
+import asyncio
+from collections import OrderedDict
+import copy
+import logging
+import secrets
+import time
+from typing import Any
+import uuid
+
+from aiohttp.web import Application, Request, StreamResponse
+from aiohttp_session import AbstractStorage, Session
+from aiohttp_session.cookie_storage import EncryptedCookieStorage
+from cryptography.fernet import Fernet, MultiFernet
+from discord.ext import vbu
+
+__all__ = (
+    'load_session_keys',
+    'RotatingEncryptedCookieStorage',
+    'RedisSessionStorage',
+)
+
+log = logging.getLogger("vbu.voxelfox.sessions")
+
+
+INVALIDATION_CHANNEL = "website:session-invalidate"
+LOCAL_SESSION_MAX_ITEMS = 10_000  # Sessions kept in memory by each worker
+LOCAL_SESSION_TTL = 60  # Seconds a session is kept in memory before it's read from Redis again
+
+
+def load_session_keys(config: dict[str, Any]) -> list[bytes]:
+    """
+    Get the keys that session cookies are encrypted with from the
+    ``[session]`` section of the config - either a list of ``keys``, or a
+    ``key_file`` with one key per line. The first key is used to encrypt new
+    cookies, and the rest are only used to read old ones, so that keys can
+    be rotated without logging everyone out.
+
+    If no keys are set, a random key is generated, and sessions won't last
+    past a restart.
+
+    Parameters
+    ----------
+    config : dict[str, Any]
+        The website config.
+
+    Returns
+    -------
+    list[bytes]
+        The Fernet keys to use, newest first.
+    """
+
+    session_config = config.get("session", {})
+    keys: list[str] = list(session_config.get("keys", []))
+    key_file = session_config.get("key_file")
+    if key_file:
+        with open(key_file) as a:
+            keys.extend(
+                line.strip()
+                for line in a
+                if line.strip() and not line.strip().startswith("#")
+            )
+    if not keys:
+        log.warning("No session keys are set; sessions won't last past a restart")
+        return [Fernet.generate_key()]
+    return [i.encode() for i in keys]
+
+
+class RotatingEncryptedCookieStorage(EncryptedCookieStorage):
+    """
+    An encrypted cookie storage that accepts cookies encrypted with any of
+    the given keys, and encrypts new cookies with the first.
+
+    Parameters
+    ----------
+    keys : list[bytes]
+        The Fernet keys to use, newest first.
+    """
+
+    def __init__(self, keys: list[bytes], **kwargs: Any):
+        super().__init__(keys[0], **kwargs)
+        self._fernet = MultiFernet([Fernet(i) for i in keys])
+
+
+class RedisSessionStorage(AbstractStorage):
+    """
+    A session storage that keeps session data in Redis, with only a random
+    ID in the cookie. Recently used sessions are kept in a small in-process
+    LRU for a short time; other workers are told (through Redis) to drop
+    their copy when a session is saved. Sessions are only written back when they've been
+    changed, and expire in Redis after the storage's max age.
+
+    Parameters
+    ----------
+    max_age : int
+        Seconds that sessions last for, both in the cookie and in Redis.
+    local_max_items : int
+        The maximum number of sessions kept in memory.
+    prefix : str
+        A prefix added to the session keys stored in Redis.
+    """
+
+    def __init__(
+            self,
+            *,
+            max_age: int,
+            local_max_items: int = LOCAL_SESSION_MAX_ITEMS,
+            prefix: str = "website:session:",
+            **kwargs: Any):
+        super().__init__(max_age=max_age, **kwargs)
+        self.local_max_items = local_max_items
+        self.prefix = prefix
+        self.origin = uuid.uuid4().hex
+        self._local: OrderedDict[str, tuple[float, dict[str, Any]]] = OrderedDict()
+
+    def _get_local(self, key: str) -> dict[str, Any] | None:
+        item = self._local.get(key)
+        if item is None:
+            return None
+        expires_at, data = item
+        if expires_at < time.monotonic():
+            del self._local[key]
+            return None
+        self._local.move_to_end(key)
+        return data
+
+    def _set_local(self, key: str, data: dict[str, Any]) -> None:
+        self._local[key] = (time.monotonic() + LOCAL_SESSION_TTL, data)
+        self._local.move_to_end(key)
+        while len(self._local) > self.local_max_items:
+            self._local.popitem(last=False)
+
+    def forget(self, key: str) -> None:
+        """
+        Drop a session from the in-process cache.
+        """
+
+        self._local.pop(key, None)
+
+    async def load_session(self, request: Request) -> Session:
+        key = self.load_cookie(request)
+        if not key:
+            return Session(None, data=None, new=True, max_age=self.max_age)
+        key = str(key)
+
+        # See if we have it locally
+        data = self._get_local(key)
+        if data is not None:
+            return Session(key, data=copy.deepcopy(data), new=False, max_age=self.max_age)
+
+        # Get it from Redis
+        async with vbu.Redis() as re:
+            value = await re.conn.get(self.prefix + key)
+        if value is None:
+            return Session(None, data=None, new=True, max_age=self.max_age)
+        try:
+            data = self._decoder(value.decode())
+        except ValueError:
+            return Session(None, data=None, new=True, max_age=self.max_age)
+        self._set_local(key, data)
+        return Session(key, data=copy.deepcopy(data), new=False, max_age=self.max_age)
+
+    async def save_session(
+            self,
+            request: Request,
+            response: StreamResponse,
+            session: Session) -> None:
+        key = session.identity
+        if session.empty:
+            self.save_cookie(response, "", max_age=session.max_age)
+            if key is not None:
+                key = str(key)
+                self.forget(key)
+                async with vbu.Redis() as re:
+                    await re.conn.delete(self.prefix + key)
+                    await re.publish_str(INVALIDATION_CHANNEL, f"{self.origin}:{key}")
+            return
+
+        # Store the session
+        if key is None:
+            key = secrets.token_urlsafe(32)
+        key = str(key)
+        data = self._get_session_data(session)
+        async with vbu.Redis() as re:
+            await re.conn.set(
+                self.prefix + key,
+                self._encoder(data),
+                expire=session.max_age or self.max_age,
+            )
+            await re.publish_str(INVALIDATION_CHANNEL, f"{self.origin}:{key}")
+        self._set_local(key, copy.deepcopy(data))
+        self.save_cookie(response, key, max_age=session.max_age)
+
+    async def _listen_for_invalidations(self) -> None:
+        """
+        Drop sessions from the in-process cache when they're saved by other
+        workers.
+        """
+
+        async with vbu.Redis() as re:
+            channel, = await re.conn.subscribe(INVALIDATION_CHANNEL)
+        async for message in channel.iter(encoding="utf-8"):
+            origin, _, key = message.partition(":")
+            if origin != self.origin:
+                self.forget(key)
+
+    async def start(self, app: Application) -> None:
+        app["session_invalidation_listener"] = asyncio.create_task(self._listen_for_invalidations())
+
+    async def stop(self, app: Application) -> None:
+        task = app.get("session_invalidation_listener")
+        if task is not None:
+            task.cancel()
@@ -0,0 +1,149 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+
+import asyncpg
+from aiohttp.web import Application
+
+__all__ = (
+    'get_dsn_pool',
+    'close_dsn_pools',
+)
+
+log = logging.getLogger("vbu.voxelfox.sql_pools")
+
+
+POOL_MAX_SIZE = 5  # Max connections per downstream database
+POOL_IDLE_LIFETIME = 60 * 10  # Seconds before an unused pool is closed
+POOL_HEALTH_CHECK_INTERVAL = 60  # Seconds between pool health checks
+POOL_HEALTH_CHECK_TIMEOUT = 5
+POOL_COMMAND_TIMEOUT = 30  # Max seconds a delivered statement can run for
+POOL_CLOSE_TIMEOUT = POOL_COMMAND_TIMEOUT + 10  # Seconds to let running statements finish before a pool is terminated
+
+
+class _PoolEntry:
+
+    __slots__ = (
+        'pool',
+        'last_used',
+        'last_checked',
+    )
+
+    def __init__(self, pool: asyncpg.Pool):
+        self.pool = pool
+        self.last_used = time.monotonic()
+        self.last_checked = time.monotonic()
+
+
+DSN_POOLS: dict[str, _PoolEntry] = {}
+_DSN_LOCKS: dict[str, asyncio.Lock] = {}
+_closing: set[asyncio.Task] = set()
+
+
+async def _close_pool(pool: asyncpg.Pool) -> None:
+    try:
+        await asyncio.wait_for(pool.close(), timeout=POOL_CLOSE_TIMEOUT)
+    except Exception:
+        pool.terminate()
+
+
+def _close_pool_later(pool: asyncpg.Pool) -> None:
+    """
+    Close a pool in the background, letting anything that's using it
+    finish first.
+    """
+
+    task = asyncio.create_task(_close_pool(pool))
+    _closing.add(task)
+    task.add_done_callback(_closing.discard)
+
+
+async def _evict_idle_pools() -> None:
+    """
+    Close any pools that haven't been used within the idle lifetime, and
+    forget the locks of any DSNs that don't have a pool.
+    """
+
+    now = time.monotonic()
+    for dsn, entry in list(DSN_POOLS.items()):
+        if now - entry.last_used < POOL_IDLE_LIFETIME:
+            continue
+        log.info("Closing idle SQL delivery pool")
+        del DSN_POOLS[dsn]
+        _close_pool_later(entry.pool)
+    for dsn, lock in list(_DSN_LOCKS.items()):
+        if dsn not in DSN_POOLS and not lock.locked():
+            del _DSN_LOCKS[dsn]
+
+
+async def _is_healthy(entry: _PoolEntry) -> bool:
+    """
+    Check that a pool is still able to talk to its database.
+    """
+
+    if time.monotonic() - entry.last_checked < POOL_HEALTH_CHECK_INTERVAL:
+        return True
+    try:
+        await asyncio.wait_for(
+            entry.pool.fetchval("SELECT 1"),
+            timeout=POOL_HEALTH_CHECK_TIMEOUT,
+        )
+    except Exception:
+        log.warning("SQL delivery pool failed its health check", exc_info=True)
+        return False
+    entry.last_checked = time.monotonic()
+    return True
+
+
+async def get_dsn_pool(dsn: str) -> asyncpg.Pool:
+    """
+    Get a connection pool for the given DSN, creating one if there isn't a
+    healthy pool for it already.
+
+    Parameters
+    ----------
+    dsn : str
+        The DSN of the database that you want to connect to.
+
+    Returns
+    -------
+    asyncpg.Pool
+        A pool connected to the given database.
+    """
+
+    await _evict_idle_pools()
+    lock = _DSN_LOCKS.setdefault(dsn, asyncio.Lock())
+    async with lock:
+        entry = DSN_POOLS.get(dsn)
+        if entry is not None and not await _is_healthy(entry):
+            del DSN_POOLS[dsn]
+            _close_pool_later(entry.pool)
+            entry = None
+        if entry is None:
+            log.info("Creating new SQL delivery pool")
+            pool = await asyncpg.create_pool(
+                dsn,
+                min_size=0,
+                max_size=POOL_MAX_SIZE,
+                max_inactive_connection_lifetime=POOL_IDLE_LIFETIME,
+                command_timeout=POOL_COMMAND_TIMEOUT,
+            )
+            assert pool
+            entry = DSN_POOLS[dsn] = _PoolEntry(pool)
+        entry.last_used = time.monotonic()
+        return entry.pool
+
+
+async def close_dsn_pools(_: Application | None = None) -> None:
+    """
+    Close all of the open SQL delivery pools.
+    """
+
+    entries = list(DSN_POOLS.values())
+    DSN_POOLS.clear()
+    _DSN_LOCKS.clear()
+    for entry in entries:
+        await _close_pool(entry.pool)
+    await asyncio.gather(*_closing, return_exceptions=True)
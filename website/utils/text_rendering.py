@@ -0,0 +1,114 @@
+from datetime import datetime as dt
+from functools import lru_cache
+import html
+import re
+import threading
+from typing import Any
+
+from jinja2 import Environment
+import markdown
+
+__all__ = (
+    'render_message',
+    'register_filters',
+)
+
+
+MENTION_PATTERN = r"(?:<|&lt;)@!?(?P<userid>\d{16,23})(?:>|&gt;)"
+EMOJI_PATTERN = r"(?:<|&lt;)(?P<animated>a)?:(?P<name>\w+):(?P<id>\d+)(?:>|&gt;)"
+MENTION_REGEX = re.compile(MENTION_PATTERN, re.IGNORECASE | re.MULTILINE)
+EMOJI_REGEX = re.compile(EMOJI_PATTERN, re.IGNORECASE | re.MULTILINE)
+TOKEN_REGEX = re.compile(
+    f"(?P<mention>{MENTION_PATTERN})|(?P<emoji>{EMOJI_PATTERN})",
+    re.IGNORECASE | re.MULTILINE,
+)
+
+_markdown = threading.local()
+
+
+@lru_cache(maxsize=128)
+def _compile(pattern: str) -> re.Pattern:
+    return re.compile(pattern, re.IGNORECASE | re.MULTILINE)
+
+
+def regex_replace(string, find, replace):
+    return _compile(find).sub(replace, string)
+
+
+def escape_text(string):
+    return html.escape(string)
+
+
+def timestamp(string):
+    return dt.fromtimestamp(float(string))
+
+
+def int_to_hex(string):
+    return format(hex(int(string))[2:], "0>6")
+
+
+def to_markdown(string):
+    # Building a Markdown instance (and its extensions) is slow, so we keep
+    # one per thread and reset it between uses
+    md = getattr(_markdown, "instance", None)
+    if md is None:
+        md = _markdown.instance = markdown.Markdown(extensions=["extra"])
+    return md.reset().convert(string)
+
+
+def _mention_html(match: re.Match, users: dict[str, Any]) -> str:
+    user = users.get(match.group("userid"))
+    if not user:
+        name = "unknown-user"
+    else:
+        name = user.get("display_name") or user.get("username")
+    return f'<span class="chatlog__mention">@{name}</span>'
+
+
+def _emoji_html(match: re.Match) -> str:
+    return (
+        f'<img class="discord_emoji" src="https://cdn.discordapp.com/emojis/{match.group("id")}'
+        f'.{"gif" if match.group("animated") else "png"}" alt="Discord custom emoji: '
+        f'{match.group("name")}" style="height: 1em; width: auto;">'
+    )
+
+
+def display_mentions(string, users):
+    return MENTION_REGEX.sub(lambda m: _mention_html(m, users), string)
+
+
+def display_emojis(string):
+    return EMOJI_REGEX.sub(_emoji_html, string)
+
+
+def render_message(string, users, markdown=True):
+    """
+    Render the content of a Discord message as HTML - escaping it,
+    converting its markdown, and then replacing mentions and custom emojis
+    in a single pass.
+    """
+
+    def replace(match: re.Match) -> str:
+        if match.group("mention"):
+            return _mention_html(match, users)
+        return _emoji_html(match)
+
+    string = escape_text(string)
+    if markdown:
+        string = to_markdown(string)
+    return TOKEN_REGEX.sub(replace, string)
+
+
+def register_filters(env: Environment) -> None:
+    """
+    Add the website's text filters to a Jinja environment.
+    """
+
+    env.filters["regex_replace"] = regex_replace
+    env.filters["escape_text"] = escape_text
+    env.filters["timestamp"] = timestamp
+    env.filters["int_to_hex"] = int_to_hex
+    env.filters["markdown"] = to_markdown
+    env.filters["display_mentions"] = display_mentions
+    env.filters["display_emojis"] = display_emojis
+    env.filters["render_message"] = render_message
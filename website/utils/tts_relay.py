@@ -0,0 +1,332 @@
+from __future__ import annotations
+
+import asyncio
+from collections import deque
+import json
+import logging
+from typing import Any, Literal, Protocol
+import uuid
+
+from aiohttp.web import Application, WebSocketResponse
+from discord.ext import vbu
+
+__all__ = (
+    'RelayConnection',
+    'TTSRelayBroker',
+    'LocalTTSRelayBroker',
+    'RedisTTSRelayBroker',
+    'get_tts_relay_broker',
+    'set_tts_relay_broker',
+    'setup_tts_relay',
+)
+
+log = logging.getLogger("vbu.voxelfox.tts_relay")
+
+
+Role = Literal["tts", "streamdeck"]
+CHANNEL_PREFIX = "website:tts-streamdeck:"
+SEND_QUEUE_SIZE = 64  # Messages queued for a client before the oldest are dropped
+SEND_TIMEOUT = 10  # Seconds a client can take to accept a message before it's closed
+
+
+class RelayConnection:
+    """
+    A websocket with its own bounded queue of messages to send, and a task
+    that writes them, so that a slow client doesn't hold up the messages
+    sent to any others. When the queue is full the oldest message is
+    dropped; a client that doesn't accept a message within the send
+    timeout is disconnected.
+
+    Attributes
+    ----------
+    ws : WebSocketResponse
+        The websocket that messages are sent to.
+    queue_size : int
+        The maximum number of messages waiting to be sent.
+    stats : dict[str, int]
+        How many messages have been ``sent``, ``dropped`` and ``failed``,
+        and the ``max_depth`` that the queue has reached.
+    """
+
+    def __init__(self, ws: WebSocketResponse, queue_size: int = SEND_QUEUE_SIZE):
+        self.ws = ws
+        self.queue_size = queue_size
+        self.stats: dict[str, int] = {
+            "sent": 0,
+            "dropped": 0,
+            "failed": 0,
+            "max_depth": 0,
+        }
+        self._queue: deque[str] = deque()
+        self._ready = asyncio.Event()
+        self._writer = asyncio.create_task(self._write_forever())
+
+    @property
+    def depth(self) -> int:
+        return len(self._queue)
+
+    @property
+    def closed(self) -> bool:
+        return self.ws.closed or self._writer.done()
+
+    def send(self, text: str) -> None:
+        """
+        Queue a message to be sent. This never waits.
+        """
+
+        if len(self._queue) >= self.queue_size:
+            self._queue.popleft()
+            self.stats["dropped"] += 1
+        self._queue.append(text)
+        self.stats["max_depth"] = max(self.stats["max_depth"], len(self._queue))
+        self._ready.set()
+
+    async def _write_forever(self) -> None:
+        while True:
+            await self._ready.wait()
+            while self._queue:
+                text = self._queue.popleft()
+                try:
+                    await asyncio.wait_for(self.ws.send_str(text), SEND_TIMEOUT)
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    self.stats["failed"] += 1
+                    log.info("Closing TTS relay client that couldn't be sent to", exc_info=True)
+                    await self.ws.close()
+                    return
+                self.stats["sent"] += 1
+            self._ready.clear()
+
+    def close(self) -> None:
+        """
+        Stop sending messages. Anything still queued is dropped.
+        """
+
+        self.stats["dropped"] += len(self._queue)
+        self._queue.clear()
+        self._writer.cancel()
+
+
+class TTSRelayBroker(Protocol):
+    """
+    Passes messages between the TTS clients and Streamdecks connected for
+    the same username.
+    """
+
+    async def join(self, username: str, role: Role, ws: WebSocketResponse) -> None:
+        ...
+
+    async def leave(self, username: str, role: Role, ws: WebSocketResponse) -> None:
+        ...
+
+    async def publish(self, username: str, role: Role, text: str) -> None:
+        ...
+
+    async def close(self) -> None:
+        ...
+
+    def get_metrics(self) -> dict[str, Any]:
+        ...
+
+
+class LocalTTSRelayBroker:
+    """
+    A broker that only relays messages between clients connected to this
+    process.
+    """
+
+    def __init__(self):
+        self.clients: dict[str, dict[Role, dict[WebSocketResponse, RelayConnection]]] = {}
+
+    async def join(self, username: str, role: Role, ws: WebSocketResponse) -> None:
+        """
+        Add a websocket that messages for the given username and role
+        should be sent to.
+        """
+
+        self.clients.setdefault(username, {"tts": {}, "streamdeck": {}})
+        self.clients[username][role][ws] = RelayConnection(ws)
+
+    async def leave(self, username: str, role: Role, ws: WebSocketResponse) -> None:
+        """
+        Remove a websocket added with :meth:`join`.
+        """
+
+        roles = self.clients.get(username)
+        if roles is None:
+            return
+        connection = roles[role].pop(ws, None)
+        if connection is not None:
+            connection.close()
+        if not roles["tts"] and not roles["streamdeck"]:
+            del self.clients[username]
+
+    async def publish(self, username: str, role: Role, text: str) -> None:
+        """
+        Send a message to every client with the given username and role.
+        """
+
+        await self.deliver(username, role, text)
+
+    async def deliver(self, username: str, role: Role, text: str) -> None:
+        """
+        Queue a message for the clients with the given username and role
+        that are connected to this process. Each client is sent the message
+        by its own writer, so this doesn't wait for any of them.
+        """
+
+        peers = self.clients.get(username, {}).get(role, {})
+        for ws, connection in list(peers.items()):
+            if connection.closed:
+                connection.close()
+                del peers[ws]
+                continue
+            connection.send(text)
+
+    async def close(self) -> None:
+        for roles in self.clients.values():
+            for peers in roles.values():
+                for connection in peers.values():
+                    connection.close()
+        self.clients.clear()
+
+    def get_metrics(self) -> dict[str, Any]:
+        """
+        Get the queue depth and counters for each connected client.
+        """
+
+        connections = [
+            {
+                "username": username,
+                "role": role,
+                "depth": connection.depth,
+                **connection.stats,
+            }
+            for username, roles in self.clients.items()
+            for role, peers in roles.items()
+            for connection in peers.values()
+        ]
+        return {
+            "connections": connections,
+            "queued": sum(i["depth"] for i in connections),
+            "dropped": sum(i["dropped"] for i in connections),
+        }
+
+
+class RedisTTSRelayBroker(LocalTTSRelayBroker):
+    """
+    A broker that relays messages through Redis so that clients connected
+    to different workers (or servers) can talk to each other. Each process
+    only subscribes to the channels of the usernames connected to it.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.origin = uuid.uuid4().hex
+        self._readers: dict[str, asyncio.Task] = {}
+        self._lock = asyncio.Lock()
+
+    @staticmethod
+    def channel_name(username: str) -> str:
+        return CHANNEL_PREFIX + username
+
+    async def join(self, username: str, role: Role, ws: WebSocketResponse) -> None:
+        await super().join(username, role, ws)
+        async with self._lock:
+            if username in self._readers or username not in self.clients:
+                return
+            async with vbu.Redis() as re:
+                channel, = await re.conn.subscribe(self.channel_name(username))
+            self._readers[username] = asyncio.create_task(self._read(username, channel))
+
+    async def leave(self, username: str, role: Role, ws: WebSocketResponse) -> None:
+        await super().leave(username, role, ws)
+        async with self._lock:
+            if username in self.clients or username not in self._readers:
+                return
+            self._readers.pop(username)
+            try:
+                async with vbu.Redis() as re:
+                    await re.conn.unsubscribe(self.channel_name(username))
+            except Exception:
+                log.warning(f"Failed to unsubscribe from TTS relay for {username}", exc_info=True)
+
+    async def publish(self, username: str, role: Role, text: str) -> None:
+        """
+        Send a message to every client with the given username and role,
+        on any worker. Clients on this process are sent the message
+        directly rather than waiting for it to come back from Redis.
+        """
+
+        await self.deliver(username, role, text)
+        payload = json.dumps({
+            "origin": self.origin,
+            "role": role,
+            "text": text,
+        })
+        try:
+            async with vbu.Redis() as re:
+                await re.publish_str(self.channel_name(username), payload)
+        except Exception:
+            log.warning(f"Failed to publish TTS relay message for {username}", exc_info=True)
+
+    async def _read(self, username: str, channel) -> None:
+        """
+        Deliver the messages published for a username by other processes.
+        """
+
+        async for message in channel.iter(encoding="utf-8"):
+            try:
+                data = json.loads(message)
+                if data["origin"] == self.origin:
+                    continue
+                await self.deliver(username, data["role"], data["text"])
+            except Exception:
+                log.warning(f"Failed to relay TTS message for {username}", exc_info=True)
+
+    async def close(self) -> None:
+        for task in self._readers.values():
+            task.cancel()
+        self._readers.clear()
+        await super().close()
+
+
+_broker: TTSRelayBroker = LocalTTSRelayBroker()
+
+
+def get_tts_relay_broker() -> TTSRelayBroker:
+    """
+    Get the broker used to relay TTS Streamdeck messages.
+    """
+
+    return _broker
+
+
+def set_tts_relay_broker(broker: TTSRelayBroker) -> None:
+    """
+    Set the broker used to relay TTS Streamdeck messages.
+    """
+
+    global _broker
+    _broker = broker
+
+
+async def _close_broker(_: Application) -> None:
+    await get_tts_relay_broker().close()
+
+
+def setup_tts_relay(app: Application) -> None:
+    """
+    Pick the TTS Streamdeck relay broker from the ``[tts_relay]`` section
+    of the config - ``"redis"`` to relay between workers, or ``"local"``
+    to only relay within this process.
+    """
+
+    backend = app["config"].get("tts_relay", {}).get("backend", "local")
+    if backend == "redis":
+        if app["config"].get("redis", {}).get("enabled", False):
+            set_tts_relay_broker(RedisTTSRelayBroker())
+        else:
+            log.warning("Redis isn't enabled; TTS messages will only be relayed within each worker")
+    app.on_cleanup.append(_close_broker)
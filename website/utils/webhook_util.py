@@ -3,8 +3,8 @@ import logging
 
 from typing import TYPE_CHECKING, Any
 
-import aiohttp
-import asyncpg
+from .http_sessions import get_session
+from .sql_pools import get_dsn_pool
 
 if TYPE_CHECKING:
     from .db_util import CheckoutItem
@@ -21,7 +21,8 @@ async def send_webhook(
         item: CheckoutItem,
         data: dict[str, Any]) -> None:
     """
-    Send a webhook to the given URL with the given data.
+    Send a webhook to the given URL with the given data. Raises an error if
+    the remote server fails in a way that's worth retrying.
     """
 
     if not item.webhook:
@@ -29,15 +30,16 @@ async def send_webhook(
         return
     headers = {"Authorization": item.webhook_auth}
     url = item.webhook
-    async with aiohttp.ClientSession() as session:
-        log.info(f"Sending POST {item.webhook} {data}")
-        try:
-            resp = await session.post(url, json=data, headers=headers)
+    log.info(f"Sending POST {item.webhook} {data}")
+    try:
+        async with get_session("webhook").post(url, json=data, headers=headers) as resp:
             body = await resp.read()
-        except Exception:
-            log.info("Error sending webhook", exc_info=True)
-            raise
-        log.info(f"POST {item.webhook} returned {resp.status} {body}")
+    except Exception:
+        log.info("Error sending webhook", exc_info=True)
+        raise
+    log.info(f"POST {item.webhook} returned {resp.status} {body}")
+    if resp.status >= 500 or resp.status == 429:
+        raise Exception(f"POST {item.webhook} returned {resp.status}")
 
 
 async def send_sql(
@@ -50,13 +52,11 @@ async def send_sql(
     if not item.dsn or not item.sql:
         log.info(f"No SQL found for item {item} {data}")
         return
-    conn = await asyncpg.connect(item.dsn)
+    pool = await get_dsn_pool(item.dsn)
     log.info(f"Executing SQL for {item} {data}")
     try:
-        await conn.execute(item.sql.format(**data))
+        await pool.execute(item.sql.format(**data))
     except Exception:
         log.info("Error executing SQL", exc_info=True)
         raise
-    finally:
-        await conn.close()
     log.info(f"Executed SQL for {item} successfully")